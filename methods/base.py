@@ -1,43 +1,73 @@
 from collections import defaultdict
 
 from modules import visualization as vis
+from modules.scalar_buffer import ScalarBuffer
 from nnlib.nnlib.method_utils import Method
 
 
 class BaseClassifier(Method):
     """ Abstract class for classifiers.
     """
+    # outputs of forward() that are collected once per visualization epoch, see make_vis_caches()
+    vis_output_keys = ['pred']
+    # statistics added with log_scalar() are written to tensorboard every this many iterations
+    scalar_flush_iters = 100
+
     def __init__(self, **kwargs):
         super(BaseClassifier, self).__init__()
         # initialize and use later
         self._current_iteration = defaultdict(lambda: 0)
+        self._scalar_buffer = ScalarBuffer(flush_every=self.scalar_flush_iters)
+
+    def log_scalar(self, tag, value, partition):
+        """ Registers a statistic for the current iteration of the partition. The value can be a tensor
+        on the device, it is moved to the host only when the buffer is flushed.
+        """
+        self._scalar_buffer.add(tag, value, step=self._current_iteration[partition])
 
-    def on_iteration_end(self, partition, **kwargs):
+    def on_iteration_end(self, partition, tensorboard=None, **kwargs):
         self._current_iteration[partition] += 1
+        self._scalar_buffer.step(tensorboard=tensorboard)
+
+    def on_epoch_end(self, tensorboard=None, **kwargs):
+        self._scalar_buffer.flush(tensorboard=tensorboard)
+        super(BaseClassifier, self).on_epoch_end(tensorboard=tensorboard, **kwargs)
+
+    def make_vis_caches(self, train_loader, val_loader):
+        """ Runs one inference pass per split that collects all outputs needed by visualize(). """
+        caches = {'train': vis.InferenceCache(self, train_loader, output_keys=self.vis_output_keys,
+                                              description='vis-cache:train')}
+        if val_loader is not None:
+            caches['val'] = vis.InferenceCache(self, val_loader, output_keys=self.vis_output_keys,
+                                               description='vis-cache:val')
+        return caches
 
     def visualize(self, train_loader, val_loader, tensorboard=None, epoch=None, **kwargs):
-        visualizations = {}
+        vis_caches = self.make_vis_caches(train_loader, val_loader)
+        tasks = self.visualization_tasks(train_loader, val_loader, vis_caches=vis_caches, tensorboard=tensorboard)
+        return vis.render_tasks(tasks, tensorboard=tensorboard, epoch=epoch)
+
+    def visualization_tasks(self, train_loader, val_loader, vis_caches, **kwargs):
+        """ Returns the list of plots to make (see modules/visualization.py). Subclasses extend this list. """
+        tasks = []
 
         # gradient norm tensorboard histograms
-        if tensorboard is not None:
-            vis.ce_gradient_norm_histogram(self, train_loader, tensorboard, epoch, name='train-ce-grad')
-            if val_loader is not None:
-                vis.ce_gradient_norm_histogram(self, val_loader, tensorboard, epoch, name='val-ce-grad')
+        tasks.append(vis.ce_gradient_norm_histogram(vis_caches['train'], name='train-ce-grad'))
+        if val_loader is not None:
+            tasks.append(vis.ce_gradient_norm_histogram(vis_caches['val'], name='val-ce-grad'))
 
         # add gradient pair plots
         if train_loader.dataset.dataset_name == 'mnist':
             for p in [(0, 1), (4, 9)]:
-                fig, _ = vis.ce_gradient_pair_scatter(self, train_loader, d1=p[0], d2=p[1])
-                visualizations['gradients/train-ce-scatter-{}-{}'.format(p[0], p[1])] = fig
+                tasks.append(vis.ce_gradient_pair_scatter(
+                    vis_caches['train'], name='gradients/train-ce-scatter-{}-{}'.format(p[0], p[1]), d1=p[0], d2=p[1]))
                 if val_loader is not None:
-                    fig, _ = vis.ce_gradient_pair_scatter(self, val_loader, d1=p[0], d2=p[1])
-                    visualizations['gradients/val-ce-scatter-{}-{}'.format(p[0], p[1])] = fig
+                    tasks.append(vis.ce_gradient_pair_scatter(
+                        vis_caches['val'], name='gradients/val-ce-scatter-{}-{}'.format(p[0], p[1]), d1=p[0], d2=p[1]))
 
         # visualize pred
-        fig, _ = vis.plot_predictions(self, train_loader, key='pred')
-        visualizations['predictions/pred-train'] = fig
+        tasks.append(vis.plot_predictions(vis_caches['train'], name='predictions/pred-train', key='pred'))
         if val_loader is not None:
-            fig, _ = vis.plot_predictions(self, val_loader, key='pred')
-            visualizations['predictions/pred-val'] = fig
+            tasks.append(vis.plot_predictions(vis_caches['val'], name='predictions/pred-val', key='pred'))
 
-        return visualizations
+        return tasks
@@ -2,9 +2,9 @@ import numpy as np
 import torch
 import torch.nn.functional as F
 
-from nnlib.nnlib import visualizations as vis
 from nnlib.nnlib import losses, utils
 from modules import nn_utils
+from modules import visualization as vis
 from methods.predict import PredictGradBaseClassifier
 
 
@@ -18,6 +18,8 @@ class LIMIT(PredictGradBaseClassifier):
 
     For more details, refer to the paper at https://arxiv.org/abs/2002.07933.
     """
+    vis_output_keys = ['pred', 'grad_pred', 'q_label_pred']
+
     @utils.capture_arguments_of_init
     def __init__(self, input_shape, architecture_args, device='cuda',
                  grad_weight_decay=0.0, lamb=1.0, sample_from_q=False,
@@ -171,15 +173,15 @@ class LIMIT(PredictGradBaseClassifier):
             for param in self.classifier.parameters():
                 param.requires_grad = requires_grad
 
-    def visualize(self, train_loader, val_loader, tensorboard=None, epoch=None, **kwargs):
-        visualizations = super(LIMIT, self).visualize(train_loader, val_loader,
-                                                      tensorboard, epoch)
+    def visualization_tasks(self, train_loader, val_loader, vis_caches, **kwargs):
+        tasks = super(LIMIT, self).visualization_tasks(train_loader, val_loader,
+                                                       vis_caches=vis_caches, **kwargs)
 
         # visualize q_label_pred
-        fig, _ = vis.plot_predictions(self, train_loader, key='q_label_pred')
-        visualizations['predictions/q-label-pred-train'] = fig
+        tasks.append(vis.plot_predictions(vis_caches['train'], name='predictions/q-label-pred-train',
+                                          key='q_label_pred'))
         if val_loader is not None:
-            fig, _ = vis.plot_predictions(self, val_loader, key='q_label_pred')
-            visualizations['predictions/q-label-pred-val'] = fig
+            tasks.append(vis.plot_predictions(vis_caches['val'], name='predictions/q-label-pred-val',
+                                              key='q_label_pred'))
 
-        return visualizations
+        return tasks
@@ -104,10 +104,11 @@ class PenalizeLastLayerFixedForm(BaseClassifier):
 
         return batch_losses, outputs
 
-    def on_iteration_end(self, outputs, batch_labels, partition, tensorboard, **kwargs):
+    def on_iteration_end(self, outputs, batch_labels, partition, tensorboard=None, **kwargs):
         super(PenalizeLastLayerFixedForm, self).on_iteration_end(outputs=outputs, batch_labels=batch_labels,
-                                                                 partition=partition, **kwargs)
+                                                                 partition=partition, tensorboard=tensorboard,
+                                                                 **kwargs)
         # track some additional statistics
-        tensorboard.add_scalar('stats/{}_norm_z'.format(partition),
-                               torch.sum(outputs['z'] ** 2, dim=1).mean(),
-                               self._current_iteration[partition])
+        self.log_scalar('stats/{}_norm_z'.format(partition),
+                        torch.sum(outputs['z'] ** 2, dim=1).mean(),
+                        partition=partition)
@@ -11,34 +11,39 @@ from nnlib.nnlib import utils
 class PredictGradBaseClassifier(BaseClassifier):
     """ Abstract class for gradient prediction approaches.
     """
+    vis_output_keys = ['pred', 'grad_pred']
+
     def __init__(self, **kwargs):
         super(PredictGradBaseClassifier, self).__init__(**kwargs)
 
-    def visualize(self, train_loader, val_loader, tensorboard=None, epoch=None, **kwargs):
-        visualizations = super(PredictGradBaseClassifier, self).visualize(
-            train_loader, val_loader, tensorboard, epoch)
+    def visualization_tasks(self, train_loader, val_loader, vis_caches, **kwargs):
+        tasks = super(PredictGradBaseClassifier, self).visualization_tasks(
+            train_loader, val_loader, vis_caches=vis_caches, **kwargs)
 
         # gradient norm tensorboard histograms
-        if tensorboard is not None:
-            vis.pred_gradient_norm_histogram(self, train_loader, tensorboard, epoch, name='train-pred-grad')
-            if val_loader is not None:
-                vis.pred_gradient_norm_histogram(self, val_loader, tensorboard, epoch, name='val-pred-grad')
+        tasks.append(vis.pred_gradient_norm_histogram(vis_caches['train'], name='train-pred-grad'))
+        if val_loader is not None:
+            tasks.append(vis.pred_gradient_norm_histogram(vis_caches['val'], name='val-pred-grad'))
 
         # add gradient pair plots
         if train_loader.dataset.dataset_name == 'mnist':
             for p in [(0, 1), (4, 9)]:
-                fig, _ = vis.pred_gradient_pair_scatter(self, train_loader, d1=p[0], d2=p[1])
-                visualizations['gradients/train-pred-scatter-{}-{}'.format(p[0], p[1])] = fig
+                tasks.append(vis.pred_gradient_pair_scatter(
+                    vis_caches['train'], name='gradients/train-pred-scatter-{}-{}'.format(p[0], p[1]),
+                    d1=p[0], d2=p[1]))
                 if val_loader is not None:
-                    fig, _ = vis.pred_gradient_pair_scatter(self, val_loader, d1=p[0], d2=p[1])
-                    visualizations['gradients/val-pred-scatter-{}-{}'.format(p[0], p[1])] = fig
+                    tasks.append(vis.pred_gradient_pair_scatter(
+                        vis_caches['val'], name='gradients/val-pred-scatter-{}-{}'.format(p[0], p[1]),
+                        d1=p[0], d2=p[1]))
 
-        return visualizations
+        return tasks
 
 
 class PredictGradOutput(PredictGradBaseClassifier):
     """ Trains the classifier using predicted gradients. Only the output gradients are predicted.
     """
+    vis_output_keys = ['pred', 'grad_pred', 'q_label_pred']
+
     @utils.capture_arguments_of_init
     def __init__(self, input_shape, architecture_args, pretrained_arg=None, device='cuda',
                  grad_weight_decay=0.0, grad_l1_penalty=0.0, lamb=1.0, sample_from_q=False,
@@ -214,24 +219,26 @@ class PredictGradOutput(PredictGradBaseClassifier):
             for param in self.classifier.parameters():
                 param.requires_grad = requires_grad
 
-    def visualize(self, train_loader, val_loader, tensorboard=None, epoch=None, **kwargs):
-        visualizations = super(PredictGradOutput, self).visualize(train_loader, val_loader,
-                                                                  tensorboard, epoch)
+    def visualization_tasks(self, train_loader, val_loader, vis_caches, **kwargs):
+        tasks = super(PredictGradOutput, self).visualization_tasks(train_loader, val_loader,
+                                                                   vis_caches=vis_caches, **kwargs)
 
         # visualize q_label_pred
-        fig, _ = vis.plot_predictions(self, train_loader, key='q_label_pred')
-        visualizations['predictions/q-label-pred-train'] = fig
+        tasks.append(vis.plot_predictions(vis_caches['train'], name='predictions/q-label-pred-train',
+                                          key='q_label_pred'))
         if val_loader is not None:
-            fig, _ = vis.plot_predictions(self, val_loader, key='q_label_pred')
-            visualizations['predictions/q-label-pred-val'] = fig
+            tasks.append(vis.plot_predictions(vis_caches['val'], name='predictions/q-label-pred-val',
+                                              key='q_label_pred'))
 
-        return visualizations
+        return tasks
 
 
 class PredictGradOutputFixedFormWithConfusion(PredictGradBaseClassifier):
     """ Trains the classifier using predicted gradients. Only the output gradients are predicted.
     The q network uses the form of output gradients. A confusion matrix is also inferred.
     """
+    vis_output_keys = ['pred', 'grad_pred', 'q_label_pred']
+
     @utils.capture_arguments_of_init
     def __init__(self, input_shape, architecture_args, pretrained_arg=None, device='cuda',
                  grad_weight_decay=0.0, grad_l1_penalty=0.0, lamb=1.0, small_qtop=False,
@@ -350,23 +357,23 @@ class PredictGradOutputFixedFormWithConfusion(PredictGradBaseClassifier):
 
         return batch_losses, outputs
 
-    def visualize(self, train_loader, val_loader, tensorboard=None, epoch=None, **kwargs):
-        visualizations = super(PredictGradOutputFixedFormWithConfusion, self).visualize(
-            train_loader, val_loader, tensorboard, epoch)
+    def visualization_tasks(self, train_loader, val_loader, vis_caches, tensorboard=None, **kwargs):
+        tasks = super(PredictGradOutputFixedFormWithConfusion, self).visualization_tasks(
+            train_loader, val_loader, vis_caches=vis_caches, tensorboard=tensorboard, **kwargs)
 
         # visualize the confusion matrix
         if tensorboard is not None:
-            fig, _ = vis.plot_confusion_matrix(torch.softmax(self.Q_logits, dim=1))
-            visualizations['confusion-matrix'] = fig
+            Q = utils.to_numpy(torch.softmax(self.Q_logits, dim=1))
+            tasks.append(vis.FigureTask('confusion-matrix', vis.plot_confusion_matrix, Q=Q))
 
         # visualize q_label_pred
-        fig, _ = vis.plot_predictions(self, train_loader, key='q_label_pred')
-        visualizations['predictions/q-label-pred-train'] = fig
+        tasks.append(vis.plot_predictions(vis_caches['train'], name='predictions/q-label-pred-train',
+                                          key='q_label_pred'))
         if val_loader is not None:
-            fig, _ = vis.plot_predictions(self, val_loader, key='q_label_pred')
-            visualizations['predictions/q-label-pred-val'] = fig
+            tasks.append(vis.plot_predictions(vis_caches['val'], name='predictions/q-label-pred-val',
+                                              key='q_label_pred'))
 
-        return visualizations
+        return tasks
 
 
 # TODO: pred_before needs to be detached
@@ -1,7 +1,10 @@
+import numpy as np
 import torch
 
 from modules import nn_utils, losses
 from modules import visualization as vis
+from modules.data_utils import get_labels
+from nnlib.nnlib import utils
 from nnlib.nnlib.utils import capture_arguments_of_init
 from nnlib.nnlib.data_utils.base import revert_normalization
 from nnlib.nnlib.method_utils import Method
@@ -11,6 +14,10 @@ class VAE(Method):
     """ VAE with two additional regularization parameters.
      `beta`: weight of the KL term, as in beta-VAE
     """
+    # the latent space embedding is made of this many validation examples, within this many seconds
+    latent_embedding_size = 2000
+    latent_embedding_time_budget = 10.0
+
     @capture_arguments_of_init
     def __init__(self, input_shape, architecture_args, device='cuda', **kwargs):
         super(VAE, self).__init__()
@@ -80,28 +87,57 @@ class VAE(Method):
 
         return batch_losses, outputs
 
-    def visualize(self, train_loader, val_loader, **kwargs):
+    def decode_grid(self, low, high, n_points, d1=0, d2=1):
+        """ Decodes latent codes that vary on a (n_points, n_points) grid along dimensions d1 and d2, the other
+        dimensions being fixed to random values. Returns a numpy array of shape (n_points, n_points, C, H, W).
+        """
+        z = np.random.uniform(low=low, high=high, size=(self.hidden_shape[-1],))
+        z = np.tile(z, (n_points, n_points, 1))
+        grid = np.linspace(low, high, n_points)
+        z[:, :, d1] = grid[:, np.newaxis]
+        z[:, :, d2] = grid[np.newaxis, :]
+        z = torch.tensor(z.reshape((n_points * n_points, -1)), dtype=torch.float, device=self.device)
+        with torch.no_grad():
+            x = self.decoder(z)
+        return utils.to_numpy(x).reshape([n_points, n_points] + list(self.input_shape[1:]))
+
+    def visualize(self, train_loader, val_loader, tensorboard=None, epoch=None, **kwargs):
         self._vis_iters += 1
-        visualizations = {}
+        self.eval()
+        tasks = []
+
+        # the plots are made from numpy snapshots, so that they can be rendered in another process
 
-        # add reconstruction plot
+        # add reconstruction plot of the first few training and validation examples
         if val_loader is not None:
-            fig, _ = vis.reconstruction_plot(self, train_loader.dataset, val_loader.dataset)
-            visualizations['reconstruction'] = fig
+            n_samples = 5
+            samples = torch.stack([train_loader.dataset[i][0] for i in range(n_samples)] +
+                                  [val_loader.dataset[i][0] for i in range(n_samples)], dim=0)
+            x_rec = self.forward(inputs=[samples])['x_rec'].reshape(samples.shape)
+            samples = revert_normalization(samples, dataset=train_loader.dataset)
+            tasks.append(vis.FigureTask('reconstruction', vis.reconstruction_snapshot_plot,
+                                        samples=utils.to_numpy(samples), x_rec=utils.to_numpy(x_rec)))
 
         # add manifold plot
-        fig, _ = vis.manifold_plot(self, example_shape=self.input_shape[1:],
-                                   low=-3, high=+3, n_points=10)
-        visualizations['manifold'] = fig
+        tasks.append(vis.FigureTask('manifold', vis.manifold_snapshot_plot,
+                                    decoded=self.decode_grid(low=-3, high=+3, n_points=10)))
 
-        # scatter plot
         if val_loader is not None:
-            fig, _ = vis.latent_scatter(self, val_loader)
-            visualizations['scatter'] = fig
-
-        # latent space T-SNE plot, plotted less often since it is slower
-        if (val_loader is not None) and self._vis_iters % 5 == 0:
-            fig, _ = vis.latent_space_tsne(self, val_loader)
-            visualizations['latent space T-SNE'] = fig
-
-        return visualizations
+            # latent codes of the validation set
+            z = utils.apply_on_dataset(model=self, dataset=val_loader.dataset, output_keys_regexp='^z$',
+                                       description='latent:z')['z']
+            z = utils.to_numpy(z)
+            labels = get_labels(val_loader.dataset)
+
+            # scatter plot
+            tasks.append(vis.FigureTask('scatter', vis.latent_scatter_snapshot_plot, z=z, labels=labels))
+
+            # latent space T-SNE plot of a fixed stratified subsample of the validation set, initialized with
+            # the previous embedding
+            indices = vis.stratified_subsample(labels, n=self.latent_embedding_size)
+            tasks.append(vis.FigureTask('latent space T-SNE', vis.latent_embedding_plot, z=z[indices],
+                                        labels=labels[indices],
+                                        key=tensorboard.get_logdir() if tensorboard is not None else None,
+                                        time_budget=self.latent_embedding_time_budget))
+
+        return vis.render_tasks(tasks, tensorboard=tensorboard, epoch=epoch)
@@ -0,0 +1,181 @@
+""" Asynchronous successive halving (ASHA) for hyperparameter grids.
+
+Runs of a grid report their best validation accuracy so far when they reach a rung, i.e. after
+min_epochs * eta^k epochs, to a coordinator stored in a local sqlite file. Runs that differ only in the
+hyperparameters of result_utils.hparam_columns and in the seed compete in one bracket; this is the group
+in which do_model_selection_by_val_score picks the winner. A configuration is scored at a rung by the
+mean over its seeds that reached the rung.
+
+A run is stopped at a rung only if at least eta configurations of its bracket reached the rung and its
+configuration is not among the top 1/eta of them, so the runs that can still win are never stopped.
+Stopped runs keep their best checkpoint and are tested as usual, so they stay in the result tables.
+"""
+import os
+import json
+import math
+import sqlite3
+import hashlib
+import time
+
+import numpy as np
+
+from modules import registry
+from modules.result_utils import hparam_columns
+
+
+def _hash(d):
+    return hashlib.sha256(json.dumps(d, sort_keys=True, default=str).encode('utf-8')).hexdigest()[:16]
+
+
+def get_bracket_key(args):
+    """ Runs with the same bracket key differ only in hyperparameters and seed. """
+    excluded = set(registry.ignored_args) | set(hparam_columns) | {'seed'}
+    return _hash({k: v for k, v in vars(args).items() if k not in excluded})
+
+
+def get_config_key(args):
+    """ Runs with the same config key differ only in seed. """
+    excluded = set(registry.ignored_args) | {'seed'}
+    return _hash({k: v for k, v in vars(args).items() if k not in excluded})
+
+
+def get_rungs(min_epochs, eta, max_epochs):
+    """ Numbers of finished epochs at which runs report, min_epochs * eta^k <= max_epochs. """
+    rungs = []
+    r = min_epochs
+    while r <= max_epochs:
+        rungs.append(r)
+        r *= eta
+    return rungs
+
+
+def is_dominated(score, peer_scores, eta, margin=0.0):
+    """ Whether a configuration with `score` should be stopped, given the scores of all configurations
+    of the bracket that reached the rung (including itself).
+    """
+    if len(peer_scores) < eta:
+        return False
+    n_top = max(1, int(math.ceil(len(peer_scores) / eta)))
+    threshold = sorted(peer_scores, reverse=True)[n_top - 1]
+    return score < threshold - margin
+
+
+class ASHACoordinator(object):
+    def __init__(self, path, min_epochs=10, eta=3, margin=0.0):
+        self.path = path
+        self.min_epochs = min_epochs
+        self.eta = eta
+        self.margin = margin
+        dir_name = os.path.dirname(path)
+        if dir_name != '':
+            os.makedirs(dir_name, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS reports (
+                    bracket TEXT,
+                    config TEXT,
+                    seed INTEGER,
+                    rung INTEGER,
+                    value REAL,
+                    log_dir TEXT,
+                    time REAL,
+                    PRIMARY KEY (bracket, config, seed, rung)
+                )""")
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=60)
+
+    def report(self, bracket, config, seed, rung, value, log_dir=None):
+        with self._connect() as conn:
+            conn.execute("INSERT OR REPLACE INTO reports VALUES (?, ?, ?, ?, ?, ?, ?)",
+                         (bracket, config, seed, rung, float(value), log_dir, time.time()))
+
+    def get_rung_scores(self, bracket, rung):
+        """ Returns config -> mean value over the seeds that reached the rung. """
+        with self._connect() as conn:
+            rows = conn.execute("SELECT config, AVG(value) FROM reports WHERE bracket = ? AND rung = ? "
+                                "GROUP BY config", (bracket, rung)).fetchall()
+        return dict(rows)
+
+    def should_stop(self, bracket, config, rung):
+        scores = self.get_rung_scores(bracket, rung)
+        if config not in scores:
+            return False
+        return is_dominated(scores[config], list(scores.values()), eta=self.eta, margin=self.margin)
+
+
+class ASHAStopper(object):
+    """ Wraps a stopper (e.g. callbacks.EarlyStoppingWithMetric) and additionally stops the run when it is
+    dominated at a rung. Reported values are the best values of the metric so far, as the model selection
+    uses the best validation accuracy of each run.
+    """
+    def __init__(self, stopper, metric, coordinator, args, max_epochs, partition='val', direction='max'):
+        self.stopper = stopper
+        self.metric = metric
+        self.coordinator = coordinator
+        self.partition = partition
+        self.direction = direction
+        self.log_dir = args.log_dir
+        self.seed = args.seed
+        self.bracket = get_bracket_key(args)
+        self.config = get_config_key(args)
+        self.rungs = get_rungs(coordinator.min_epochs, coordinator.eta, max_epochs)
+        self.best_value = None
+        self._n_reported = 0
+        self._stopped_at = None
+
+    def call(self, epoch, *args, **kwargs):
+        plateaued = self.stopper.call(epoch, *args, **kwargs)
+
+        value = self.metric.value(epoch=epoch, partition=self.partition)
+        if self.direction == 'min':
+            value = -value
+        if self.best_value is None or value > self.best_value:
+            self.best_value = value
+
+        # rungs are reported at the first call after reaching them, as the validation metric might not be
+        # computed every epoch (see modules/validation.py)
+        n_epochs = epoch + 1
+        while self._n_reported < len(self.rungs) and n_epochs >= self.rungs[self._n_reported]:
+            rung = self.rungs[self._n_reported]
+            self._n_reported += 1
+            self.coordinator.report(self.bracket, self.config, self.seed, rung, self.best_value, self.log_dir)
+            if self._stopped_at is None and self.coordinator.should_stop(self.bracket, self.config, rung):
+                self._stopped_at = rung
+                print("ASHA: stopping the run at rung {} (best value {:.4f})".format(rung, self.best_value))
+                if self.log_dir is not None:
+                    with open(os.path.join(self.log_dir, 'asha_stopped.txt'), 'w') as f:
+                        f.write("{}\n".format(rung))
+        return bool(plateaued) or self.should_stop()
+
+    def should_stop(self):
+        stopper_should_stop = getattr(self.stopper, 'should_stop', None)
+        if callable(stopper_should_stop) and stopper_should_stop():
+            return True
+        return self._stopped_at is not None
+
+
+def simulate(curves, min_epochs=10, eta=3, margin=0.0):
+    """ Replays ASHA on historical validation curves, in the worst case order where all runs of a rung
+    report before any decision is made, which is the order that stops the most runs.
+    :param curves: dict run -> (bracket, config, seed, array of validation accuracies per epoch).
+    Returns dict run -> number of epochs the run would have trained.
+    """
+    n_epochs = {run: len(c[3]) for run, c in curves.items()}
+    alive = set(curves.keys())
+    max_epochs = max(n_epochs.values()) if len(n_epochs) > 0 else 0
+    for rung in get_rungs(min_epochs, eta, max_epochs):
+        reached = [run for run in alive if n_epochs[run] >= rung]
+        scores = {}
+        for run in reached:
+            bracket, config, seed, values = curves[run]
+            best = float(np.max(values[:rung]))
+            scores.setdefault((bracket, config), []).append(best)
+        scores = {k: float(np.mean(v)) for k, v in scores.items()}
+        for run in reached:
+            bracket, config = curves[run][0], curves[run][1]
+            peers = [s for (b, _), s in scores.items() if b == bracket]
+            if is_dominated(scores[(bracket, config)], peers, eta=eta, margin=margin):
+                n_epochs[run] = rung
+                alive.discard(run)
+    return n_epochs
@@ -0,0 +1,109 @@
+""" Asynchronous rendering of visualizations.
+
+When enabled, methods hand snapshots of the data to plot (see FigureTask and HistogramTask in
+modules/visualization.py) to a separate process, which renders the figures and writes them to
+tensorboard. The queue between the training process and the renderer is bounded. When it is full,
+the oldest pending snapshot is dropped, so that the training loop never waits on plotting.
+"""
+import atexit
+import multiprocessing
+import queue
+
+
+_enabled = False
+_max_queue_size = 2
+_renderers = {}
+
+
+def enable(max_queue_size=2):
+    global _enabled, _max_queue_size
+    _enabled = True
+    _max_queue_size = max_queue_size
+
+
+def disable(timeout=600):
+    """ Renders the pending visualizations and switches back to rendering in the training process. Training
+    scripts call it at the end of run(), so that later runs in the same process (scripts/sweep.py) are not
+    affected.
+    """
+    global _enabled
+    close_all(timeout=timeout)
+    _enabled = False
+
+
+def is_enabled():
+    return _enabled
+
+
+def get_renderer(log_dir):
+    """ Returns the renderer process of the given log directory, starting it if needed. """
+    if log_dir not in _renderers:
+        _renderers[log_dir] = AsyncRenderer(log_dir, max_queue_size=_max_queue_size)
+    return _renderers[log_dir]
+
+
+def close_all(timeout=600):
+    """ Waits until all pending visualizations are rendered. """
+    for renderer in _renderers.values():
+        renderer.close(timeout=timeout)
+    _renderers.clear()
+
+
+atexit.register(close_all)
+
+
+def _render_loop(log_dir, task_queue):
+    import matplotlib
+    matplotlib.use('agg')
+    from torch.utils.tensorboard import SummaryWriter
+
+    # a separate event file in the same directory, so that tensorboard shows everything together
+    tensorboard = SummaryWriter(log_dir, filename_suffix='.vis')
+    while True:
+        item = task_queue.get()
+        if item is None:
+            break
+        epoch, tasks = item
+        for task in tasks:
+            try:
+                task.render(tensorboard, epoch)
+            except Exception as e:
+                print("Failed to render {} at epoch {}: {}".format(task.tag, epoch, e))
+        tensorboard.flush()
+    tensorboard.close()
+
+
+class AsyncRenderer(object):
+    def __init__(self, log_dir, max_queue_size=2):
+        self.log_dir = log_dir
+        self.n_dropped = 0
+        context = multiprocessing.get_context('spawn')
+        self._queue = context.Queue(maxsize=max_queue_size)
+        self._process = context.Process(target=_render_loop, args=(log_dir, self._queue), daemon=True)
+        self._process.start()
+
+    def submit(self, tasks, epoch):
+        """ Adds a snapshot to the queue without blocking. Drops the oldest pending snapshot if needed. """
+        item = (epoch, tasks)
+        while True:
+            try:
+                self._queue.put_nowait(item)
+                return
+            except queue.Full:
+                try:
+                    self._queue.get_nowait()
+                    self.n_dropped += 1
+                    print("Visualization queue is full, dropped the oldest snapshot ({} dropped so far)".format(
+                        self.n_dropped))
+                except queue.Empty:
+                    pass
+
+    def close(self, timeout=600):
+        if not self._process.is_alive():
+            return
+        try:
+            self._queue.put(None, timeout=timeout)
+        except queue.Full:
+            print("Visualization renderer of {} is not responding, terminating it".format(self.log_dir))
+            self._process.terminate()
+        self._process.join(timeout=timeout)
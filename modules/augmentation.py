@@ -0,0 +1,134 @@
+""" Data augmentation on whole batches.
+
+Instead of transforming every example with PIL/torchvision transforms in the data loader workers, random
+crops with padding and horizontal flips are applied to collated batches of shape (B, C, H, W) with one
+indexing operation. Batches can be uint8 (e.g. raw images of a CachedDataset, dequantized after the
+augmentation) or float. Random decisions are drawn from a generator seeded once, so the augmentation
+is deterministic given the seed and the order of batches.
+"""
+import torch
+import torch.nn.functional as F
+
+from modules import data_utils
+
+
+def find_normalization(dataset):
+    """ Returns (mean, std) of the first torchvision Normalize transform of the dataset (looking into
+    wrapped datasets and composed transforms), or None if the dataset is not normalized.
+    """
+    objects = [dataset]
+    seen = set()
+    while len(objects) > 0:
+        obj = objects.pop(0)
+        if obj is None or id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        if type(obj).__name__ == 'Normalize' and hasattr(obj, 'mean') and hasattr(obj, 'std'):
+            return obj.mean, obj.std
+        for name in ['dataset', 'transform', 'transforms']:
+            value = getattr(obj, name, None)
+            objects.extend(value if isinstance(value, (list, tuple)) else [value])
+    return None
+
+
+def normalized_zero(dataset):
+    """ Per-channel value of a black pixel after the normalization of the dataset, -mean / std. This is
+    the padding value of torchvision's RandomCrop(padding=4), which pads before normalizing.
+    """
+    normalization = find_normalization(dataset)
+    if normalization is None:
+        return 0.0
+    mean, std = normalization
+    return [-float(m) / float(s) for m, s in zip(mean, std)]
+
+
+class BatchAugmentation(object):
+    """ Random crop with zero padding (as torchvision.transforms.RandomCrop(size, padding)) followed by
+    an optional random horizontal flip.
+    :param fill: value of the padded pixels, a number or a list of per-channel values (e.g. the value of
+        black pixels of normalized images, see normalized_zero).
+    """
+    def __init__(self, padding=4, flip=True, seed=42, fill=0):
+        self.padding = padding
+        self.flip = flip
+        self.fill = fill
+        self.generator = torch.Generator()
+        self.generator.manual_seed(seed)
+
+    def __call__(self, x):
+        B, C, H, W = x.shape
+        p = self.padding
+        device = x.device
+
+        if isinstance(self.fill, (list, tuple)):
+            fill = torch.tensor(self.fill, dtype=x.dtype, device=device).view(1, C, 1, 1)
+            padded = F.pad(x - fill, (p, p, p, p)) + fill
+        else:
+            padded = F.pad(x, (p, p, p, p), value=self.fill)
+
+        dy = torch.randint(0, 2 * p + 1, (B,), generator=self.generator).to(device)
+        dx = torch.randint(0, 2 * p + 1, (B,), generator=self.generator).to(device)
+        rows = dy.view(B, 1) + torch.arange(H, device=device).view(1, H)  # (B, H)
+        cols = dx.view(B, 1) + torch.arange(W, device=device).view(1, W)  # (B, W)
+        if self.flip:
+            do_flip = (torch.rand(B, generator=self.generator) < 0.5).to(device)
+            cols = torch.where(do_flip.view(B, 1), cols.flip(dims=[1]), cols)
+
+        b_idx = torch.arange(B, device=device).view(B, 1, 1, 1)
+        c_idx = torch.arange(C, device=device).view(1, C, 1, 1)
+        return padded[b_idx, c_idx, rows.view(B, 1, H, 1), cols.view(B, 1, 1, W)]
+
+
+def get_batch_augmentation(dataset_name, seed, fill=0):
+    """ Augmentation used with the -A flag. Digits are not flipped. """
+    flip = (dataset_name is None) or ('mnist' not in dataset_name)
+    return BatchAugmentation(padding=4, flip=flip, seed=seed, fill=fill)
+
+
+class DequantizedDataset(torch.utils.data.Dataset):
+    """ View of a dataset of uint8 images (e.g. a raw CachedDataset) that returns dequantized images.
+    Other attributes (dataset_name, labels, ...) are the ones of the wrapped dataset.
+    """
+    def __init__(self, dataset, dequantize):
+        self.dataset = dataset
+        self.dequantize = dequantize
+
+    def get_labels(self, indices):
+        return data_utils.get_labels(self.dataset, indices)
+
+    def __getitem__(self, idx):
+        x, y = self.dataset[idx]
+        return self.dequantize(x.unsqueeze(0))[0], y
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getattr__(self, item):
+        # not called for attributes set in __init__; guards against recursion while unpickling
+        if item == 'dataset':
+            raise AttributeError(item)
+        return getattr(self.dataset, item)
+
+
+class AugmentedLoader(object):
+    """ Wraps a data loader and applies a batch augmentation to the inputs of every batch.
+    If dequantize is given, it is applied after the augmentation (e.g. CachedDataset.dequantize). In that
+    case the raw uint8 dataset stays in `loader.dataset` and `dataset` is a DequantizedDataset view of it,
+    so that code running the model on `dataset` (e.g. visualizations) gets float images.
+    """
+    def __init__(self, loader, augmentation, dequantize=None):
+        self.loader = loader
+        self.augmentation = augmentation
+        self.dequantize = dequantize
+        self.dataset = loader.dataset if dequantize is None else DequantizedDataset(loader.dataset, dequantize)
+        self.batch_size = loader.batch_size
+
+    def __iter__(self):
+        for x, y in self.loader:
+            x = self.augmentation(x)
+            if self.dequantize is not None:
+                x = self.dequantize(x)
+            yield x, y
+
+    def __len__(self):
+        return len(self.loader)
@@ -2,6 +2,7 @@ import torch
 import numpy as np
 
 from nnlib.nnlib import utils
+from modules import inference
 import methods
 
 
@@ -11,9 +12,9 @@ def estimate_transition(load_from, data_loader, device='cpu', batch_size=256):
     """
     assert load_from is not None
     model = utils.load(load_from, methods=methods, device=device)
-    pred = utils.apply_on_dataset(model=model, dataset=data_loader.dataset,
-                                  batch_size=batch_size, cpu=True, description="Estimating transition matrix",
-                                  output_keys_regexp='pred')['pred']
+    pred = inference.apply_on_dataset(model=model, dataset=data_loader.dataset,
+                                      batch_size=batch_size, cpu=True, description="Estimating transition matrix",
+                                      output_keys_regexp='pred')['pred']
     pred = torch.softmax(pred, dim=1)
     pred = utils.to_numpy(pred)
 
@@ -0,0 +1,186 @@
+""" Asynchronous checkpointing.
+
+Saving a model with utils.save pickles it on the training thread. Here the training thread only copies
+the state dict of the model to CPU memory. A background thread loads the copy into a CPU replica of the
+model, serializes it with utils.save to a temporary file, fsyncs it and renames it to the final path, so
+a checkpoint file is either complete or absent. Only the last `keep_last` periodic checkpoints are kept,
+including the ones left in the directory by an earlier (e.g. resumed) run. The best checkpoint is stored
+separately and never removed.
+"""
+import os
+import copy
+import queue
+import threading
+
+import torch
+
+from nnlib.nnlib import utils
+
+
+def get_cpu_state(model):
+    """ Copy of the state dict of the model in CPU memory. """
+    return {k: v.detach().to('cpu', copy=True) for k, v in model.state_dict().items()}
+
+
+def _fsync_dir(dir_path):
+    try:
+        fd = os.open(dir_path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def _fsync_file_and_replace(tmp_path, path):
+    with open(tmp_path, 'rb') as f:
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    _fsync_dir(os.path.dirname(path))
+
+
+def atomic_torch_save(obj, path):
+    """ torch.save that leaves either the complete file or no file at path. """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + '.tmp'
+    torch.save(obj, tmp_path)
+    _fsync_file_and_replace(tmp_path, path)
+
+
+def list_periodic_checkpoints(checkpoint_dir):
+    """ File names of the epoch{epoch}.mdl checkpoints in the directory, sorted by epoch. """
+    epochs = []
+    for file_name in os.listdir(checkpoint_dir):
+        epoch = file_name[len('epoch'):-len('.mdl')]
+        if file_name.startswith('epoch') and file_name.endswith('.mdl') and epoch.isdigit():
+            epochs.append(int(epoch))
+    return ['epoch{}.mdl'.format(epoch) for epoch in sorted(epochs)]
+
+
+class AsyncCheckpointWriter(object):
+    """ Writes checkpoints of a model in a background thread.
+    :param checkpoint_dir: directory of the checkpoints (log_dir/checkpoints).
+    :param keep_last: number of periodic checkpoints to keep, None keeps all of them.
+    :param max_pending: maximum number of snapshots waiting to be written. When reached, save() waits,
+        so that snapshots do not pile up in memory.
+    """
+    def __init__(self, model, checkpoint_dir, keep_last=None, max_pending=2):
+        self.checkpoint_dir = checkpoint_dir
+        self.keep_last = keep_last
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        # the replica is created here, on the training thread, and used only by the writer thread afterwards
+        self._replica = copy.deepcopy(model).to('cpu')
+        self._periodic = list_periodic_checkpoints(checkpoint_dir)
+        self._error = None
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._thread = threading.Thread(target=self._write_loop, daemon=True)
+        self._thread.start()
+
+    def save(self, file_name, state=None, model=None, periodic=False):
+        """ Schedules writing a checkpoint. Either state (from get_cpu_state) or model should be given. """
+        self._raise_error()
+        if state is None:
+            state = get_cpu_state(model)
+        self._queue.put((file_name, state, periodic))
+
+    def close(self):
+        """ Waits until all scheduled checkpoints are written. """
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        self._raise_error()
+
+    def _raise_error(self):
+        if self._error is not None:
+            raise RuntimeError("Writing a checkpoint failed") from self._error
+
+    def _write_loop(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            if self._error is not None:
+                continue
+            file_name, state, periodic = item
+            try:
+                self._write(file_name, state)
+                if periodic:
+                    self._prune(file_name)
+            except Exception as e:
+                print("Could not write checkpoint {}: {}".format(file_name, e))
+                self._error = e
+
+    def _write(self, file_name, state):
+        path = os.path.join(self.checkpoint_dir, file_name)
+        tmp_path = path + '.tmp'
+        self._replica.load_state_dict(state)
+        utils.save(self._replica, tmp_path)
+        _fsync_file_and_replace(tmp_path, path)
+
+    def _prune(self, file_name):
+        if file_name in self._periodic:
+            self._periodic.remove(file_name)
+        self._periodic.append(file_name)
+        if self.keep_last is None:
+            return
+        while len(self._periodic) > self.keep_last:
+            old_path = os.path.join(self.checkpoint_dir, self._periodic.pop(0))
+            if os.path.exists(old_path):
+                os.remove(old_path)
+
+
+class AsyncSaveBestWithMetric(object):
+    """ Same as callbacks.SaveBestWithMetric, but the checkpoint is written by an AsyncCheckpointWriter.
+    The best state is also kept in memory (best_state), so that it can be tested without reading it back.
+    """
+    def __init__(self, writer, metric, partition='val', direction='max', file_name='best_val.mdl', log_dir=None):
+        assert direction in ['min', 'max']
+        self.writer = writer
+        self.metric = metric
+        self.partition = partition
+        self.direction = direction
+        self.file_name = file_name
+        self.log_dir = log_dir
+        self.best_value = None
+        self.best_epoch = None
+        self.best_state = None
+
+    def call(self, epoch, model, log_dir=None, **kwargs):
+        value = self.metric.value(epoch=epoch, partition=self.partition)
+        improved = (self.best_value is None or
+                    (self.direction == 'max' and value > self.best_value) or
+                    (self.direction == 'min' and value < self.best_value))
+        if improved:
+            self.best_value = value
+            self.best_epoch = epoch
+            self.best_state = get_cpu_state(model)
+            self.writer.save(self.file_name, state=self.best_state)
+            log_dir = self.log_dir or log_dir
+            if log_dir is not None:
+                with open(os.path.join(log_dir, 'best_{}_result.txt'.format(self.partition)), 'w') as f:
+                    f.write("{}\n".format(value))
+        return False
+
+    def load_best(self, model):
+        """ Loads the best state into the model. """
+        assert self.best_state is not None, 'no state was saved'
+        model.load_state_dict(self.best_state)
+        return model
+
+
+class AsyncSaveEvery(object):
+    """ Schedules a checkpoint epoch{epoch}.mdl every save_iter epochs. Old ones are removed by the writer. """
+    # does not read the validation metrics, so modules/training.train calls it after every epoch
+    every_epoch = True
+
+    def __init__(self, writer, save_iter):
+        self.writer = writer
+        self.save_iter = save_iter
+
+    def call(self, epoch, model, **kwargs):
+        if (epoch + 1) % self.save_iter == 0:
+            self.writer.save('epoch{}.mdl'.format(epoch), model=model, periodic=True)
+        return False
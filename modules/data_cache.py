@@ -0,0 +1,238 @@
+""" Cache of preprocessed datasets in memory-mapped files.
+
+Each variant of a dataset, identified by (dataset, error_prob, seed, num_train_examples, clean_validation),
+is built once with load_data_from_arguments and stored as uint8 images plus an int64 label array per split.
+The noisy labels of uniform-noise-* and pair-noise-* datasets are stored as they are, so they are not
+generated again. The files are opened with mmap, so that jobs on the same node share one copy of the data
+through the page cache.
+
+Images are stored with a per-channel affine quantization, x = offset[c] + scale[c] * q, where q is uint8 and
+offset[c], scale[c] come from the range of channel c in the split. The error is at most scale[c] / 2. For datasets
+that are normalized per channel (ToTensor followed by Normalize), the quantization is lossless up to float rounding
+only if the uint8 values of every channel span 0..255 in the split; otherwise the quantization levels do not line
+up with the original pixel levels.
+
+The cache stores images without augmentation. Runs with data augmentation use it only together with
+batch augmentation (see modules/augmentation.py), which is applied on raw uint8 batches before they are
+dequantized.
+"""
+import os
+import json
+import copy
+import fcntl
+import shutil
+import tempfile
+
+import numpy as np
+import torch
+from tqdm import tqdm
+
+from modules import augmentation, data_utils, shards
+
+
+splits = ['train', 'val', 'test']
+
+
+def get_cache_name(args):
+    return "{}-error_prob{}-seed{}-num_train_examples{}-clean_validation{}".format(
+        args.dataset, args.error_prob, args.seed, args.num_train_examples, args.clean_validation)
+
+
+def _write_split(dataset, split_dir, batch_size=1024, num_workers=4):
+    """ Quantizes the examples of the dataset and writes them with the labels to split_dir. """
+    os.makedirs(split_dir)
+    loader = torch.utils.data.DataLoader(dataset, batch_size=batch_size, shuffle=False, num_workers=num_workers)
+
+    # the first pass finds the range of every channel
+    x_min = None
+    x_max = None
+    labels = []
+    for x, y in tqdm(loader, desc='Caching {} (pass 1/2)'.format(os.path.basename(split_dir))):
+        x = x.float().transpose(0, 1).flatten(start_dim=1)  # (C, batch_size * H * W)
+        batch_min = x.min(dim=1).values
+        batch_max = x.max(dim=1).values
+        x_min = batch_min if x_min is None else torch.min(x_min, batch_min)
+        x_max = batch_max if x_max is None else torch.max(x_max, batch_max)
+        labels.append(y.numpy().astype(np.int64))
+    labels = np.concatenate(labels)
+    offset = x_min.numpy().astype(np.float64)
+    scale = np.maximum((x_max - x_min).numpy().astype(np.float64) / 255.0, 1e-12)
+
+    shape = (len(dataset),) + tuple(dataset[0][0].shape)
+    images = np.lib.format.open_memmap(os.path.join(split_dir, 'images.npy'), mode='w+', dtype=np.uint8,
+                                       shape=shape)
+    start = 0
+    c_shape = [1, -1] + [1] * (len(shape) - 2)
+    for x, _ in tqdm(loader, desc='Caching {} (pass 2/2)'.format(os.path.basename(split_dir))):
+        q = (x.double().numpy() - offset.reshape(c_shape)) / scale.reshape(c_shape)
+        images[start:start + len(x)] = np.clip(np.round(q), 0, 255).astype(np.uint8)
+        start += len(x)
+    images.flush()
+    del images
+
+    np.save(os.path.join(split_dir, 'labels.npy'), labels)
+    with open(os.path.join(split_dir, 'meta.json'), 'w') as f:
+        json.dump({
+            'offset': offset.tolist(),
+            'scale': scale.tolist(),
+            'shape': list(shape),
+            'dataset_name': getattr(dataset, 'dataset_name', None),
+        }, f)
+
+
+def build_cache(args, cache_root, num_workers=4):
+    """ Builds the cache of the variant described by args, unless it exists. Concurrent jobs wait for
+    the one that builds it. Returns the directory of the variant.
+    :param num_workers: number of data loader workers that read the examples while building.
+    """
+    from nnlib.nnlib.data_utils.base import load_data_from_arguments
+
+    cache_dir = os.path.join(cache_root, get_cache_name(args))
+    if os.path.exists(os.path.join(cache_dir, 'done')):
+        return cache_dir
+    os.makedirs(cache_root, exist_ok=True)
+    with open(cache_dir + '.lock', 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        if os.path.exists(os.path.join(cache_dir, 'done')):  # built by another job while we waited
+            return cache_dir
+
+        print("Building the dataset cache {}".format(cache_dir))
+        data_args = copy.copy(args)
+        data_args.data_augmentation = False
+        loaders = load_data_from_arguments(data_args)[:3]
+
+        # write to a temporary directory and move it in place at the end, so a crashed build leaves no cache
+        tmp_dir = tempfile.mkdtemp(prefix='.tmp-', dir=cache_root)
+        try:
+            for split, loader in zip(splits, loaders):
+                if loader is not None:
+                    _write_split(loader.dataset, os.path.join(tmp_dir, split), num_workers=num_workers)
+            open(os.path.join(tmp_dir, 'done'), 'w').close()
+            if os.path.exists(cache_dir):
+                shutil.rmtree(cache_dir)
+            os.rename(tmp_dir, cache_dir)
+        finally:
+            if os.path.exists(tmp_dir):
+                shutil.rmtree(tmp_dir)
+    return cache_dir
+
+
+class CachedDataset(torch.utils.data.Dataset):
+    """ A split of a cached dataset. Examples are dequantized to float tensors, unless raw=True, in which
+    case uint8 tensors are returned and dequantize() should be applied on batches (e.g. on the GPU).
+    """
+    def __init__(self, split_dir, raw=False):
+        self.split_dir = split_dir
+        self.raw = raw
+        with open(os.path.join(split_dir, 'meta.json'), 'r') as f:
+            meta = json.load(f)
+        self.dataset_name = meta['dataset_name']
+        self.images = np.load(os.path.join(split_dir, 'images.npy'), mmap_mode='r')
+        self.labels = np.load(os.path.join(split_dir, 'labels.npy'))
+        c_shape = [-1] + [1] * (len(meta['shape']) - 2)
+        self.offset = torch.tensor(meta['offset'], dtype=torch.float).view(c_shape)
+        self.scale = torch.tensor(meta['scale'], dtype=torch.float).view(c_shape)
+
+    def dequantize(self, x):
+        """ Converts uint8 images of shape (..., C, H, W) to float images. """
+        offset = self.offset.to(x.device)
+        scale = self.scale.to(x.device)
+        return x.float() * scale + offset
+
+    def get_labels(self, indices):
+        return self.labels[indices]
+
+    def __getitem__(self, idx):
+        x = torch.from_numpy(np.array(self.images[idx]))
+        if not self.raw:
+            x = self.dequantize(x)
+        return x, int(self.labels[idx])
+
+    def __len__(self):
+        return len(self.labels)
+
+
+def load_data_from_cache(args, cache_root, num_workers=0, raw_train=False, build_num_workers=4):
+    """ Same as load_data_from_arguments, but reads the data from the cache (building it if needed).
+    If raw_train is True, the training set returns uint8 images.
+    The last returned value (additional information returned by nnlib) is None.
+    :param num_workers: number of data loader workers of the returned loaders.
+    :param build_num_workers: number of data loader workers used if the cache has to be built (see build_cache).
+    """
+    cache_dir = build_cache(args, cache_root, num_workers=build_num_workers)
+    loaders = []
+    for split in splits:
+        split_dir = os.path.join(cache_dir, split)
+        if not os.path.exists(split_dir):
+            loaders.append(None)
+            continue
+        dataset = CachedDataset(split_dir, raw=(raw_train and split == 'train'))
+        loaders.append(torch.utils.data.DataLoader(dataset, batch_size=args.batch_size,
+                                                   shuffle=(split == 'train'), num_workers=num_workers))
+    return loaders[0], loaders[1], loaders[2], None
+
+
+def load_data(args):
+    """ Loads the data of a training script, using the cache given by args.data_cache when possible.
+    With --batch_augmentation, the -A augmentation is applied on whole batches after collation instead of
+    per example. With --tensor_loader, splits are kept in memory as tensors (see data_utils.TensorLoader).
+    """
+    train_loader, val_loader, test_loader, info = _load_loaders(args)
+    if not getattr(args, 'tensor_loader', False):
+        return train_loader, val_loader, test_loader, info
+
+    if isinstance(train_loader, augmentation.AugmentedLoader):
+        train_loader = augmentation.AugmentedLoader(data_utils.to_tensor_loader(train_loader.loader, seed=args.seed),
+                                                    train_loader.augmentation, train_loader.dequantize)
+    elif not args.data_augmentation:
+        train_loader = data_utils.to_tensor_loader(train_loader, seed=args.seed)
+    else:
+        print("Per-example data augmentation is used, the training set is not converted to tensors. "
+              "Use --batch_augmentation to augment tensors.")
+    if val_loader is not None:
+        val_loader = data_utils.to_tensor_loader(val_loader)
+    if test_loader is not None:
+        test_loader = data_utils.to_tensor_loader(test_loader)
+    return train_loader, val_loader, test_loader, info
+
+
+def _load_loaders(args):
+    from nnlib.nnlib.data_utils.base import load_data_from_arguments
+
+    use_batch_augmentation = args.data_augmentation and getattr(args, 'batch_augmentation', False)
+    if getattr(args, 'packed_data', None) is not None:
+        # packed images are already cropped to the training resolution, -A is always applied on batches
+        train_loader, val_loader, test_loader, info = shards.load_packed_data(args, args.packed_data,
+                                                                              raw_train=args.data_augmentation)
+        if args.data_augmentation:
+            # the loader reads raw uint8 images, AugmentedLoader exposes a dequantizing view of them as .dataset
+            dataset = train_loader.dataset
+            if isinstance(dataset, torch.utils.data.Subset):
+                dataset = dataset.dataset
+            train_loader = augmentation.AugmentedLoader(
+                train_loader, augmentation.get_batch_augmentation(args.dataset, seed=args.seed, fill=0),
+                dequantize=dataset.dequantize)
+        return train_loader, val_loader, test_loader, info
+
+    if getattr(args, 'data_cache', None) is not None and (not args.data_augmentation or use_batch_augmentation):
+        train_loader, val_loader, test_loader, info = load_data_from_cache(args, args.data_cache,
+                                                                           raw_train=use_batch_augmentation)
+        if use_batch_augmentation:
+            # raw value 0 is the per-channel minimum, i.e. black pixels
+            train_loader = augmentation.AugmentedLoader(
+                train_loader,
+                augmentation.get_batch_augmentation(train_loader.dataset.dataset_name, seed=args.seed, fill=0),
+                dequantize=train_loader.dataset.dequantize)
+        return train_loader, val_loader, test_loader, info
+
+    if use_batch_augmentation:
+        data_args = copy.copy(args)
+        data_args.data_augmentation = False
+        train_loader, val_loader, test_loader, info = load_data_from_arguments(data_args)
+        dataset_name = getattr(train_loader.dataset, 'dataset_name', args.dataset)
+        fill = augmentation.normalized_zero(train_loader.dataset)
+        train_loader = augmentation.AugmentedLoader(
+            train_loader, augmentation.get_batch_augmentation(dataset_name, seed=args.seed, fill=fill))
+        return train_loader, val_loader, test_loader, info
+
+    return load_data_from_arguments(args)
@@ -0,0 +1,164 @@
+""" Tools for working with datasets.
+
+Bulk label access protocol: a dataset can expose its labels either through a `labels` array
+(indexed by example index) or through a `get_labels(indices)` method. For datasets that support
+neither (e.g. nnlib datasets), `get_labels` below falls back to reading `dataset[idx][1]`, but does
+this at most once per example and caches the result on the dataset object.
+"""
+import numpy as np
+import torch
+
+
+def _fast_labels(dataset):
+    """ Returns all labels of the dataset without decoding examples, when this is possible. """
+    labels = getattr(dataset, 'labels', None)
+    if labels is not None and not callable(labels):
+        return np.asarray(labels, dtype=np.int64)
+    if isinstance(dataset, torch.utils.data.Subset):
+        parent = _fast_labels(dataset.dataset)
+        if parent is not None:
+            return parent[np.asarray(dataset.indices, dtype=np.int64)]
+    # plain torchvision datasets keep their targets in memory. Subclasses (e.g. datasets with
+    # noisy labels) may override the labels in __getitem__, therefore only exact torchvision classes are trusted.
+    if (type(dataset).__module__.startswith('torchvision.') and hasattr(dataset, 'targets') and
+            getattr(dataset, 'target_transform', None) is None):
+        return np.asarray(dataset.targets, dtype=np.int64)
+    return None
+
+
+class _LabelCache(object):
+    """ Lazily filled array of labels. Only labels of the requested examples are read. """
+    def __init__(self, dataset):
+        self.dataset = dataset
+        self.labels = np.full(len(dataset), -1, dtype=np.int64)
+
+    def get(self, indices):
+        missing = indices[self.labels[indices] < 0]
+        for idx in np.unique(missing):
+            self.labels[idx] = int(self.dataset[idx][1])
+        return self.labels[indices]
+
+
+def get_labels(dataset, indices=None):
+    """ Returns labels of the given examples (all examples if `indices` is None) as an int64 numpy array. """
+    if indices is None:
+        indices = np.arange(len(dataset))
+    indices = np.asarray(indices, dtype=np.int64)
+
+    if hasattr(dataset, 'get_labels'):
+        return np.asarray(dataset.get_labels(indices), dtype=np.int64)
+
+    labels = _fast_labels(dataset)
+    if labels is not None:
+        return labels[indices]
+
+    cache = getattr(dataset, '_label_cache', None)
+    if cache is None:
+        cache = _LabelCache(dataset)
+        dataset._label_cache = cache
+    return cache.get(indices)
+
+
+def dataset_to_tensors(dataset, batch_size=1024, num_workers=4):
+    """ Returns (inputs, labels, transform): all examples of the dataset as contiguous tensors, and a function
+    that should be applied on batches of inputs (None if not needed). Labels are the ones returned by
+    the dataset, so noisy label overrides are kept.
+    """
+    # cached datasets (see modules/data_cache.py) keep uint8 images, which are dequantized per batch
+    if hasattr(dataset, 'images') and hasattr(dataset, 'dequantize'):
+        transform = None if dataset.raw else dataset.dequantize
+        return (torch.from_numpy(np.ascontiguousarray(dataset.images)),
+                torch.from_numpy(np.asarray(dataset.labels, dtype=np.int64)), transform)
+    if isinstance(dataset, torch.utils.data.Subset):
+        inputs, labels, transform = dataset_to_tensors(dataset.dataset, batch_size, num_workers)
+        indices = torch.as_tensor(dataset.indices, dtype=torch.long)
+        return inputs.index_select(0, indices), labels.index_select(0, indices), transform
+
+    loader = torch.utils.data.DataLoader(dataset, batch_size=batch_size, shuffle=False, num_workers=num_workers)
+    inputs = []
+    labels = []
+    for x, y in loader:
+        inputs.append(x)
+        labels.append(torch.as_tensor(y, dtype=torch.long))
+    return torch.cat(inputs).contiguous(), torch.cat(labels), None
+
+
+class InMemoryDataset(torch.utils.data.Dataset):
+    """ A dataset stored as contiguous tensors. Supports the bulk label access protocol and batched
+    fetching through __getitems__, which torch DataLoaders use instead of per-example __getitem__ calls.
+    """
+    def __init__(self, inputs, labels, transform=None, dataset_name=None):
+        self.inputs = inputs
+        self.label_tensor = labels
+        self.labels = labels.numpy()
+        self.transform = transform
+        self.dataset_name = dataset_name
+
+    def get_labels(self, indices):
+        return self.labels[indices]
+
+    def get_batch(self, indices):
+        """ Returns (inputs, labels) of the given examples, with one index_select per tensor. """
+        x = self.inputs.index_select(0, indices)
+        if self.transform is not None:
+            x = self.transform(x)
+        return x, self.label_tensor.index_select(0, indices)
+
+    def __getitems__(self, indices):
+        x, y = self.get_batch(torch.as_tensor(indices, dtype=torch.long))
+        return list(zip(x.unbind(0), y.unbind(0)))
+
+    def __getitem__(self, idx):
+        x = self.inputs[idx]
+        if self.transform is not None:
+            x = self.transform(x)
+        return x, int(self.label_tensor[idx])
+
+    def __len__(self):
+        return len(self.label_tensor)
+
+
+class TensorLoader(object):
+    """ Data loader for an InMemoryDataset. Each batch is built with one index_select from a permutation
+    of the examples, without per-example calls and collation.
+    """
+    def __init__(self, dataset, batch_size, shuffle=False, drop_last=False, seed=None):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.generator = torch.Generator()
+        if seed is not None:
+            self.generator.manual_seed(seed)
+        else:
+            self.generator.seed()
+
+    def __iter__(self):
+        n = len(self.dataset)
+        if self.shuffle:
+            order = torch.randperm(n, generator=self.generator)
+        else:
+            order = torch.arange(n)
+        for start in range(0, n, self.batch_size):
+            indices = order[start:start + self.batch_size]
+            if self.drop_last and len(indices) < self.batch_size:
+                break
+            yield self.dataset.get_batch(indices)
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.dataset) // self.batch_size
+        return (len(self.dataset) + self.batch_size - 1) // self.batch_size
+
+
+def to_tensor_loader(loader, seed=None):
+    """ Converts a torch DataLoader of an in-memory sized dataset (e.g. MNIST or CIFAR) to a TensorLoader
+    with the same batch size, shuffling and drop_last settings.
+    """
+    dataset = loader.dataset
+    inputs, labels, transform = dataset_to_tensors(dataset)
+    in_memory = InMemoryDataset(inputs, labels, transform=transform,
+                                dataset_name=getattr(dataset, 'dataset_name', None))
+    shuffle = isinstance(loader.sampler, torch.utils.data.RandomSampler)
+    return TensorLoader(in_memory, batch_size=loader.batch_size, shuffle=shuffle,
+                        drop_last=loader.drop_last, seed=seed)
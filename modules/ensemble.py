@@ -0,0 +1,106 @@
+""" Tools for evaluating an ensemble of same-architecture models (e.g. different seeds) in a single
+pass over the data. The parameters of the models are stacked and the forward pass is vectorized
+with torch.func.vmap, so that one batch of data is scored by all ensemble members at once.
+"""
+import copy
+
+import numpy as np
+import torch
+from torch.func import stack_module_state, functional_call, vmap
+from tqdm import tqdm
+
+
+class StackedEnsemble(object):
+    """ Holds stacked parameters and buffers of models that share the same architecture.
+    If the forward function of the models cannot be vectorized (e.g. it uses custom autograd
+    functions that do not support vmap), the models are applied one after another on each batch,
+    which still requires only one pass over the data.
+    """
+    def __init__(self, models, output_key='pred', vectorize=True):
+        assert len(models) > 0
+        names = [dict(m.named_parameters()).keys() for m in models]
+        assert all(n == names[0] for n in names), "all models should have the same architecture"
+
+        self.models = models
+        self.output_key = output_key
+        self.n_models = len(models)
+        self.vectorize = vectorize
+        for m in self.models:
+            m.eval()
+
+        if self.vectorize:
+            self.params, self.buffers = stack_module_state(models)
+            # a copy of the first model is used as the template for functional calls
+            self.base_model = copy.deepcopy(models[0])
+
+    def _forward_one(self, params, buffers, x):
+        out = functional_call(self.base_model, (params, buffers), args=(),
+                              kwargs={'inputs': [x], 'grad_enabled': False})
+        return out[self.output_key]
+
+    def __call__(self, x):
+        """ Returns a tensor of shape (n_models, batch_size, ...). """
+        if self.vectorize:
+            try:
+                with torch.no_grad():
+                    return vmap(self._forward_one, in_dims=(0, 0, None))(self.params, self.buffers, x)
+            except RuntimeError as e:
+                print("Could not vectorize the ensemble forward pass, falling back to a loop: {}".format(e))
+                self.vectorize = False
+        with torch.no_grad():
+            return torch.stack([m.forward(inputs=[x], grad_enabled=False)[self.output_key]
+                                for m in self.models], dim=0)
+
+
+def predict(ensemble, dataset, batch_size=256, num_workers=0, device='cpu', description='Ensemble predictions'):
+    """ Applies the ensemble on the dataset. Returns predictions of shape (n_models, n_samples, n_classes)
+    and labels of shape (n_samples,). Both are stored on CPU.
+    """
+    loader = torch.utils.data.DataLoader(dataset, batch_size=batch_size, shuffle=False, num_workers=num_workers)
+    preds = []
+    labels = []
+    for (batch_data, batch_labels) in tqdm(loader, desc=description):
+        x = batch_data.to(device)
+        preds.append(ensemble(x).cpu())
+        labels.append(batch_labels)
+    return torch.cat(preds, dim=1), torch.cat(labels, dim=0)
+
+
+def evaluate(preds, labels):
+    """ Computes per-model accuracies, the accuracy of averaged probabilities, and disagreement statistics.
+    :param preds: logits of shape (n_models, n_samples, n_classes).
+    :param labels: labels of shape (n_samples,).
+    """
+    probs = torch.softmax(preds, dim=-1)
+    hard = probs.argmax(dim=-1)  # (n_models, n_samples)
+    n_models = preds.shape[0]
+
+    per_model_accuracy = (hard == labels.unsqueeze(0)).float().mean(dim=1)
+    avg_probs = probs.mean(dim=0)
+    ensemble_accuracy = (avg_probs.argmax(dim=-1) == labels).float().mean()
+
+    # pairwise disagreement rates between ensemble members
+    pairwise = np.zeros((n_models, n_models))
+    for i in range(n_models):
+        for j in range(i + 1, n_models):
+            pairwise[i, j] = pairwise[j, i] = (hard[i] != hard[j]).float().mean().item()
+    n_pairs = n_models * (n_models - 1) / 2
+    mean_pairwise = pairwise.sum() / 2 / n_pairs if n_pairs > 0 else 0.0
+
+    # fraction of examples where not all members agree
+    any_disagreement = (hard != hard[:1]).any(dim=0).float().mean()
+
+    # entropy of the averaged predictive distribution
+    eps = 1e-12
+    entropy = -torch.sum(avg_probs * torch.log(avg_probs + eps), dim=-1).mean()
+
+    return {
+        'per_model_accuracy': per_model_accuracy.numpy(),
+        'mean_accuracy': per_model_accuracy.mean().item(),
+        'std_accuracy': per_model_accuracy.std().item() if n_models > 1 else 0.0,
+        'ensemble_accuracy': ensemble_accuracy.item(),
+        'pairwise_disagreement': pairwise,
+        'mean_pairwise_disagreement': mean_pairwise,
+        'any_disagreement': any_disagreement.item(),
+        'ensemble_entropy': entropy.item()
+    }
@@ -2,18 +2,29 @@ from tqdm import tqdm
 import numpy as np
 
 
-def compute_accuracy_with_bootstrapping(pred, target, n_iters=1000):
+def compute_accuracy_with_bootstrapping(pred, target=None, n_iters=1000):
     """ Expects numpy arrays. pred should have shape (n_samples, n_classes), while
-    target should have shape (n_samples,).
+    target should have shape (n_samples,). Alternatively, pred can be a PredictionReader
+    (see modules/prediction_io.py), in which case target defaults to the stored labels and
+    predictions are never loaded into memory at once.
     """
+    if target is None:
+        target = pred.labels
     assert pred.shape[0] == target.shape[0]
 
+    if isinstance(pred, np.ndarray):
+        correct = (pred.argmax(axis=1) == target)
+    elif target is pred.labels:
+        correct = pred.correct()
+    else:
+        # PredictionReader.argmax() returns the predicted class of every sample, reading one shard at a time
+        correct = (pred.argmax() == target)
+    correct = correct.astype(np.float)
+
     all_accuracies = []
     for _ in tqdm(range(n_iters), desc='bootstrapping') :
-        indices = np.random.choice(pred.shape[0], size=pred.shape[0], replace=True)
-        cur_pred = pred[indices]
-        cur_target = target[indices]
-        cur_accuracy = np.mean((cur_pred.argmax(axis=1) == cur_target).astype(np.float))
+        indices = np.random.choice(correct.shape[0], size=correct.shape[0], replace=True)
+        cur_accuracy = np.mean(correct[indices])
         all_accuracies.append(cur_accuracy)
 
     return {
@@ -0,0 +1,145 @@
+""" Inference-time optimization of the classifier networks.
+
+In eval mode BatchNorm is a fixed per-channel affine map. optimize_network() returns a copy of a network
+in which:
+    - in PreActBlocks (modules/resnet18_double_descent.py), bn2 is folded into the preceding conv1 and the
+      following ReLU is applied in place on its output. bn1 cannot be folded into a convolution, because
+      a ReLU separates it from conv1 and its input is also the identity shortcut, so it becomes a
+      precomputed scale and shift.
+    - in post-activation ResNet blocks (BasicBlock and Bottleneck of torchvision and nnlib) and in
+      nn.Sequential containers, every BatchNorm2d directly following a Conv2d is folded into it.
+    - optionally, weights and activations use the channels-last memory format, and the network is traced
+      and frozen with TorchScript.
+The optimized copy is meant for evaluation only: BatchNorm statistics are frozen and it should not be trained.
+optimized() temporarily replaces the networks of a method by their optimized copies.
+"""
+import copy
+from contextlib import contextmanager
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+
+from nnlib.nnlib import utils
+from modules.resnet18_double_descent import PreActBlock
+
+
+# blocks of the form conv_i -> bn_i -> (relu), where bn_i can be folded into conv_i
+post_activation_classes = ['BasicBlock', 'Bottleneck', 'ResNet']
+post_activation_pairs = [('conv1', 'bn1'), ('conv2', 'bn2'), ('conv3', 'bn3')]
+
+# networks of the methods that optimized() replaces
+network_names = ['classifier', 'q_network']
+
+
+def _batch_norm_affine(bn):
+    """ Returns (scale, shift) such that bn(x) = x * scale + shift in eval mode. """
+    scale = bn.weight / torch.sqrt(bn.running_var + bn.eps)
+    shift = bn.bias - bn.running_mean * scale
+    return scale.view(1, -1, 1, 1), shift.view(1, -1, 1, 1)
+
+
+class FusedPreActBlock(nn.Module):
+    """ Eval-mode equivalent of a PreActBlock with bn2 folded into conv1. """
+    def __init__(self, block):
+        super(FusedPreActBlock, self).__init__()
+        scale, shift = _batch_norm_affine(block.bn1)
+        self.register_buffer('scale', scale.detach().clone())
+        self.register_buffer('shift', shift.detach().clone())
+        self.conv1 = fuse_conv_bn_eval(block.conv1, block.bn2)
+        self.conv2 = block.conv2
+        self.has_shortcut = hasattr(block, 'shortcut')
+        self.shortcut = block.shortcut if self.has_shortcut else nn.Identity()
+
+    def forward(self, x):
+        out = F.relu(torch.addcmul(self.shift, x, self.scale))
+        shortcut = self.shortcut(out) if self.has_shortcut else x
+        out = F.relu(self.conv1(out), inplace=True)
+        out = self.conv2(out)
+        out += shortcut
+        return out
+
+
+def _fold_sequential(sequential):
+    children = list(sequential.children())
+    i = 0
+    while i + 1 < len(children):
+        if (isinstance(children[i], nn.Conv2d) and isinstance(children[i + 1], nn.BatchNorm2d) and
+                children[i].out_channels == children[i + 1].num_features):
+            sequential[i] = fuse_conv_bn_eval(children[i], children[i + 1])
+            sequential[i + 1] = nn.Identity()
+            i += 2
+        else:
+            i += 1
+
+
+def fold_batch_norms(net):
+    """ Folds the BatchNorm layers of an eval-mode network in place, see the module docstring. """
+    for name, child in list(net.named_children()):
+        if isinstance(child, PreActBlock):
+            setattr(net, name, FusedPreActBlock(child))
+        else:
+            fold_batch_norms(child)
+
+    if isinstance(net, nn.Sequential):
+        _fold_sequential(net)
+    if net.__class__.__name__ in post_activation_classes:
+        for conv_name, bn_name in post_activation_pairs:
+            conv = getattr(net, conv_name, None)
+            bn = getattr(net, bn_name, None)
+            if isinstance(conv, nn.Conv2d) and isinstance(bn, nn.BatchNorm2d):
+                setattr(net, conv_name, fuse_conv_bn_eval(conv, bn))
+                setattr(net, bn_name, nn.Identity())
+    return net
+
+
+class ChannelsLast(nn.Module):
+    """ Converts 4D inputs to the channels-last memory format before applying the network. """
+    def __init__(self, net):
+        super(ChannelsLast, self).__init__()
+        self.net = net.to(memory_format=torch.channels_last)
+
+    def forward(self, x):
+        if x.dim() == 4:
+            x = x.contiguous(memory_format=torch.channels_last)
+        return self.net(x)
+
+
+@torch.no_grad()
+def optimize_network(net, channels_last=True, jit=False, example_input=None):
+    """ Returns an optimized eval-mode copy of the network. With jit=True, example_input is needed for tracing. """
+    net = fold_batch_norms(copy.deepcopy(net).eval())
+    if channels_last:
+        net = ChannelsLast(net)
+    if jit:
+        assert example_input is not None, 'tracing needs an example input'
+        net = torch.jit.freeze(torch.jit.trace(net.eval(), example_input))
+    return net
+
+
+@contextmanager
+def optimized(model, channels_last=True, jit=False, example_input=None):
+    """ Temporarily replaces the networks of a method (classifier, q_network) by optimized copies. """
+    originals = {}
+    for name in network_names:
+        net = getattr(model, name, None)
+        if isinstance(net, nn.Module):
+            originals[name] = net
+    try:
+        for name, net in originals.items():
+            setattr(model, name, optimize_network(net, channels_last=channels_last, jit=jit,
+                                                  example_input=example_input))
+        yield model
+    finally:
+        for name, net in originals.items():
+            setattr(model, name, net)
+
+
+def apply_on_dataset(model, dataset, optimize=True, **kwargs):
+    """ utils.apply_on_dataset with the networks of the model optimized for inference. """
+    if not optimize:
+        return utils.apply_on_dataset(model=model, dataset=dataset, **kwargs)
+    model.eval()
+    with optimized(model):
+        return utils.apply_on_dataset(model=model, dataset=dataset, **kwargs)
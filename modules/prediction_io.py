@@ -0,0 +1,148 @@
+""" Streaming storage of model predictions.
+
+Predictions are written batch by batch into fixed-size shards of .npy files (float16 by default),
+together with a labels array and a small json index. The reader memory-maps the shards, so that
+accuracies and other statistics can be computed chunk by chunk without loading everything into RAM.
+"""
+import os
+import json
+from contextlib import nullcontext
+
+import numpy as np
+import torch
+from tqdm import tqdm
+
+from nnlib.nnlib import utils
+from modules import inference
+
+
+INDEX_FILE = 'index.json'
+LABELS_FILE = 'labels.npy'
+
+
+class PredictionWriter(object):
+    """ Accumulates predictions and flushes them to disk every `shard_size` examples. """
+    def __init__(self, output_dir, shard_size=8192, dtype='float16'):
+        self.output_dir = output_dir
+        self.shard_size = shard_size
+        self.dtype = np.dtype(dtype)
+        self._buffer = []
+        self._buffer_size = 0
+        self._labels = []
+        self._shards = []
+        self._n_classes = None
+        os.makedirs(output_dir, exist_ok=True)
+
+    def write(self, pred, labels):
+        """ Adds a batch of predictions of shape (batch_size, n_classes) and labels of shape (batch_size,). """
+        pred = utils.to_numpy(pred) if torch.is_tensor(pred) else np.asarray(pred)
+        labels = utils.to_numpy(labels) if torch.is_tensor(labels) else np.asarray(labels)
+        assert pred.shape[0] == labels.shape[0]
+        if self._n_classes is None:
+            self._n_classes = pred.shape[1]
+        assert pred.shape[1] == self._n_classes
+
+        self._labels.append(labels.astype(np.int64))
+        while pred.shape[0] > 0:
+            n = min(pred.shape[0], self.shard_size - self._buffer_size)
+            self._buffer.append(pred[:n].astype(self.dtype))
+            self._buffer_size += n
+            pred = pred[n:]
+            if self._buffer_size == self.shard_size:
+                self._flush()
+
+    def _flush(self):
+        if self._buffer_size == 0:
+            return
+        file_name = 'shard_{:05d}.npy'.format(len(self._shards))
+        np.save(os.path.join(self.output_dir, file_name), np.concatenate(self._buffer, axis=0))
+        self._shards.append({'file': file_name, 'n_samples': self._buffer_size})
+        self._buffer = []
+        self._buffer_size = 0
+
+    def close(self):
+        self._flush()
+        labels = np.concatenate(self._labels, axis=0) if len(self._labels) > 0 else np.zeros((0,), dtype=np.int64)
+        np.save(os.path.join(self.output_dir, LABELS_FILE), labels)
+        index = {
+            'shards': self._shards,
+            'n_samples': int(labels.shape[0]),
+            'n_classes': self._n_classes,
+            'dtype': self.dtype.name,
+            'labels': LABELS_FILE
+        }
+        # the index is written last, so that its presence indicates that the predictions are complete
+        with open(os.path.join(self.output_dir, INDEX_FILE), 'w') as f:
+            json.dump(index, f, indent=2)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+
+
+class PredictionReader(object):
+    """ Memory-mapped access to predictions written by PredictionWriter. """
+    def __init__(self, input_dir):
+        self.input_dir = input_dir
+        with open(os.path.join(input_dir, INDEX_FILE), 'r') as f:
+            self.index = json.load(f)
+        self.shards = [np.load(os.path.join(input_dir, s['file']), mmap_mode='r') for s in self.index['shards']]
+        self.labels = np.load(os.path.join(input_dir, self.index['labels']))
+        self.n_classes = self.index['n_classes']
+        self.offsets = np.cumsum([0] + [s.shape[0] for s in self.shards])
+        assert self.offsets[-1] == self.index['n_samples'] == self.labels.shape[0]
+
+    @property
+    def shape(self):
+        return len(self), self.n_classes
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def iter_chunks(self):
+        """ Yields (start_index, predictions) for each shard. Predictions are converted to float32. """
+        for start, shard in zip(self.offsets, self.shards):
+            yield int(start), np.asarray(shard, dtype=np.float32)
+
+    def __getitem__(self, indices):
+        """ Returns predictions of the given examples as a float32 array. """
+        indices = np.arange(len(self))[indices] if isinstance(indices, slice) else np.asarray(indices)
+        scalar = (indices.ndim == 0)
+        indices = np.atleast_1d(indices)
+        shard_ids = np.searchsorted(self.offsets, indices, side='right') - 1
+        result = np.zeros((indices.shape[0], self.n_classes), dtype=np.float32)
+        for shard_id in np.unique(shard_ids):
+            mask = (shard_ids == shard_id)
+            result[mask] = self.shards[shard_id][indices[mask] - self.offsets[shard_id]]
+        return result[0] if scalar else result
+
+    def argmax(self):
+        return np.concatenate([chunk.argmax(axis=1) for _, chunk in self.iter_chunks()], axis=0)
+
+    def correct(self):
+        """ Returns a boolean array indicating which examples are classified correctly. """
+        return self.argmax() == self.labels
+
+    def accuracy(self):
+        return float(np.mean(self.correct()))
+
+
+def write_predictions(model, dataset, output_dir, batch_size=256, output_key='pred', num_workers=0,
+                      shard_size=8192, dtype='float16', description='Testing', optimize=True):
+    """ Applies the model on the dataset and streams its predictions to `output_dir`.
+    If optimize=True, the networks of the model are optimized for inference (see modules/inference.py).
+    Returns a PredictionReader for the written predictions.
+    """
+    model.eval()
+    loader = torch.utils.data.DataLoader(dataset, batch_size=batch_size, shuffle=False, num_workers=num_workers)
+    with inference.optimized(model) if optimize else nullcontext(), \
+            PredictionWriter(output_dir, shard_size=shard_size, dtype=dtype) as writer:
+        for (batch_data, batch_labels) in tqdm(loader, desc=description):
+            if not isinstance(batch_data, list):
+                batch_data = [batch_data]
+            outputs = model.forward(inputs=batch_data, grad_enabled=False)
+            writer.write(outputs[output_key], batch_labels)
+    return PredictionReader(output_dir)
@@ -0,0 +1,278 @@
+""" Registry of experiments, stored in a local sqlite file.
+
+An experiment is identified by a hash of the parsed arguments of the training script (excluding
+arguments that do not change the result, like the log directory or the device), the contents of the
+architecture config file and the version of the code. The registry records the status of every
+experiment ('running', 'finished' or 'failed') along with its log directory and result files. Training
+scripts register themselves on start, so that finished or in-flight duplicates are not started again,
+and the command generators use the same keys to skip such experiments.
+
+While an experiment runs, a background thread refreshes its updated_at field every heartbeat_interval
+seconds. A 'running' entry of another host whose heartbeat is older than heartbeat_timeout is treated
+as dead (e.g. the job was preempted or killed), so that the restarted job can take it over and resume.
+"""
+import os
+import json
+import socket
+import shlex
+import sqlite3
+import hashlib
+import importlib
+import time
+import threading
+
+
+# arguments that do not change the outcome of an experiment
+ignored_args = ['log_dir', 'device', 'all_device_ids', 'save_iter', 'vis_iter', 'async_vis', 'vis_queue_size',
+                'registry', 'use_registry', 'async_checkpoints', 'keep_last',
+                'resume', 'resume_iter']
+
+root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+default_registry_path = os.path.join(root_dir, 'logs', 'experiments.sqlite')
+heartbeat_interval = 60
+heartbeat_timeout = 600
+_code_versions = {}
+
+
+def get_code_version(script):
+    """ Hash of the python sources of methods/, modules/, nnlib and of the training script itself.
+    Other scripts are not included, so that editing the command generators does not change the version.
+    """
+    if script in _code_versions:
+        return _code_versions[script]
+    paths = [os.path.join(root_dir, *script.split('.')) + '.py']
+    for package in ['methods', 'modules', 'nnlib']:
+        for dir_path, dir_names, file_names in os.walk(os.path.join(root_dir, package)):
+            dir_names[:] = sorted(d for d in dir_names if not d.startswith('.') and d != '__pycache__')
+            paths.extend(os.path.join(dir_path, f) for f in file_names if f.endswith('.py'))
+    h = hashlib.sha256()
+    for path in sorted(paths):
+        h.update(os.path.relpath(path, root_dir).encode('utf-8'))
+        with open(path, 'rb') as f:
+            h.update(f.read())
+    _code_versions[script] = h.hexdigest()[:16]
+    return _code_versions[script]
+
+
+def get_experiment_key(args, script):
+    """ Canonical hash of an experiment, given the parsed arguments of a training script. """
+    args_dict = {k: v for k, v in sorted(vars(args).items()) if k not in ignored_args}
+    # the contents of the config file are hashed instead of its path
+    config_path = args_dict.pop('config', None)
+    config = None
+    if config_path is not None:
+        if not os.path.exists(config_path):
+            config_path = os.path.join(root_dir, config_path)
+        with open(config_path, 'r') as f:
+            config = json.load(f)
+    description = {
+        'script': script,
+        'args': args_dict,
+        'config': config,
+        'code_version': get_code_version(script)
+    }
+    return hashlib.sha256(json.dumps(description, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+def parse_command(command):
+    """ Parses a command like `python -um scripts.train_classifier ...` with the parser of the script.
+    Returns (script, args), or (None, None) if the script has no make_parser function.
+    """
+    argv = shlex.split(command)
+    module_idx = None
+    for idx, token in enumerate(argv):
+        if token.startswith('-') and token.endswith('m') and not token.startswith('--') and idx + 1 < len(argv):
+            module_idx = idx + 1
+            break
+    if module_idx is None:
+        return None, None
+    script = argv[module_idx]
+    module = importlib.import_module(script)
+    if not hasattr(module, 'make_parser'):
+        return None, None
+    return script, module.make_parser().parse_args(argv[module_idx + 1:])
+
+
+def _pid_is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class ExperimentRegistry(object):
+    def __init__(self, path):
+        self.path = path
+        dir_name = os.path.dirname(path)
+        if dir_name != '':
+            os.makedirs(dir_name, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS experiments (
+                    key TEXT PRIMARY KEY,
+                    script TEXT,
+                    args TEXT,
+                    code_version TEXT,
+                    status TEXT,
+                    log_dir TEXT,
+                    result_paths TEXT,
+                    host TEXT,
+                    pid INTEGER,
+                    started_at REAL,
+                    updated_at REAL
+                )""")
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=60, isolation_level=None)
+
+    @staticmethod
+    def _to_dict(row, description):
+        if row is None:
+            return None
+        entry = {d[0]: v for d, v in zip(description, row)}
+        entry['result_paths'] = json.loads(entry['result_paths']) if entry['result_paths'] else None
+        return entry
+
+    def get(self, key):
+        with self._connect() as conn:
+            cursor = conn.execute("SELECT * FROM experiments WHERE key = ?", (key,))
+            return self._to_dict(cursor.fetchone(), cursor.description)
+
+    @staticmethod
+    def has_results(entry):
+        """ Whether all result files of a 'finished' entry still exist. Relative paths are resolved against the
+        current directory and the repository root. Entries with deleted results are stale and are rerun.
+        """
+        for path in (entry['result_paths'] or {}).values():
+            if not (os.path.exists(path) or os.path.exists(os.path.join(root_dir, path))):
+                return False
+        return True
+
+    def is_finished(self, entry):
+        return entry is not None and entry['status'] == 'finished' and self.has_results(entry)
+
+    def is_in_flight(self, entry):
+        """ Whether a 'running' entry belongs to a process that is still alive. Processes of other hosts
+        are assumed to be alive while their heartbeat is recent.
+        """
+        if entry is None or entry['status'] != 'running':
+            return False
+        if entry['host'] != socket.gethostname():
+            return time.time() - (entry['updated_at'] or 0) < heartbeat_timeout
+        return _pid_is_alive(entry['pid'])
+
+    def should_skip(self, key):
+        """ Returns the reason to skip the experiment ('finished' or 'running'), or None. """
+        entry = self.get(key)
+        if entry is None:
+            return None
+        if self.is_finished(entry):
+            return 'finished'
+        if self.is_in_flight(entry):
+            return 'running'
+        return None
+
+    def start(self, key, script, args):
+        """ Registers the experiment as running, unless it is finished or in flight.
+        Returns (True, None) if registered, (False, entry) otherwise.
+        """
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")  # lock the database between the check and the update
+            cursor = conn.execute("SELECT * FROM experiments WHERE key = ?", (key,))
+            entry = self._to_dict(cursor.fetchone(), cursor.description)
+            if entry is not None and (self.is_finished(entry) or self.is_in_flight(entry)):
+                conn.execute("ROLLBACK")
+                return False, entry
+            args_dict = {k: v for k, v in sorted(vars(args).items())}
+            conn.execute("INSERT OR REPLACE INTO experiments VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                         (key, script, json.dumps(args_dict, default=str), get_code_version(script), 'running',
+                          getattr(args, 'log_dir', None), None, socket.gethostname(), os.getpid(), now, now))
+            conn.execute("COMMIT")
+            return True, None
+        finally:
+            conn.close()
+
+    def heartbeat(self, key):
+        """ Refreshes updated_at of the entry, if it is still owned by this process. """
+        with self._connect() as conn:
+            conn.execute("UPDATE experiments SET updated_at = ? WHERE key = ? AND status = 'running' "
+                         "AND host = ? AND pid = ?", (time.time(), key, socket.gethostname(), os.getpid()))
+
+    def _set_status(self, key, status, result_paths=None):
+        with self._connect() as conn:
+            conn.execute("UPDATE experiments SET status = ?, result_paths = ?, updated_at = ? WHERE key = ?",
+                         (status, json.dumps(result_paths) if result_paths is not None else None,
+                          time.time(), key))
+
+    def finish(self, key, result_paths):
+        """ Marks the experiment as finished. result_paths maps names of results to their file paths. """
+        self._set_status(key, 'finished', result_paths)
+
+    def fail(self, key):
+        self._set_status(key, 'failed')
+
+
+class Heartbeat(object):
+    """ Calls registry.heartbeat(key) every interval seconds in a background thread, until stopped. """
+    def __init__(self, registry, key, interval=None):
+        self.registry = registry
+        self.key = key
+        self.interval = heartbeat_interval if interval is None else interval
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+
+    def _loop(self):
+        while not self._stop_event.wait(self.interval):
+            try:
+                self.registry.heartbeat(self.key)
+            except sqlite3.Error as e:
+                print("Could not update the heartbeat of {}: {}".format(self.key, e))
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop_event.set()
+        self._thread.join()
+        return False
+
+
+def run_registered(args, script, run):
+    """ Runs run(args) unless an equivalent experiment is finished or in flight according to the
+    registry at args.registry. run should return a dict of result file paths.
+    """
+    if not args.use_registry:
+        return run(args)
+    registry = ExperimentRegistry(args.registry)
+    key = get_experiment_key(args, script)
+    started, entry = registry.start(key, script, args)
+    if not started:
+        print("Skipping, an equivalent experiment is {} (log_dir: {}, key: {})".format(
+            entry['status'], entry['log_dir'], key))
+        return entry['result_paths']
+    try:
+        with Heartbeat(registry, key):
+            result_paths = run(args)
+    except BaseException:
+        registry.fail(key)
+        raise
+    registry.finish(key, result_paths)
+    return result_paths
+
+
+def should_skip_command(command, registry_path):
+    """ Used by the command generators. Returns 'finished' or 'running' if an equivalent experiment is
+    recorded in the registry, None otherwise.
+    """
+    if registry_path is None or not os.path.exists(registry_path):
+        return None
+    script, args = parse_command(command)
+    if script is None:
+        return None
+    return ExperimentRegistry(registry_path).should_skip(get_experiment_key(args, script))
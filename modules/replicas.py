@@ -0,0 +1,258 @@
+""" Lock-step training of several replicas of the same small classifier.
+
+The parameters of M replicas (e.g. different seeds, learning rates, weight decays or gradient noise levels)
+are stacked along a new leading dimension. The forward and backward passes of all replicas are computed
+at once with torch.func.vmap, and a vectorized Adam updates all replicas with their own hyperparameters
+and optimizer states. Replicas that stopped early are masked out of the updates.
+
+train_replicas can write resume checkpoints of the whole grid to log_dir/resume/ (see modules/training.py)
+and continue an interrupted run from the latest one.
+"""
+import copy
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from torch.func import stack_module_state, functional_call, vmap
+
+from modules import training
+
+
+class ReplicaAdam(object):
+    """ Adam (with L2 weight decay, as torch.optim.Adam) on stacked parameters. lr and weight_decay are
+    tensors of shape (M,), one value per replica.
+    """
+    def __init__(self, params, lr, weight_decay, betas=(0.9, 0.999), eps=1e-8):
+        self.params = params
+        self.lr = lr
+        self.weight_decay = weight_decay
+        self.betas = betas
+        self.eps = eps
+        n_replicas = lr.shape[0]
+        self.step_count = torch.zeros(n_replicas, device=lr.device)
+        self.exp_avg = {k: torch.zeros_like(p) for k, p in params.items()}
+        self.exp_avg_sq = {k: torch.zeros_like(p) for k, p in params.items()}
+
+    @staticmethod
+    def _per_replica(v, p):
+        return v.view([-1] + [1] * (p.dim() - 1))
+
+    def state_dict(self):
+        return {'step_count': self.step_count, 'exp_avg': self.exp_avg, 'exp_avg_sq': self.exp_avg_sq}
+
+    @torch.no_grad()
+    def load_state_dict(self, state):
+        self.step_count.copy_(state['step_count'])
+        for k in self.params:
+            self.exp_avg[k].copy_(state['exp_avg'][k])
+            self.exp_avg_sq[k].copy_(state['exp_avg_sq'][k])
+
+    @torch.no_grad()
+    def step(self, grads, active):
+        """ Updates the parameters of active replicas. active is a boolean tensor of shape (M,). """
+        beta1, beta2 = self.betas
+        active_f = active.float()
+        self.step_count += active_f
+        t = self.step_count.clamp(min=1)
+        bias_correction1 = 1 - beta1 ** t
+        bias_correction2 = 1 - beta2 ** t
+
+        for k, p in self.params.items():
+            mask = self._per_replica(active_f, p)
+            g = grads[k] + self._per_replica(self.weight_decay, p) * p
+            exp_avg = self.exp_avg[k]
+            exp_avg_sq = self.exp_avg_sq[k]
+            exp_avg.copy_(torch.lerp(exp_avg, g, (1 - beta1) * mask))
+            exp_avg_sq.copy_(exp_avg_sq + mask * (1 - beta2) * (g * g - exp_avg_sq))
+            denom = (exp_avg_sq / self._per_replica(bias_correction2, p)).sqrt() + self.eps
+            step_size = self._per_replica(self.lr / bias_correction1, p)
+            p.sub_(mask * step_size * exp_avg / denom)
+
+
+class ReplicaTrainer(object):
+    """ Trains the classifiers of StandardClassifier models in lock-step.
+    :param models: StandardClassifier instances with the same architecture and without a trainable
+        representation network.
+    :param noise_stds: per-replica standard deviations of the noise added to the gradient wrt logits
+        (see nn_utils.get_grad_noise_class). Zero means no noise.
+    """
+    def __init__(self, models, lrs, weight_decays, noise_stds, noise_type='Gaussian', device='cuda'):
+        self.models = models
+        self.n_replicas = len(models)
+        self.device = device
+        self.noise_type = noise_type
+        self.repr_net = models[0].repr_net
+        assert not any(p.requires_grad for m in models for p in m.repr_net.parameters()), \
+            "only fixed representation networks are supported"
+
+        classifiers = [m.classifier.to(device) for m in models]
+        self.params, self.buffers = stack_module_state(classifiers)
+        self.template = copy.deepcopy(classifiers[0])
+
+        def to_tensor(values):
+            return torch.tensor(values, dtype=torch.float, device=device)
+        self.noise_stds = to_tensor(noise_stds)
+        self.optimizer = ReplicaAdam(self.params, lr=to_tensor(lrs), weight_decay=to_tensor(weight_decays))
+
+    def _forward_one(self, params, buffers, x):
+        return functional_call(self.template, (params, buffers), args=(x,))
+
+    def forward(self, x, train):
+        """ x has shape (M, batch_size, ...). Returns logits of shape (M, batch_size, n_classes). """
+        self.template.train(train)
+        with torch.no_grad():
+            x = torch.stack([self.repr_net(x_m) for x_m in x])
+        return vmap(self._forward_one, in_dims=(0, 0, 0), randomness='different')(self.params, self.buffers, x)
+
+    def _add_gradient_noise(self, grad):
+        std = self.noise_stds.view(-1, 1, 1)
+        if self.noise_type == 'Gaussian':
+            noise = torch.randn_like(grad)
+        elif self.noise_type == 'Laplace':
+            noise = torch.distributions.Laplace(0.0, np.sqrt(1.0 / 2.0)).sample(grad.shape).to(grad.device)
+        else:
+            raise NotImplementedError()
+        return grad + std * noise
+
+    def train_step(self, x, y, active):
+        """ One optimization step of all active replicas. Returns the per-replica losses and
+        number of correct predictions.
+        """
+        with torch.enable_grad():
+            logits = self.forward(x, train=True)
+            if (self.noise_stds > 0).any():
+                logits.register_hook(self._add_gradient_noise)
+            losses = F.cross_entropy(logits.flatten(0, 1), y.flatten(), reduction='none').view(y.shape).mean(dim=1)
+            names = list(self.params.keys())
+            grads = torch.autograd.grad(losses.sum(), [self.params[k] for k in names])
+        self.optimizer.step(dict(zip(names, grads)), active)
+        correct = (logits.detach().argmax(dim=-1) == y).sum(dim=1)
+        return losses.detach(), correct
+
+    @torch.no_grad()
+    def eval_step(self, x, y):
+        logits = self.forward(x, train=False)
+        return (logits.argmax(dim=-1) == y).sum(dim=1)
+
+    def state_dict(self):
+        """ Stacked parameters, buffers and optimizer state of all replicas. """
+        return {'params': self.params, 'buffers': self.buffers, 'optimizer': self.optimizer.state_dict()}
+
+    @torch.no_grad()
+    def load_state_dict(self, state):
+        for k, v in self.params.items():
+            v.copy_(state['params'][k])
+        for k, v in self.buffers.items():
+            v.copy_(state['buffers'][k])
+        self.optimizer.load_state_dict(state['optimizer'])
+
+    def replica_state(self, idx):
+        """ State dict of the classifier of one replica, on CPU. """
+        state = {k: v[idx].detach().cpu().clone() for k, v in self.params.items()}
+        state.update({k: v[idx].detach().cpu().clone() for k, v in self.buffers.items()})
+        return state
+
+
+def stack_batches(batches, data_index, device):
+    """ Given one (x, y) batch per data stream, builds inputs of shape (M, batch_size, ...), where replica
+    m gets the batch of stream data_index[m].
+    """
+    x = torch.stack([b[0] for b in batches]).to(device)
+    y = torch.stack([b[1] for b in batches]).to(device)
+    return x[data_index], y[data_index]
+
+
+def train_replicas(trainer, train_loaders, val_loaders, data_index, epochs, stopping_param, writers=None,
+                   log_dir=None, run_names=None, resume=True, resume_iter=1):
+    """ Trains all replicas until each of them stops improving its validation accuracy for stopping_param
+    epochs, or for the given number of epochs.
+    :param train_loaders: one loader per data stream. All streams should have the same number of batches.
+    :param data_index: list of length M, the data stream of each replica.
+    :param writers: optional list of M tensorboard writers.
+    :param log_dir: if given, resume checkpoints of the grid are written to log_dir/resume/ every resume_iter
+        epochs, and with resume=True the training continues from the latest one.
+    :param run_names: names of the M replicas (e.g. their log directories). A resume checkpoint is used only
+        if it was written by a grid with the same names.
+    Returns the best validation accuracies and the classifier states at the best epochs.
+    """
+    M = trainer.n_replicas
+    device = trainer.device
+    data_index = torch.tensor(data_index, device=device)
+    active = torch.ones(M, dtype=torch.bool, device=device)
+    best_val = np.full(M, -np.inf)
+    best_epoch = np.zeros(M, dtype=np.int64)
+    best_states = [trainer.replica_state(m) for m in range(M)]
+    loaders = list(train_loaders) + list(val_loaders)
+
+    start_epoch = 0
+    state = training.load_resume_checkpoint(log_dir) if (log_dir is not None and resume) else None
+    if state is not None and state['run_names'] != run_names:
+        print("Ignoring the resume checkpoint in {}, it belongs to a different grid".format(log_dir))
+        state = None
+    if state is not None:
+        trainer.load_state_dict(state['trainer'])
+        active.copy_(state['active'])
+        best_val, best_epoch, best_states = state['best_val'], state['best_epoch'], state['best_states']
+        training.set_rng_state(state['rng'], loaders)
+        start_epoch = state['epoch'] + 1
+        print("Resuming the training from epoch {}".format(start_epoch))
+        del state
+
+    for epoch in range(start_epoch, epochs):
+        total_loss = torch.zeros(M, device=device)
+        train_correct = torch.zeros(M, device=device)
+        n_train = 0
+        n_batches = 0
+        for batches in zip(*train_loaders):
+            x, y = stack_batches(batches, data_index, device)
+            losses, correct = trainer.train_step(x, y, active)
+            total_loss += losses
+            train_correct += correct
+            n_train += y.shape[1]
+            n_batches += 1
+
+        val_correct = torch.zeros(M, device=device)
+        n_val = 0
+        for batches in zip(*val_loaders):
+            x, y = stack_batches(batches, data_index, device)
+            val_correct += trainer.eval_step(x, y)
+            n_val += y.shape[1]
+
+        train_acc = (train_correct / max(n_train, 1)).cpu().numpy()
+        val_acc = (val_correct / max(n_val, 1)).cpu().numpy()
+        mean_loss = (total_loss / max(n_batches, 1)).cpu().numpy()
+        active_np = active.cpu().numpy()
+
+        for m in range(M):
+            if not active_np[m]:
+                continue
+            if writers is not None:
+                writers[m].add_scalar('losses/classifier', mean_loss[m], epoch)
+                writers[m].add_scalar('accuracy/train', train_acc[m], epoch)
+                writers[m].add_scalar('accuracy/val', val_acc[m], epoch)
+            if val_acc[m] > best_val[m]:
+                best_val[m] = val_acc[m]
+                best_epoch[m] = epoch
+                best_states[m] = trainer.replica_state(m)
+            elif epoch - best_epoch[m] >= stopping_param:
+                print("Replica {} stopped at epoch {}, best val accuracy {:.4f} at epoch {}".format(
+                    m, epoch, best_val[m], best_epoch[m]))
+                active[m] = False
+
+        print("Epoch {}: {} active replicas, val accuracy mean {:.4f} max {:.4f}".format(
+            epoch, int(active.sum()), float(val_acc.mean()), float(val_acc.max())))
+        if log_dir is not None and ((epoch + 1) % resume_iter == 0 or epoch + 1 == epochs or not active.any()):
+            training.write_resume_state(log_dir, epoch, {
+                'epoch': epoch,
+                'run_names': run_names,
+                'trainer': trainer.state_dict(),
+                'active': active,
+                'best_val': best_val,
+                'best_epoch': best_epoch,
+                'best_states': best_states,
+                'rng': training.get_rng_state(loaders),
+            })
+        if not active.any():
+            break
+
+    return best_val, best_states
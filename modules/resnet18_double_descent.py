@@ -1,6 +1,7 @@
 """ ResNet18 for CIFAR
 Based on: https://github.com/kuangliu/pytorch-cifar/blob/master/models/preact_resnet.py
 """
+import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
@@ -71,3 +72,81 @@ class PreActResNet(nn.Module):
 def make_resnet18k(k=64, num_classes=10) -> PreActResNet:
     """ Returns a ResNet18 with width parameter k. (k=64 is standard ResNet18) """
     return PreActResNet(PreActBlock, [2, 2, 2, 2], num_classes=num_classes, init_channels=k)
+
+
+def _make_mapping(old_width, new_width, generator):
+    """ Net2Net mapping of new channels to old ones: the old channels are kept, the new ones copy random old ones. """
+    assert new_width >= old_width
+    extra = torch.randint(0, old_width, (new_width - old_width,), generator=generator)
+    return torch.cat([torch.arange(old_width), extra])
+
+
+def _widen_out(weight, mapping):
+    """ Widens the output dimension (dim 0) of a producer weight by copying. """
+    return weight[mapping.to(weight.device)]
+
+
+def _widen_in(weight, mapping, noise_std, generator):
+    """ Widens the input dimension (dim 1) of a consumer weight. Copies of an input channel share its weight,
+    so the output does not change. If noise_std > 0, noise with zero sum over the copies of every channel is added
+    (relative to the std of the weight), which breaks the symmetry of the copies but keeps the function.
+    """
+    old_width = weight.shape[1]
+    counts = torch.bincount(mapping, minlength=old_width).to(weight)
+    shape = [1, -1] + [1] * (weight.dim() - 2)
+    device_mapping = mapping.to(weight.device)
+    new_weight = weight[:, device_mapping] / counts[device_mapping].view(*shape)
+    if noise_std > 0:
+        noise = torch.randn(new_weight.shape, generator=generator).to(weight) * noise_std * weight.std()
+        group_sum = torch.zeros_like(weight).index_add_(1, device_mapping, noise)
+        noise = noise - (group_sum / counts.view(*shape))[:, device_mapping]
+        new_weight = new_weight + noise
+    return new_weight
+
+
+def _widen_batch_norm(old_bn, new_bn, mapping):
+    for name in ['weight', 'bias', 'running_mean', 'running_var']:
+        getattr(new_bn, name).copy_(_widen_out(getattr(old_bn, name), mapping))
+    new_bn.num_batches_tracked.copy_(old_bn.num_batches_tracked)
+
+
+@torch.no_grad()
+def widen_resnet18k(net, new_k, noise_std=0.0, seed=42) -> PreActResNet:
+    """ Net2Net widening (Chen et al., 2016) of a ResNet18-k into a ResNet18-new_k computing the same function.
+    New channels are copies of random old channels. Layers producing a channel copy its weights, layers consuming
+    it divide the weights of its copies by the number of copies. The residual stream of every stage uses a single
+    channel mapping, so that both summands of a residual connection are widened the same way, and the hidden
+    channels of every block get their own mapping.
+    :param noise_std: std of the symmetry-breaking noise added to consumer weights, relative to their std.
+    """
+    old_k = net.conv1.out_channels
+    assert new_k >= old_k, 'can only widen, {} < {}'.format(new_k, old_k)
+    device = net.conv1.weight.device
+    new_net = make_resnet18k(k=new_k, num_classes=net.linear.out_features).to(device)
+    new_net.train(net.training)
+    generator = torch.Generator()
+    generator.manual_seed(seed)
+
+    stream = _make_mapping(old_k, new_k, generator)
+    new_net.conv1.weight.copy_(_widen_out(net.conv1.weight, stream))
+    for layer_name in ['layer1', 'layer2', 'layer3', 'layer4']:
+        for old_block, new_block in zip(getattr(net, layer_name), getattr(new_net, layer_name)):
+            if hasattr(old_block, 'shortcut'):
+                out_stream = _make_mapping(old_block.conv2.out_channels, new_block.conv2.out_channels, generator)
+                shortcut = _widen_in(old_block.shortcut[0].weight, stream, noise_std, generator)
+                new_block.shortcut[0].weight.copy_(_widen_out(shortcut, out_stream))
+            else:
+                out_stream = stream
+            hidden = _make_mapping(old_block.conv1.out_channels, new_block.conv1.out_channels, generator)
+
+            _widen_batch_norm(old_block.bn1, new_block.bn1, stream)
+            conv1 = _widen_in(old_block.conv1.weight, stream, noise_std, generator)
+            new_block.conv1.weight.copy_(_widen_out(conv1, hidden))
+            _widen_batch_norm(old_block.bn2, new_block.bn2, hidden)
+            conv2 = _widen_in(old_block.conv2.weight, hidden, noise_std, generator)
+            new_block.conv2.weight.copy_(_widen_out(conv2, out_stream))
+            stream = out_stream
+
+    new_net.linear.weight.copy_(_widen_in(net.linear.weight, stream, noise_std, generator))
+    new_net.linear.bias.copy_(net.linear.bias)
+    return new_net
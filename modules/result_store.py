@@ -0,0 +1,184 @@
+""" Append-only store of run results.
+
+Results are kept in a parquet dataset partitioned by dataset and model_class (hive layout, e.g.
+`root/dataset=mnist/model_class=StandardClassifier/part-<uuid>-0.parquet`). Every append writes new
+files, so existing files are never rewritten. All files share one fixed schema, so queries with
+filters only read the partitions and row groups they need.
+
+Example:
+    store = ResultStore('results_store')
+    store.append(df)
+    df = store.query("dataset == 'uniform-noise-cifar10' and label_noise_level == 0.8")
+"""
+import ast
+import os
+import time
+import uuid
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+
+
+partition_columns = ['dataset', 'model_class']
+
+# the column types are the types of the script arguments. Integer columns with missing values (e.g.
+# num_train_examples) are read back as float64, whereas pickled tables keep them as objects; fill_missing_values
+# (modules/result_utils.py) handles both
+_string_columns = ['model_class', 'config', 'loss_function', 'q_dist', 'noise_type', 'dataset',
+                   'label_noise_type', 'transform_function', 'device', 'pretrained_arg', 'load_from', 'log_dir']
+_float_columns = ['detach', 'grad_l1_penalty', 'grad_weight_decay', 'lamb', 'loss_function_param', 'noise_std',
+                  'lr', 'weight_decay', 'label_noise_level', 'error_prob', 'remove_prob', 'test_accuracy',
+                  'val_accuracy']
+_bool_columns = ['sample_from_q', 'data_augmentation', 'clean_validation', 'add_noise']
+_int_columns = ['seed', 'batch_size', 'epochs', 'save_iter', 'vis_iter', 'stopping_param', 'warm_up',
+                'num_train_examples']
+
+schema = pa.schema(
+    [pa.field(c, pa.string()) for c in _string_columns] +
+    [pa.field(c, pa.float64()) for c in _float_columns] +
+    [pa.field(c, pa.bool_()) for c in _bool_columns] +
+    [pa.field(c, pa.int64()) for c in _int_columns] +
+    [pa.field('appended_at', pa.timestamp('us'))])
+
+partitioning = ds.partitioning(pa.schema([schema.field(c) for c in partition_columns]), flavor='hive')
+
+
+def to_arrow_table(df):
+    """ Converts a results table to the schema of the store. Columns that are not in the schema are dropped,
+    missing columns are filled with nulls.
+    """
+    unknown = sorted(set(df.columns) - set(schema.names))
+    if len(unknown) > 0:
+        print("Columns not in the result store schema are dropped: {}".format(unknown))
+
+    out = pd.DataFrame(index=range(len(df)))
+    for c in _string_columns:
+        values = df[c].values if c in df.columns else [None] * len(df)
+        out[c] = [None if v is None or (isinstance(v, float) and v != v) else str(v) for v in values]
+    for c in _float_columns:
+        out[c] = pd.to_numeric(df[c].values, errors='coerce') if c in df.columns else float('nan')
+    for c in _bool_columns:
+        values = df[c].values if c in df.columns else [None] * len(df)
+        out[c] = pd.Series(values, dtype='object').astype('boolean')
+    for c in _int_columns:
+        values = df[c].values if c in df.columns else [None] * len(df)
+        out[c] = pd.to_numeric(pd.Series(values, dtype='object'), errors='coerce').astype('Int64')
+    out['appended_at'] = pd.Timestamp.now()
+
+    assert out[partition_columns].notnull().all().all(), 'dataset and model_class are required'
+    return pa.Table.from_pandas(out, schema=schema, preserve_index=False)
+
+
+_comparison_ops = {
+    ast.Eq: '==', ast.NotEq: '!=', ast.Lt: '<', ast.LtE: '<=', ast.Gt: '>', ast.GtE: '>=',
+    ast.In: 'in', ast.NotIn: 'not in'
+}
+
+
+def _make_comparison(column, op, value):
+    assert column in schema.names, "unknown column: {}".format(column)
+    field = pc.field(column)
+    if op == '==':
+        return field == value
+    if op == '!=':
+        return field != value
+    if op == '<':
+        return field < value
+    if op == '<=':
+        return field <= value
+    if op == '>':
+        return field > value
+    if op == '>=':
+        return field >= value
+    if op == 'in':
+        return field.isin(list(value))
+    if op == 'not in':
+        return ~field.isin(list(value))
+    raise NotImplementedError("unknown operator: {}".format(op))
+
+
+def _expression_from_ast(node):
+    if isinstance(node, ast.Expression):
+        return _expression_from_ast(node.body)
+    if isinstance(node, ast.BoolOp):
+        parts = [_expression_from_ast(v) for v in node.values]
+        expr = parts[0]
+        for p in parts[1:]:
+            expr = (expr & p) if isinstance(node.op, ast.And) else (expr | p)
+        return expr
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Not):
+        return ~_expression_from_ast(node.operand)
+    if isinstance(node, ast.Compare):
+        # chained comparisons like `0.2 <= label_noise_level <= 0.6` are split into a conjunction
+        expr = None
+        left = node.left
+        for op, right in zip(node.ops, node.comparators):
+            op = _comparison_ops[type(op)]
+            if isinstance(left, ast.Name):
+                part = _make_comparison(left.id, op, ast.literal_eval(right))
+            else:
+                assert isinstance(right, ast.Name), "one side of a comparison should be a column name"
+                flipped = {'<': '>', '<=': '>=', '>': '<', '>=': '<=', '==': '==', '!=': '!='}
+                part = _make_comparison(right.id, flipped[op], ast.literal_eval(left))
+            expr = part if expr is None else (expr & part)
+            left = right
+        return expr
+    raise NotImplementedError("unsupported filter expression: {}".format(ast.dump(node)))
+
+
+def make_filter_expression(filters):
+    """ Converts filters to a pyarrow expression. Filters can be given as a string, like
+    "dataset == 'mnist' and label_noise_level >= 0.4", or as a list of (column, op, value) tuples
+    that should all hold. None means no filter.
+    """
+    if filters is None:
+        return None
+    if isinstance(filters, str):
+        return _expression_from_ast(ast.parse(filters, mode='eval'))
+    expr = None
+    for column, op, value in filters:
+        part = _make_comparison(column, op, value)
+        expr = part if expr is None else (expr & part)
+    return expr
+
+
+class ResultStore(object):
+    def __init__(self, root):
+        self.root = root
+
+    def append(self, df):
+        """ Appends the rows of a results table to the store. Returns the number of appended rows. """
+        if len(df) == 0:
+            return 0
+        table = to_arrow_table(df)
+        os.makedirs(self.root, exist_ok=True)
+        ds.write_dataset(table, self.root, format='parquet', partitioning=partitioning,
+                         basename_template='part-{}-{{i}}.parquet'.format(uuid.uuid4().hex),
+                         existing_data_behavior='overwrite_or_ignore')
+        return len(df)
+
+    def _dataset(self):
+        return ds.dataset(self.root, format='parquet', partitioning=partitioning, schema=schema)
+
+    def query(self, filters=None, columns=None, deduplicate=True):
+        """ Reads the rows that match the filters (see make_filter_expression) as a pandas DataFrame.
+        If a run was appended several times, only its last appended row is kept when deduplicate=True.
+        """
+        if columns is not None and deduplicate:
+            columns = list(dict.fromkeys(list(columns) + ['log_dir', 'appended_at']))
+        if not os.path.isdir(self.root):
+            return schema.empty_table().to_pandas()[columns or schema.names]
+
+        start = time.time()
+        table = self._dataset().to_table(filter=make_filter_expression(filters), columns=columns)
+        df = table.to_pandas()
+        if deduplicate:
+            df = df.sort_values('appended_at', kind='stable')
+            df = df.drop_duplicates(subset='log_dir', keep='last').reset_index(drop=True)
+        print("Read {} rows from {} in {:.2f}s".format(len(df), self.root, time.time() - start))
+        return df
+
+    def count(self, filters=None):
+        return self._dataset().count_rows(filter=make_filter_expression(filters))
@@ -1,5 +1,6 @@
 import pickle
 
+import numpy as np
 import pandas as pd
 
 
@@ -31,31 +32,65 @@ method_order = {
 }
 
 
+def read_result_table(path):
+    """ Reads a table written by scripts/extract_results_from_logs.py. """
+    if path.endswith('.parquet'):
+        return pd.read_parquet(path)
+    if path.endswith('.feather'):
+        return pd.read_feather(path)
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+
 def load_result_tables(list_of_datasets):
-    """ Loads results datasets from stored .pkl files. """
+    """ Loads results datasets from stored .pkl, .parquet or .feather files. """
     datasets = []
     df = None
     for dataset_path in list_of_datasets:
-        with open(dataset_path, 'rb') as f:
-            df = pickle.load(f)
+        df = read_result_table(dataset_path)
         datasets.append(df)
     df = df.drop(labels=ignore_columns, axis=1)  # drop columns that do not matter
     df = pd.concat(datasets, sort=False).reset_index(drop=True)
-    df['num_train_examples'].fillna('N/A', inplace=True)
-    df['transform_function'].fillna('N/A', inplace=True)
-    df['detach'].fillna(1.0, inplace=True)
-    df['load_from'].fillna('N/A', inplace=True)
+    return fill_missing_values(df)
+
+
+def load_result_store(store_path, filters=None):
+    """ Loads results from a ResultStore (see modules/result_store.py). Only the slices of the
+    store that match `filters` are read. E.g. filters="dataset == 'mnist' and label_noise_level == 0.8".
+    """
+    from modules.result_store import ResultStore
+    df = ResultStore(store_path).query(filters=filters)
+    df = df.drop(columns=['appended_at'])
+    return fill_missing_values(df)
+
+
+def _fill_column(df, column, value):
+    # the column is assigned, since inplace fillna on df[column] does nothing under copy-on-write. Numeric columns
+    # (e.g. num_train_examples of a ResultStore, float64 when some values are missing) are converted to objects
+    # before being filled with a string
+    if isinstance(value, str):
+        df[column] = df[column].astype(object).fillna(value)
+    else:
+        df[column] = df[column].fillna(value)
+
+
+def fill_missing_values(df):
+    """ Fills values of columns that are missing in older runs and adds derived columns. """
+    _fill_column(df, 'num_train_examples', 'N/A')
+    _fill_column(df, 'transform_function', 'N/A')
+    _fill_column(df, 'detach', 1.0)
+    _fill_column(df, 'load_from', 'N/A')
     df['is_loaded'] = (df.load_from != 'N/A')
-    df['pretrained_arg'].fillna('N/A', inplace=True)
-    df['lr'].fillna('1e-3', inplace=True)
+    _fill_column(df, 'pretrained_arg', 'N/A')
+    _fill_column(df, 'lr', '1e-3')
 
     if 'warm_up' in df.columns:
-        df['warm_up'].fillna(0, inplace=True)
+        _fill_column(df, 'warm_up', 0)
     else:
         df['warm_up'] = 0
 
     if 'weight_decay' is df.columns:
-        df['weight_decay'].fillna(0.0, inplace=True)
+        _fill_column(df, 'weight_decay', 0.0)
     else:
         df['weight_decay'] = 0.0
 
@@ -95,47 +130,67 @@ def infer_method_name(row):
 
 
 def fill_short_names(df):
-    for idx, row in df.iterrows():
-        df.at[idx, 'method_name'] = infer_method_name(row)
+    """ Fills the method_name column. Gives the same result as applying infer_method_name to every row,
+    but works with whole columns at once.
+    """
+    model_class = df['model_class']
+    loss_function = df['loss_function']
+
+    # StandardClassifier
+    is_standard = (model_class == 'StandardClassifier')
+    assert loss_function[is_standard].isin(['dmi', 'fw', 'mae', 'ce']).all()
+    standard_names = pd.Series(np.where(df['add_noise'] == 1.0,
+                                        'CE-noisy-grad-' + df['noise_type'].astype(str), 'CE'),
+                               index=df.index)
+    standard_names = standard_names.mask(loss_function == 'mae', 'MAE')
+    standard_names = standard_names.mask(loss_function == 'fw', 'FW')
+    standard_names = standard_names.mask(loss_function == 'dmi', 'DMI')
+
+    # PredictGradOutput
+    predict_names = 'Predict-' + df['q_dist'].astype(str)
+    predict_names += np.where(df['sample_from_q'].astype(bool), '-sample', '')
+    predict_names += np.where(loss_function != 'ce', '-' + loss_function.astype(str), '')
+    predict_names += np.where(df['detach'] == 0.0, '-nodetach', '')
+    predict_names += np.where(df['is_loaded'].astype(bool), '-loaded', '')
+    predict_names += np.where(df['warm_up'] != 0, '-warm_up' + df['warm_up'].astype(str), '')
+
+    df['method_name'] = np.select(
+        condlist=[is_standard, model_class == 'PredictGradOutput', model_class == 'PenalizeLastLayerFixedForm'],
+        choicelist=[standard_names, predict_names, 'Penalize'],
+        default='unknown')
     return df
 
 
 def get_agg_results(df):
     """ Takes a dataframe containing all results and computes aggregate results. """
     grouped = df.groupby(method_columns + hparam_columns + data_columns)
-    total_size = 0
-    for key, item in grouped:
-        group = grouped.get_group(key)
-        assert len(group) <= 5  # less than 5 seeds always
-        assert len(set(group['seed'])) == len(group)  # all seeds are distinct
-
-        if item.dataset.iloc[0] == 'mnist' and item.label_noise_type.iloc[0] == 'error':
-            if item.sample_from_q.iloc[0] == True:
-                assert len(group) == 3
-            elif item.model_class.iloc[0] == 'PenalizeLastLayerFixedForm':
-                assert len(group) == 3
-            else:
-                assert len(group) == 5
-
-        total_size += len(group)
-    assert total_size == len(df)
-
-    agg_results = grouped.agg({'test_accuracy': ['mean', 'std'], 'val_accuracy': ['mean', 'std']})
+    agg_results = grouped.agg(test_accuracy_mean=('test_accuracy', 'mean'),
+                              test_accuracy_std=('test_accuracy', 'std'),
+                              val_accuracy_mean=('val_accuracy', 'mean'),
+                              val_accuracy_std=('val_accuracy', 'std'),
+                              n_runs=('seed', 'size'),
+                              n_seeds=('seed', 'nunique'))
     agg_results = agg_results.reset_index()
-    agg_results.columns = ['_'.join(tup).rstrip('_') for tup in agg_results.columns.values]
 
-    return agg_results
+    n_runs = agg_results['n_runs']
+    assert (n_runs <= 5).all()  # less than 5 seeds always
+    assert (agg_results['n_seeds'] == n_runs).all()  # all seeds are distinct
 
+    # the number of seeds of mnist runs with label_noise_type='error'
+    mask = (agg_results['dataset'] == 'mnist') & (agg_results['label_noise_type'] == 'error')
+    expected_n_runs = np.where(agg_results['sample_from_q'] == True, 3,
+                               np.where(agg_results['model_class'] == 'PenalizeLastLayerFixedForm', 3, 5))
+    assert (n_runs.values[mask.values] == expected_n_runs[mask.values]).all()
 
-def do_model_selection_by_val_score(df):
-    """ Takes aggregate results and selects best model by val_accuracy_mean. """
+    assert n_runs.sum() == len(df)
 
-    def select(group):
-        idx = group['val_accuracy_mean'].idxmax()
-        return group.loc[idx]
+    return agg_results.drop(columns=['n_runs', 'n_seeds'])
 
-    grouped = df.groupby(method_columns + data_columns)
-    best_results = grouped.apply(select)
+
+def do_model_selection_by_val_score(df):
+    """ Takes aggregate results and selects best model by val_accuracy_mean. """
+    best_indices = df.groupby(method_columns + data_columns)['val_accuracy_mean'].idxmax()
+    best_results = df.loc[best_indices.values]
     best_results = best_results.reset_index(drop=True)
 
     return best_results
@@ -0,0 +1,55 @@
+from collections import defaultdict
+
+import torch
+
+
+class ScalarBuffer(object):
+    """ Accumulates scalar statistics without moving them to host memory. On flush, all pending
+    values are transferred with a single device-to-host copy and written to tensorboard together.
+    Values can be 0-dim tensors (on any single device) or python numbers.
+    """
+    def __init__(self, flush_every=100):
+        self.flush_every = flush_every
+        self.tensorboard = None
+        self._pending = defaultdict(list)  # tag -> list of (step, value)
+        self._n_steps = 0
+
+    def add(self, tag, value, step, tensorboard=None):
+        if torch.is_tensor(value):
+            value = value.detach()
+        if tensorboard is not None:
+            self.tensorboard = tensorboard
+        self._pending[tag].append((step, value))
+
+    def step(self, tensorboard=None):
+        """ Should be called once per iteration. Flushes every `flush_every` calls. """
+        if tensorboard is not None:
+            self.tensorboard = tensorboard
+        self._n_steps += 1
+        if self._n_steps % self.flush_every == 0:
+            self.flush()
+
+    def flush(self, tensorboard=None):
+        if tensorboard is not None:
+            self.tensorboard = tensorboard
+        if len(self._pending) == 0 or self.tensorboard is None:
+            return
+
+        records = [(tag, step, value) for tag, values in self._pending.items() for step, value in values]
+        tensor_indices = [i for i, r in enumerate(records) if torch.is_tensor(r[2])]
+        host_values = [r[2] for r in records]
+        if len(tensor_indices) > 0:
+            stacked = torch.stack([records[i][2].float().reshape(()) for i in tensor_indices])
+            for i, v in zip(tensor_indices, stacked.cpu().tolist()):
+                host_values[i] = v
+
+        for (tag, step, _), value in zip(records, host_values):
+            self.tensorboard.add_scalar(tag, value, step)
+        self._pending.clear()
+
+    def __getstate__(self):
+        # neither the tensorboard writer nor pending device tensors should be copied or pickled
+        return {'flush_every': self.flush_every}
+
+    def __setstate__(self, state):
+        self.__init__(flush_every=state['flush_every'])
@@ -0,0 +1,150 @@
+""" Packed image datasets stored in fixed-size memory-mapped shards.
+
+Large datasets of JPEG files (Clothing1M, ImageNet) are packed once with scripts/pack_images.py: every
+image is resized and center-cropped to the training resolution and stored as uint8 (H, W, 3) in
+shards of `shard_size` images. A split directory contains:
+    shard_00000.npy, shard_00001.npy, ...   uint8 arrays of shape (n, H, W, 3)
+    index.npz                               labels, noisy_labels (-1 if unknown), paths and failed
+                                            (images that could not be read, stored as zeros)
+    meta.json                               number of images, shard size, resolution
+
+ShardedImageDataset leaves out the failed images: its indices enumerate the readable images only.
+
+ShardedImageDataset reads examples from the memory-mapped shards and ShardAwareSampler shuffles shards and
+examples within a few open shards, so that reads stay mostly sequential.
+"""
+import os
+import json
+
+import numpy as np
+import torch
+
+
+imagenet_mean = [0.485, 0.456, 0.406]
+imagenet_std = [0.229, 0.224, 0.225]
+
+
+def get_shard_path(split_dir, shard_idx):
+    return os.path.join(split_dir, 'shard_{:05d}.npy'.format(shard_idx))
+
+
+class ShardedImageDataset(torch.utils.data.Dataset):
+    """ A split packed with scripts/pack_images.py. Images are returned as normalized float tensors of
+    shape (3, H, W), or as uint8 tensors if raw=True (then dequantize() should be applied on batches).
+    :param use_noisy_labels: if True, noisy labels are returned for the examples that have them.
+    """
+    def __init__(self, split_dir, use_noisy_labels=True, raw=False, mean=None, std=None, dataset_name=None):
+        self.split_dir = split_dir
+        self.raw = raw
+        with open(os.path.join(split_dir, 'meta.json'), 'r') as f:
+            self.meta = json.load(f)
+        self.shard_size = self.meta['shard_size']
+        self.n_stored = self.meta['n_examples']
+        self.dataset_name = dataset_name or self.meta.get('dataset_name')
+
+        index = np.load(os.path.join(split_dir, 'index.npz'))
+        failed = index['failed'] if 'failed' in index.files else np.zeros(self.n_stored, dtype=bool)
+        # positions in the shards of the readable images, in increasing order
+        self.stored_indices = np.flatnonzero(~failed)
+        self.n_examples = len(self.stored_indices)
+        self.clean_labels = index['labels'].astype(np.int64)[self.stored_indices]
+        self.noisy_labels = index['noisy_labels'].astype(np.int64)[self.stored_indices]
+        if use_noisy_labels:
+            self.labels = np.where(self.noisy_labels >= 0, self.noisy_labels, self.clean_labels)
+        else:
+            self.labels = self.clean_labels
+        self.is_corrupted = (self.labels != self.clean_labels)
+
+        self.mean = torch.tensor(mean or imagenet_mean, dtype=torch.float).view(3, 1, 1)
+        self.std = torch.tensor(std or imagenet_std, dtype=torch.float).view(3, 1, 1)
+        self._shards = {}  # opened lazily, so that every data loader worker has its own memory maps
+
+    @property
+    def n_shards(self):
+        return (self.n_stored + self.shard_size - 1) // self.shard_size
+
+    def shard_indices(self, shard_idx):
+        """ Indices of the examples stored in the shard. """
+        start, end = np.searchsorted(self.stored_indices, [shard_idx * self.shard_size,
+                                                           (shard_idx + 1) * self.shard_size])
+        return np.arange(start, end)
+
+    def _get_shard(self, shard_idx):
+        if shard_idx not in self._shards:
+            self._shards[shard_idx] = np.load(get_shard_path(self.split_dir, shard_idx), mmap_mode='r')
+        return self._shards[shard_idx]
+
+    def dequantize(self, x):
+        """ Converts uint8 images of shape (..., 3, H, W) to normalized float images. """
+        return (x.float() / 255.0 - self.mean.to(x.device)) / self.std.to(x.device)
+
+    def get_labels(self, indices):
+        return self.labels[indices]
+
+    def __getitem__(self, idx):
+        position = self.stored_indices[idx]
+        image = self._get_shard(position // self.shard_size)[position % self.shard_size]
+        x = torch.from_numpy(np.array(image)).permute(2, 0, 1)  # (3, H, W)
+        if not self.raw:
+            x = self.dequantize(x)
+        return x, int(self.labels[idx])
+
+    def __len__(self):
+        return self.n_examples
+
+    def __getstate__(self):
+        # memory maps are not sent to data loader workers
+        state = self.__dict__.copy()
+        state['_shards'] = {}
+        return state
+
+
+class ShardAwareSampler(torch.utils.data.Sampler):
+    """ Shuffles the order of shards, and the order of examples within groups of n_open_shards consecutive
+    shards of that order. Only n_open_shards shards are read at a time.
+    """
+    def __init__(self, dataset, n_open_shards=4, seed=42):
+        self.dataset = dataset
+        self.n_open_shards = n_open_shards
+        self.generator = torch.Generator()
+        self.generator.manual_seed(seed)
+
+    def __iter__(self):
+        shard_order = torch.randperm(self.dataset.n_shards, generator=self.generator).tolist()
+        for start in range(0, len(shard_order), self.n_open_shards):
+            group = np.concatenate([self.dataset.shard_indices(s) for s in shard_order[start:start + self.n_open_shards]])
+            permutation = torch.randperm(len(group), generator=self.generator).numpy()
+            yield from group[permutation].tolist()
+
+    def __len__(self):
+        return len(self.dataset)
+
+
+def load_packed_data(args, packed_dir, num_workers=8, n_open_shards=4, raw_train=False):
+    """ Same as load_data_from_arguments for clothing1m and imagenet, reading packed splits from
+    packed_dir/{train,val,test}. The last returned value (additional information returned by nnlib) is None.
+    """
+    loaders = []
+    for split in ['train', 'val', 'test']:
+        split_dir = os.path.join(packed_dir, split)
+        if not os.path.exists(split_dir):
+            loaders.append(None)
+            continue
+        dataset = ShardedImageDataset(split_dir, use_noisy_labels=(split == 'train'),
+                                      raw=(raw_train and split == 'train'), dataset_name=args.dataset)
+        if split == 'train':
+            if args.num_train_examples is not None:
+                # the first examples of a random shard order, keeps reads sequential
+                rng = np.random.RandomState(args.seed)
+                order = np.concatenate([dataset.shard_indices(s) for s in rng.permutation(dataset.n_shards)])
+                dataset = torch.utils.data.Subset(dataset, np.sort(order[:args.num_train_examples]).tolist())
+                # visualizations read the dataset name from the training set
+                dataset.dataset_name = args.dataset
+                sampler = torch.utils.data.RandomSampler(dataset)
+            else:
+                sampler = ShardAwareSampler(dataset, n_open_shards=n_open_shards, seed=args.seed)
+        else:
+            sampler = torch.utils.data.SequentialSampler(dataset)
+        loaders.append(torch.utils.data.DataLoader(dataset, batch_size=args.batch_size, sampler=sampler,
+                                                   num_workers=num_workers, pin_memory=True))
+    return loaders[0], loaders[1], loaders[2], None
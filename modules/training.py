@@ -0,0 +1,348 @@
+""" Training loop with preemption-safe resume.
+
+train() has the interface of nnlib's training.train. In addition, at the end of every `resume_iter`-th epoch
+it writes a resume checkpoint to log_dir/resume/, which contains everything needed to continue the run as if
+it was never interrupted:
+    - model, optimizer and scheduler states and the per-partition iteration counters of the method,
+    - the states of metrics, callbacks and the stopper (e.g. the best value of EarlyStoppingWithMetric),
+    - python, numpy and torch (CPU and CUDA) random states and the states of the random generators of
+      the data loaders (samplers, TensorLoader, batch augmentation), which determine the order of examples.
+When train() is called with a log_dir that has a resume checkpoint, it continues from the latest checkpoint
+that can be read. Checkpoints are written atomically (temporary file, fsync, rename).
+"""
+import os
+import time
+import pickle
+import random
+from collections import defaultdict
+
+import numpy as np
+import torch
+from torch.utils.tensorboard import SummaryWriter
+from tqdm import tqdm
+
+from nnlib.nnlib import utils
+from modules.checkpointing import atomic_torch_save
+from modules import validation
+
+
+def build_optimizer(params, args):
+    args = dict(args)
+    name = args.pop('name', 'adam')
+    if name == 'adam':
+        return torch.optim.Adam(params, **args)
+    if name == 'sgd':
+        return torch.optim.SGD(params, **args)
+    raise NotImplementedError("Optimizer {} is not implemented".format(name))
+
+
+def build_scheduler(optimizer, args):
+    """ Step decay of the learning rate. Without arguments the learning rate is constant. """
+    args = args or {}
+    return torch.optim.lr_scheduler.StepLR(optimizer, step_size=args.get('step_size', 2**30),
+                                           gamma=args.get('gamma', 1.0))
+
+
+def _is_plain(value):
+    """ Whether the value is data (numbers, strings, tensors, arrays and containers of them) rather than a
+    reference to another object, which should not be replaced by a copy on resume.
+    """
+    if value is None or isinstance(value, (bool, int, float, str, np.number, np.ndarray, torch.Tensor)):
+        return True
+    if isinstance(value, (list, tuple, set)):
+        return all(_is_plain(v) for v in value)
+    if isinstance(value, dict):
+        return all(_is_plain(k) and _is_plain(v) for k, v in value.items())
+    return False
+
+
+def get_object_state(obj):
+    """ Plain attributes of a metric, callback or stopper. Wrapped callbacks (e.g. the stopper inside
+    asha.ASHAStopper) are included recursively.
+    """
+    state = {}
+    for key, value in vars(obj).items():
+        if hasattr(value, 'call') and hasattr(value, '__dict__'):
+            state[key] = {'__object__': get_object_state(value)}
+        elif _is_plain(value):
+            if isinstance(value, defaultdict):
+                value = dict(value)  # default factories can be lambdas, which cannot be pickled
+            state[key] = value
+    return state
+
+
+def set_object_state(obj, state):
+    for key, value in state.items():
+        if isinstance(value, dict) and '__object__' in value:
+            set_object_state(getattr(obj, key), value['__object__'])
+        elif isinstance(getattr(obj, key, None), defaultdict):
+            getattr(obj, key).clear()
+            getattr(obj, key).update(value)
+        else:
+            setattr(obj, key, value)
+
+
+def _get_generators(loader):
+    """ Random generators that determine the order and augmentation of the batches of a loader. """
+    generators = []
+    seen = set()
+    objects = [loader]
+    while len(objects) > 0:
+        obj = objects.pop()
+        if obj is None or id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        if isinstance(obj, torch.Generator):
+            generators.append(obj)
+            continue
+        for name in ['generator', 'sampler', 'batch_sampler', 'augmentation', 'loader']:
+            objects.append(getattr(obj, name, None))
+    return generators
+
+
+def get_rng_state(loaders):
+    state = {
+        'python': random.getstate(),
+        'numpy': np.random.get_state(),
+        'torch': torch.get_rng_state(),
+        'loaders': [[g.get_state() for g in _get_generators(loader)] for loader in loaders],
+    }
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state, loaders):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+    for loader, generator_states in zip(loaders, state['loaders']):
+        for g, g_state in zip(_get_generators(loader), generator_states):
+            g.set_state(g_state)
+
+
+def get_resume_dir(log_dir):
+    return os.path.join(log_dir, 'resume')
+
+
+def save_resume_checkpoint(log_dir, epoch, model, optimizer, scheduler, metrics, callbacks, stopper, loaders,
+                           validation_schedule, stopped=False, keep_last=2):
+    """ Writes the state after the given epoch to log_dir/resume/epoch{epoch}.pt. """
+    state = {
+        'epoch': epoch,
+        'stopped': stopped,
+        'model': model.state_dict(),
+        'current_iteration': dict(getattr(model, '_current_iteration', {})),
+        'optimizer': optimizer.state_dict(),
+        'scheduler': scheduler.state_dict(),
+        'metrics': [get_object_state(m) for m in metrics],
+        'callbacks': [get_object_state(c) for c in callbacks],
+        'stopper': get_object_state(stopper) if stopper is not None else None,
+        'validation_schedule': get_object_state(validation_schedule),
+        'rng': get_rng_state(loaders),
+    }
+    write_resume_state(log_dir, epoch, state, keep_last=keep_last)
+
+
+def write_resume_state(log_dir, epoch, state, keep_last=2):
+    """ Atomically writes a resume state to log_dir/resume/epoch{epoch}.pt and keeps the last keep_last ones. """
+    resume_dir = get_resume_dir(log_dir)
+    atomic_torch_save(state, os.path.join(resume_dir, 'epoch{}.pt'.format(epoch)))
+    for old_epoch in sorted(list_resume_checkpoints(log_dir))[:-keep_last]:
+        os.remove(os.path.join(resume_dir, 'epoch{}.pt'.format(old_epoch)))
+
+
+def list_resume_checkpoints(log_dir):
+    """ Epochs of the resume checkpoints in log_dir. """
+    resume_dir = get_resume_dir(log_dir)
+    if not os.path.isdir(resume_dir):
+        return []
+    epochs = []
+    for file_name in os.listdir(resume_dir):
+        if file_name.startswith('epoch') and file_name.endswith('.pt'):
+            epochs.append(int(file_name[len('epoch'):-len('.pt')]))
+    return epochs
+
+
+def read_resume_checkpoint(log_dir, epoch):
+    """ Returns the resume checkpoint of the given epoch, or None if it cannot be read. """
+    path = os.path.join(get_resume_dir(log_dir), 'epoch{}.pt'.format(epoch))
+    try:
+        return torch.load(path, map_location='cpu', weights_only=False)
+    except Exception as e:
+        print("Skipping the resume checkpoint {}: {}".format(path, e))
+    return None
+
+
+def load_resume_checkpoint(log_dir):
+    """ Returns the latest resume checkpoint that can be read, or None. """
+    for epoch in sorted(list_resume_checkpoints(log_dir), reverse=True):
+        state = read_resume_checkpoint(log_dir, epoch)
+        if state is not None:
+            return state
+    return None
+
+
+def restore(state, model, optimizer, scheduler, metrics, callbacks, stopper, loaders, validation_schedule):
+    model.load_state_dict(state['model'])
+    if hasattr(model, '_current_iteration'):
+        model._current_iteration.update(state['current_iteration'])
+    optimizer.load_state_dict(state['optimizer'])
+    scheduler.load_state_dict(state['scheduler'])
+    for m, m_state in zip(metrics, state['metrics']):
+        set_object_state(m, m_state)
+    for c, c_state in zip(callbacks, state['callbacks']):
+        set_object_state(c, c_state)
+    if stopper is not None and state['stopper'] is not None:
+        set_object_state(stopper, state['stopper'])
+    set_object_state(validation_schedule, state['validation_schedule'])
+    set_rng_state(state['rng'], loaders)
+
+
+def run_partition(model, epoch, tensorboard, optimizer, loader, partition, training, metrics,
+                  data_parallel_model=None):
+    for metric in metrics:
+        metric.on_epoch_start(epoch=epoch, partition=partition)
+    if hasattr(model, 'on_epoch_start'):
+        model.on_epoch_start(partition=partition, epoch=epoch, loader=loader, tensorboard=tensorboard)
+
+    epoch_losses = defaultdict(list)
+    for (batch_data, batch_labels) in tqdm(loader, desc='{} epoch {}'.format(partition, epoch)):
+        if not isinstance(batch_data, list):
+            batch_data = [batch_data]
+        if not isinstance(batch_labels, list):
+            batch_labels = [batch_labels]
+
+        if data_parallel_model is not None:
+            outputs = data_parallel_model(inputs=batch_data, grad_enabled=training)
+        else:
+            outputs = model.forward(inputs=batch_data, grad_enabled=training)
+        # as in nnlib's loop, methods can use the dataset (e.g. VAE reverts its normalization) and the loader
+        batch_losses, outputs = model.compute_loss(inputs=batch_data, labels=batch_labels, outputs=outputs,
+                                                   grad_enabled=training, dataset=loader.dataset, loader=loader)
+        batch_total_loss = sum([loss for name, loss in batch_losses.items()])
+
+        if training:
+            optimizer.zero_grad()
+            batch_total_loss.backward()
+            if hasattr(model, 'before_weight_update'):
+                model.before_weight_update()
+            optimizer.step()
+
+        model.on_iteration_end(outputs=outputs, batch_losses=batch_losses, batch_labels=batch_labels,
+                               partition=partition, tensorboard=tensorboard)
+        for metric in metrics:
+            metric.on_iteration_end(outputs=outputs, batch_labels=batch_labels, partition=partition)
+        for name, loss in batch_losses.items():
+            epoch_losses[name].append(loss.detach())
+
+    for name, losses in epoch_losses.items():
+        epoch_losses[name] = float(torch.stack(losses).mean())
+        tensorboard.add_scalar('losses/{}_{}'.format(partition, name), epoch_losses[name], epoch)
+    if hasattr(model, 'on_epoch_end'):
+        model.on_epoch_end(partition=partition, epoch=epoch, loader=loader, tensorboard=tensorboard)
+    for metric in metrics:
+        metric.on_epoch_end(epoch=epoch, partition=partition, tensorboard=tensorboard)
+    return epoch_losses
+
+
+def train(model, train_loader, val_loader, epochs, save_iter=10, vis_iter=4, optimization_args=None,
+          log_dir=None, args_to_log=None, metrics=None, callbacks=None, stopper=None, device_ids=None,
+          resume=True, resume_iter=1, validation_schedule=None):
+    """ Trains the model. Same as nnlib's training.train, except that the run is continued from the latest
+    resume checkpoint in log_dir (if resume=True) and resume checkpoints are written every resume_iter epochs.
+    :param validation_schedule: decides after which epochs the full validation set is evaluated, see
+        modules/validation.py. Callbacks and the stopper are called only after these epochs. By default,
+        the validation set is evaluated after every epoch.
+    """
+    metrics = metrics or []
+    callbacks = callbacks or []
+    validation_schedule = validation_schedule or validation.EveryN(1)
+    optimization_args = optimization_args or {'optimizer': {'name': 'adam', 'lr': 1e-3}}
+    os.makedirs(os.path.join(log_dir, 'checkpoints'), exist_ok=True)
+
+    tensorboard = SummaryWriter(log_dir)
+    if args_to_log is not None:
+        tensorboard.add_text('script arguments', str(args_to_log))
+        with open(os.path.join(log_dir, 'args.pkl'), 'wb') as f:
+            pickle.dump(args_to_log, f)
+
+    optimizer = build_optimizer(model.parameters(), optimization_args['optimizer'])
+    scheduler = build_scheduler(optimizer, optimization_args.get('scheduler'))
+
+    data_parallel_model = None
+    if device_ids is not None and len(device_ids) > 1:
+        data_parallel_model = torch.nn.DataParallel(model, device_ids=device_ids)
+
+    loaders = [train_loader, val_loader]
+    start_epoch = 0
+    state = load_resume_checkpoint(log_dir) if resume else None
+    if state is not None:
+        restore(state, model, optimizer, scheduler, metrics, callbacks, stopper, loaders, validation_schedule)
+        start_epoch = epochs if state['stopped'] else state['epoch'] + 1
+        print("Resuming the training from epoch {}".format(state['epoch'] + 1))
+        del state
+
+    for epoch in range(start_epoch, epochs):
+        t0 = time.time()
+        model.train()
+        train_losses = run_partition(model=model, epoch=epoch, tensorboard=tensorboard, optimizer=optimizer,
+                                     loader=train_loader, partition='train', training=True, metrics=metrics,
+                                     data_parallel_model=data_parallel_model)
+        val_losses = {}
+        full_validation = True
+        if val_loader is not None:
+            model.eval()
+            subsample_value = None
+            if isinstance(validation_schedule, validation.SubsampleThenFull):
+                run_partition(model=model, epoch=epoch, tensorboard=tensorboard, optimizer=optimizer,
+                              loader=validation_schedule.subsample_loader, partition=validation.SUBSAMPLE_PARTITION,
+                              training=False, metrics=metrics, data_parallel_model=data_parallel_model)
+                subsample_value = validation_schedule.metric.value(epoch=epoch,
+                                                                   partition=validation.SUBSAMPLE_PARTITION)
+            full_validation = validation_schedule.is_full(epoch, epochs, subsample_value=subsample_value)
+            if full_validation:
+                val_losses = run_partition(model=model, epoch=epoch, tensorboard=tensorboard, optimizer=optimizer,
+                                           loader=val_loader, partition='val', training=False, metrics=metrics,
+                                           data_parallel_model=data_parallel_model)
+
+        log_string = 'Epoch: {}/{}, time: {:.1f}s'.format(epoch, epochs, time.time() - t0)
+        for partition, losses in [('train', train_losses), ('val', val_losses)]:
+            for name, value in losses.items():
+                log_string += ', {}_{}: {:.4f}'.format(partition, name, value)
+        print(log_string)
+
+        if (epoch + 1) % vis_iter == 0 and hasattr(model, 'visualize'):
+            visualizations = model.visualize(train_loader, val_loader, tensorboard=tensorboard, epoch=epoch)
+            for name, fig in (visualizations or {}).items():
+                tensorboard.add_figure(name, fig, epoch)
+
+        if (epoch + 1) % save_iter == 0:
+            utils.save(model, os.path.join(log_dir, 'checkpoints', 'epoch{}.mdl'.format(epoch)))
+
+        # callbacks reading the validation metrics (e.g. SaveBestWithMetric) and the stopper are called only
+        # after full evaluations, callbacks with every_epoch=True (e.g. periodic checkpoints) after every epoch
+        should_stop = False
+        for callback in callbacks:
+            if full_validation or getattr(callback, 'every_epoch', False):
+                callback.call(epoch=epoch, model=model, optimizer=optimizer, scheduler=scheduler, log_dir=log_dir)
+        if full_validation:
+            should_stop = (stopper is not None) and stopper.call(epoch=epoch)
+
+        tensorboard.add_scalar('hyper-parameters/lr', scheduler.get_last_lr()[0], epoch)
+        scheduler.step()
+
+        if (epoch + 1) % resume_iter == 0 or should_stop or epoch + 1 == epochs:
+            save_resume_checkpoint(log_dir, epoch, model, optimizer, scheduler, metrics, callbacks, stopper, loaders,
+                                   validation_schedule=validation_schedule, stopped=should_stop)
+
+        if should_stop:
+            print("Finishing the training at epoch {}...".format(epoch))
+            break
+
+    model.eval()
+    utils.save(model, os.path.join(log_dir, 'checkpoints', 'final.mdl'))
+    tensorboard.close()
+    return model, optimizer, scheduler
@@ -0,0 +1,110 @@
+""" Validation schedules.
+
+By default the full validation set is evaluated after every epoch. A validation schedule decides after
+which epochs to do so:
+    EveryN                 every n epochs,
+    Geometric              at epochs spaced geometrically (dense at the start, sparse later),
+    SubsampleThenFull      a fixed random subsample of the validation set every epoch, and the full set
+                           only when the subsample accuracy is close to its best value so far.
+The last epoch is always fully evaluated. modules/training.train calls the callbacks that read the validation
+metric (e.g. SaveBestWithMetric) and the stopper only after full evaluations, so that the best model is always
+chosen on the full validation metric. Callbacks with every_epoch=True (periodic checkpoints) run every epoch. Early stopping with stopping_param still counts epochs, it can only trigger at the first
+full evaluation after the patience runs out.
+"""
+import torch
+
+
+SUBSAMPLE_PARTITION = 'val_subsample'
+
+
+class EveryN(object):
+    def __init__(self, n=1):
+        assert n >= 1
+        self.n = n
+
+    def is_full(self, epoch, epochs, **kwargs):
+        return (epoch + 1) % self.n == 0 or epoch + 1 == epochs
+
+
+class Geometric(object):
+    """ Full evaluations after epochs round(start * ratio^i) - 1, and at least every max_gap epochs. """
+    def __init__(self, start=1, ratio=1.1, max_gap=None):
+        assert start >= 1 and ratio > 1.0
+        self.ratio = ratio
+        self.max_gap = max_gap
+        self._next = float(start)
+        self._last_full = -1
+
+    def is_full(self, epoch, epochs, **kwargs):
+        n_epochs = epoch + 1
+        full = (n_epochs >= round(self._next) or n_epochs == epochs or
+                (self.max_gap is not None and epoch - self._last_full >= self.max_gap))
+        while round(self._next) <= n_epochs:
+            self._next *= self.ratio
+        if full:
+            self._last_full = epoch
+        return full
+
+
+class SubsampleThenFull(object):
+    """ Evaluates a fixed subsample of the validation set every epoch (as partition 'val_subsample'). The full
+    validation set is evaluated when the subsample metric is within `margin` of its best value so far, and at
+    least every max_gap epochs, so that the stopper keeps getting full evaluations.
+    """
+    def __init__(self, subsample_loader, metric, direction='max', margin=0.0, max_gap=50):
+        assert direction in ['min', 'max']
+        self.subsample_loader = subsample_loader
+        self.metric = metric
+        self.direction = direction
+        self.margin = margin
+        self.max_gap = max_gap
+        self.best_value = None
+        self._last_full = -1
+
+    def is_full(self, epoch, epochs, subsample_value=None, **kwargs):
+        value = subsample_value
+        if self.direction == 'min':
+            value = -value
+        promising = self.best_value is None or value >= self.best_value - self.margin
+        if self.best_value is None or value > self.best_value:
+            self.best_value = value
+        full = (promising or epoch + 1 == epochs or
+                (self.max_gap is not None and epoch - self._last_full >= self.max_gap))
+        if full:
+            self._last_full = epoch
+        return full
+
+
+def make_subsample_loader(val_loader, size, seed=42):
+    """ Loader of a fixed random subset of the validation set. """
+    dataset = val_loader.dataset
+    generator = torch.Generator()
+    generator.manual_seed(seed)
+    indices = torch.randperm(len(dataset), generator=generator)[:size].sort().values.tolist()
+    return torch.utils.data.DataLoader(torch.utils.data.Subset(dataset, indices), batch_size=val_loader.batch_size,
+                                       shuffle=False, num_workers=getattr(val_loader, 'num_workers', 0))
+
+
+def add_validation_arguments(parser):
+    parser.add_argument('--val_schedule', type=str, default='every', choices=['every', 'geometric', 'subsample'],
+                        help='when to evaluate the full validation set, see modules/validation.py')
+    parser.add_argument('--val_every', type=int, default=1, help='with --val_schedule every')
+    parser.add_argument('--val_ratio', type=float, default=1.1, help='with --val_schedule geometric')
+    parser.add_argument('--val_subsample_size', type=int, default=1000, help='with --val_schedule subsample')
+    parser.add_argument('--val_margin', type=float, default=0.0,
+                        help='with --val_schedule subsample, how far below its best the subsample metric can be '
+                             'for a full evaluation to be made')
+    parser.add_argument('--val_max_gap', type=int, default=50,
+                        help='maximum number of epochs between full evaluations (geometric and subsample)')
+
+
+def make_validation_schedule(args, val_loader, metric, direction='max'):
+    if val_loader is None or args.val_schedule == 'every':
+        return EveryN(args.val_every)
+    if args.val_schedule == 'geometric':
+        return Geometric(start=1, ratio=args.val_ratio, max_gap=args.val_max_gap)
+    if args.val_schedule == 'subsample':
+        return SubsampleThenFull(make_subsample_loader(val_loader, args.val_subsample_size, seed=args.seed),
+                                 metric=metric, direction=direction, margin=args.val_margin,
+                                 max_gap=args.val_max_gap)
+    raise NotImplementedError("Validation schedule {} is not implemented".format(args.val_schedule))
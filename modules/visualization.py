@@ -3,7 +3,15 @@
 These visualization tools will note save figures. That can be later done by
 calling the savefig(fig, path) below. The purpose of this design is to make it
 possible to use these tools in both jupyter notebooks and in ordinary scripts.
+
+During training, methods describe their plots as a list of tasks (FigureTask, HistogramTask)
+that hold snapshots of the data to plot. The tasks are either rendered right away or, when
+modules.async_vis is enabled, sent to a background process (see render_tasks below).
 """
+import time
+import inspect
+
+import numpy as np
 import torch.nn.functional as F
 import torch
 
@@ -12,6 +20,9 @@ matplotlib.use('agg')
 from matplotlib import pyplot
 
 from nnlib.nnlib import utils
+from nnlib.nnlib.data_utils.base import revert_normalization
+from modules.data_utils import get_labels
+from modules import async_vis, inference
 import nnlib.nnlib.visualizations
 
 
@@ -20,112 +31,296 @@ reconstruction_plot = nnlib.nnlib.visualizations.reconstruction_plot
 manifold_plot = nnlib.nnlib.visualizations.manifold_plot
 latent_scatter = nnlib.nnlib.visualizations.latent_scatter
 latent_space_tsne = nnlib.nnlib.visualizations.latent_space_tsne
-plot_predictions = nnlib.nnlib.visualizations.plot_predictions
 
 # import some utils from nnlib visualizations
 get_image = nnlib.nnlib.visualizations.get_image
 savefig = nnlib.nnlib.visualizations.savefig
 
+# previous embeddings of latent_embedding_plot by log directory, kept by the process that renders the figures
+_embedding_state = {}
 
-def ce_gradient_norm_histogram(model, data_loader, tensorboard, epoch, name, max_num_examples=5000):
-    model.eval()
 
-    pred = utils.apply_on_dataset(model=model, dataset=data_loader.dataset,
-                                  output_keys_regexp='pred', description='grad-histogram:pred',
-                                  max_num_examples=max_num_examples)['pred']
-    n_examples = min(len(data_loader.dataset), max_num_examples)
-    labels = []
-    for idx in range(n_examples):
-        labels.append(data_loader.dataset[idx][1])
-    labels = torch.tensor(labels, dtype=torch.long)
-    labels = F.one_hot(labels, num_classes=model.num_classes).float()
-    labels = utils.to_cpu(labels)
+def clear_embedding_state(log_dir=None):
+    """ Forgets the previous embeddings of the given log directory (of all log directories if None). """
+    if log_dir is None:
+        _embedding_state.clear()
+    else:
+        _embedding_state.pop(log_dir, None)
 
-    grad_wrt_logits = torch.softmax(pred, dim=-1) - labels
-    grad_norms = torch.sum(grad_wrt_logits**2, dim=-1)
-    grad_norms = utils.to_numpy(grad_norms)
 
-    try:
-        tensorboard.add_histogram(tag=name, values=grad_norms, global_step=epoch)
-    except ValueError as e:
-        print("Tensorboard histogram error: {}".format(e))
+class InferenceCache(object):
+    """ Outputs of a model on the first `max_num_examples` examples of a dataset, computed with a
+    single pass over the data. All plots of one visualization epoch are made from such a cache.
+    """
+    def __init__(self, model, data_loader, output_keys, max_num_examples=5000, description='vis-cache'):
+        model.eval()
+        self.dataset = data_loader.dataset
+        self.num_classes = getattr(model, 'num_classes', None)
+        self.n_examples = min(len(self.dataset), max_num_examples)
+        output_keys_regexp = '^({})$'.format('|'.join(output_keys))
+        self.outputs = inference.apply_on_dataset(model=model, dataset=self.dataset,
+                                                  output_keys_regexp=output_keys_regexp,
+                                                  max_num_examples=max_num_examples,
+                                                  description=description)
+        self.labels = torch.tensor(get_labels(self.dataset, range(self.n_examples)), dtype=torch.long)
+
+    def __getitem__(self, key):
+        return self.outputs[key]
+
+    def ce_gradient(self):
+        """ Gradient of the cross-entropy loss with respect to the logits. """
+        labels = F.one_hot(self.labels, num_classes=self.num_classes).float()
+        labels = utils.to_cpu(labels)
+        return torch.softmax(self['pred'], dim=-1) - labels
+
+
+class FigureTask(object):
+    """ A figure to be made by calling `plot_function(*args, **kwargs)`, which should return (fig, plt).
+    The arguments should be snapshots (e.g. numpy arrays), so that the figure can be rendered later
+    or in another process.
+    """
+    def __init__(self, tag, plot_function, *args, **kwargs):
+        self.tag = tag
+        self.plot_function = plot_function
+        self.args = args
+        self.kwargs = kwargs
+
+    def snapshot(self):
+        return self
+
+    def make_figure(self):
+        fig, _ = self.plot_function(*self.args, **self.kwargs)
+        return fig
+
+    def render(self, tensorboard, epoch):
+        tensorboard.add_figure(tag=self.tag, figure=self.make_figure(), global_step=epoch)
+
+
+class HistogramTask(object):
+    """ A tensorboard histogram of the given numpy array. """
+    def __init__(self, tag, values):
+        self.tag = tag
+        self.values = values
+
+    def snapshot(self):
+        return self
+
+    def render(self, tensorboard, epoch):
+        try:
+            tensorboard.add_histogram(tag=self.tag, values=self.values, global_step=epoch)
+        except ValueError as e:
+            print("Tensorboard histogram error: {}".format(e))
+
 
+def render_tasks(tasks, tensorboard=None, epoch=None):
+    """ Renders visualization tasks. Returns a dictionary of figures that the training loop should log.
+    If asynchronous rendering is enabled, the tasks are handed to the background renderer of the log
+    directory of `tensorboard` and an empty dictionary is returned.
+    """
+    if tensorboard is not None and async_vis.is_enabled():
+        renderer = async_vis.get_renderer(tensorboard.get_logdir())
+        renderer.submit([task.snapshot() for task in tasks], epoch)
+        return {}
 
-def ce_gradient_pair_scatter(model, data_loader, d1=0, d2=1, max_num_examples=2000, plt=None):
+    visualizations = {}
+    for task in tasks:
+        if isinstance(task, HistogramTask):
+            if tensorboard is not None:
+                task.render(tensorboard, epoch)
+        else:
+            visualizations[task.tag] = task.make_figure()
+    return visualizations
+
+
+def pair_scatter(values, d1=0, d2=1, plt=None):
     if plt is None:
         plt = matplotlib.pyplot
-    model.eval()
-
-    pred = utils.apply_on_dataset(model=model, dataset=data_loader.dataset,
-                                  output_keys_regexp='pred',
-                                  max_num_examples=max_num_examples,
-                                  description='grad-pair-scatter:pred')['pred']
-    n_examples = min(len(data_loader.dataset), max_num_examples)
-    labels = []
-    for idx in range(n_examples):
-        labels.append(data_loader.dataset[idx][1])
-    labels = torch.tensor(labels, dtype=torch.long)
-    labels = F.one_hot(labels, num_classes=model.num_classes).float()
-    labels = utils.to_cpu(labels)
-    grad_wrt_logits = torch.softmax(pred, dim=-1) - labels
-    grad_wrt_logits = utils.to_numpy(grad_wrt_logits)
-
     fig, ax = plt.subplots(1, figsize=(5, 5))
-    plt.scatter(grad_wrt_logits[:, d1], grad_wrt_logits[:, d2])
+    ax.scatter(values[:, d1], values[:, d2])
     ax.set_xlabel(str(d1))
     ax.set_ylabel(str(d2))
-    # L = np.percentile(grad_wrt_logits, q=5, axis=0)
-    # R = np.percentile(grad_wrt_logits, q=95, axis=0)
+    # L = np.percentile(values, q=5, axis=0)
+    # R = np.percentile(values, q=95, axis=0)
     # ax.set_xlim(L[d1], R[d1])
     # ax.set_ylim(L[d2], R[d2])
     ax.set_title('Two coordinates of grad wrt to logits')
     return fig, plt
 
 
-def pred_gradient_norm_histogram(model, data_loader, tensorboard, epoch, name, max_num_examples=5000):
-    model.eval()
-    grad_pred = utils.apply_on_dataset(model=model, dataset=data_loader.dataset,
-                                       output_keys_regexp='grad_pred', description='grad-histogram:grad_pred',
-                                       max_num_examples=max_num_examples)['grad_pred']
-    grad_norms = torch.sum(grad_pred**2, dim=-1)
-    grad_norms = utils.to_numpy(grad_norms)
+def reconstruction_snapshot_plot(samples, x_rec, plt=None):
+    """ Layout of nnlib's reconstruction_plot, made from snapshots instead of a model: inputs with reverted
+    normalization next to their reconstructions, both numpy arrays of shape (N, C, H, W).
+    """
+    if plt is None:
+        plt = matplotlib.pyplot
+    n_samples = samples.shape[0]
+    fig, ax = plt.subplots(nrows=n_samples, ncols=2, figsize=(2, n_samples), squeeze=False)
+    for i in range(n_samples):
+        ax[i][0].imshow(get_image(samples[i]), vmin=0, vmax=1)
+        ax[i][0].set_axis_off()
+        ax[i][1].imshow(get_image(x_rec[i]), vmin=0, vmax=1)
+        ax[i][1].set_axis_off()
+    return fig, plt
 
-    try:
-        tensorboard.add_histogram(tag=name, values=grad_norms, global_step=epoch)
-    except ValueError as e:
-        print("Tensorboard histogram error: {}".format(e))
+
+def manifold_snapshot_plot(decoded, plt=None):
+    """ Layout of nnlib's manifold_plot, made from the decoded images of a grid of latent codes, a numpy
+    array of shape (n_points, n_points, C, H, W).
+    """
+    if plt is None:
+        plt = matplotlib.pyplot
+    n1, n2, c, h, w = decoded.shape
+    image = decoded.transpose(2, 0, 3, 1, 4).reshape(c, n1 * h, n2 * w)
+    fig, ax = plt.subplots(1, figsize=(10, 10))
+    ax.imshow(get_image(image), vmin=0, vmax=1)
+    ax.axis('off')
+    return fig, plt
 
 
-def pred_gradient_pair_scatter(model, data_loader, d1=0, d2=1, max_num_examples=2000, plt=None):
+def latent_scatter_snapshot_plot(z, labels, d1=0, d2=1, plt=None):
+    """ Layout of nnlib's latent_scatter, made from latent codes z of shape (N, hidden_dim) and their labels. """
     if plt is None:
         plt = matplotlib.pyplot
-    model.eval()
-    grad_pred = utils.apply_on_dataset(model=model, dataset=data_loader.dataset,
-                                       output_keys_regexp='grad_pred',
-                                       max_num_examples=max_num_examples,
-                                       description='grad-pair-scatter:grad_pred')['grad_pred']
-    grad_pred = utils.to_numpy(grad_pred)
-    fig, ax = plt.subplots(1, figsize=(5, 5))
-    plt.scatter(grad_pred[:, d1], grad_pred[:, d2])
-    ax.set_xlabel(str(d1))
-    ax.set_ylabel(str(d2))
-    # L = np.percentile(grad_pred, q=5, axis=0)
-    # R = np.percentile(grad_pred, q=95, axis=0)
-    # ax.set_xlim(L[d1], R[d1])
-    # ax.set_ylim(L[d2], R[d2])
-    ax.set_title('Two coordinates of grad wrt to logits')
+    fig, ax = plt.subplots(1)
+    legend = []
+    for c in np.unique(labels):
+        mask = (labels == c)
+        ax.scatter(z[mask, d1], z[mask, d2], s=5, color='C{}'.format(c % 10))
+        legend.append(str(c))
+    fig.legend(legend)
+    ax.set_xlabel("$Z_{}$".format(d1))
+    ax.set_ylabel("$Z_{}$".format(d2))
+    ax.set_title('Latent space')
+    return fig, plt
+
+
+def predictions_plot(samples, probs, labels, plt=None):
+    """ Layout of nnlib's plot_predictions, made from snapshots instead of a model: examples with reverted
+    normalization next to the predicted class probabilities.
+    """
+    if plt is None:
+        plt = matplotlib.pyplot
+    n_examples, num_classes = probs.shape
+    fig, ax = plt.subplots(nrows=n_examples, ncols=2, figsize=(2 * 2, 2 * n_examples), squeeze=False)
+    for i in range(n_examples):
+        ax[i][0].imshow(get_image(samples[i]), vmin=0, vmax=1)
+        ax[i][0].set_axis_off()
+        ax[i][0].set_title('labeled as {}'.format(labels[i]))
+        ax[i][1].bar(range(num_classes), probs[i])
+        ax[i][1].set_xticks(range(num_classes))
     return fig, plt
 
 
+def ce_gradient_norm_histogram(cache, name):
+    grad_wrt_logits = cache.ce_gradient()
+    grad_norms = torch.sum(grad_wrt_logits**2, dim=-1)
+    return HistogramTask(name, utils.to_numpy(grad_norms))
+
+
+def ce_gradient_pair_scatter(cache, name, d1=0, d2=1, max_num_examples=2000):
+    grad_wrt_logits = utils.to_numpy(cache.ce_gradient()[:max_num_examples])
+    return FigureTask(name, pair_scatter, values=grad_wrt_logits, d1=d1, d2=d2)
+
+
+def pred_gradient_norm_histogram(cache, name):
+    grad_norms = torch.sum(cache['grad_pred']**2, dim=-1)
+    return HistogramTask(name, utils.to_numpy(grad_norms))
+
+
+def pred_gradient_pair_scatter(cache, name, d1=0, d2=1, max_num_examples=2000):
+    grad_pred = utils.to_numpy(cache['grad_pred'][:max_num_examples])
+    return FigureTask(name, pair_scatter, values=grad_pred, d1=d1, d2=d2)
+
+
+def plot_predictions(cache, name, key='pred', n_examples=10):
+    """ Plots the first few examples of the dataset next to the predicted class probabilities. """
+    n_examples = min(n_examples, cache.n_examples)
+    probs = utils.to_numpy(torch.softmax(cache[key][:n_examples], dim=1))
+    labels = utils.to_numpy(cache.labels[:n_examples])
+    samples = torch.stack([cache.dataset[i][0] for i in range(n_examples)], dim=0)
+    samples = utils.to_numpy(revert_normalization(samples, cache.dataset))
+    return FigureTask(name, predictions_plot, samples=samples, probs=probs, labels=labels)
+
+
 def plot_confusion_matrix(Q, plt=None):
     if plt is None:
         plt = matplotlib.pyplot
+    if torch.is_tensor(Q):
+        Q = utils.to_numpy(Q)
     num_classes = Q.shape[0]
     fig, ax = plt.subplots(1, figsize=(5, 5))
-    im = ax.imshow(utils.to_numpy(Q))
+    im = ax.imshow(Q)
     fig.colorbar(im)
     ax.set_xticks(range(num_classes))
     ax.set_yticks(range(num_classes))
     ax.set_xlabel('observed')
     ax.set_ylabel('true')
     return fig, plt
+
+
+def stratified_subsample(labels, n, seed=42):
+    """ Indices of about n examples with the same fraction of examples from every class. The same indices
+    are returned for the same labels and seed, so that successive embeddings are made of the same points.
+    """
+    labels = np.asarray(labels)
+    if labels.shape[0] <= n:
+        return np.arange(labels.shape[0])
+    rng = np.random.RandomState(seed)
+    fraction = n / labels.shape[0]
+    indices = []
+    for c in np.unique(labels):
+        class_indices = np.where(labels == c)[0]
+        size = max(1, int(round(fraction * class_indices.shape[0])))
+        indices.append(rng.choice(class_indices, size=size, replace=False))
+    return np.sort(np.concatenate(indices))
+
+
+def pca(x, n_components=50):
+    """ Projection of the rows of x on their top principal components. """
+    x = x - x.mean(axis=0, keepdims=True)
+    if x.shape[1] <= n_components:
+        return x
+    _, _, vt = np.linalg.svd(x, full_matrices=False)
+    return x @ vt[:n_components].T
+
+
+def fast_tsne(z, key=None, time_budget=10.0, pca_dim=50, seed=42):
+    """ Barnes-Hut t-SNE of z after PCA. If the previous embedding stored under `key` (the log directory of
+    the run) has the same number of points (see stratified_subsample), it is used as initialization and the
+    number of iterations is chosen so that the embedding takes about time_budget seconds, given the speed of
+    the previous one. With key=None nothing is stored.
+    """
+    from sklearn.manifold import TSNE
+    x = pca(np.asarray(z, dtype=np.float32), n_components=pca_dim)
+    previous = _embedding_state.get(key) if key is not None else None
+    if previous is not None and previous['embedding'].shape[0] == x.shape[0]:
+        init = previous['embedding']
+        n_iter = int(np.clip(time_budget / previous['seconds_per_iter'], 250, 1000))
+        early_exaggeration = 1.0  # the previous embedding is already well separated
+    else:
+        init = 'pca'
+        n_iter = 500
+        early_exaggeration = 12.0
+    # the number of iterations was renamed in newer versions of scikit-learn
+    iter_arg = 'max_iter' if 'max_iter' in inspect.signature(TSNE.__init__).parameters else 'n_iter'
+
+    t0 = time.time()
+    embedding = TSNE(n_components=2, init=init, method='barnes_hut', early_exaggeration=early_exaggeration,
+                     random_state=seed, n_jobs=-1, **{iter_arg: n_iter}).fit_transform(x)
+    if key is not None:
+        _embedding_state[key] = {
+            'embedding': embedding.astype(np.float32),
+            'seconds_per_iter': max(time.time() - t0, 1e-3) / n_iter
+        }
+    return embedding
+
+
+def latent_embedding_plot(z, labels, key=None, time_budget=10.0, plt=None):
+    """ Fast t-SNE embedding of latent representations colored by labels, see fast_tsne. """
+    if plt is None:
+        plt = matplotlib.pyplot
+    embedding = fast_tsne(z, key=key, time_budget=time_budget)
+    fig, ax = plt.subplots(1, figsize=(7, 7))
+    sc = ax.scatter(embedding[:, 0], embedding[:, 1], c=labels, s=3, cmap='tab10')
+    fig.colorbar(sc)
+    return fig, plt
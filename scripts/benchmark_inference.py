@@ -0,0 +1,77 @@
+""" Checks that the inference optimizations of modules/inference.py preserve the outputs of ResNet18-k
+and measures CPU throughput with and without them, for several widths k.
+
+Example:
+    python -m scripts.benchmark_inference --ks 2 4 8 16 32 64 -b 128 --threads 8 --jit
+"""
+import time
+import argparse
+
+import torch
+
+from modules.resnet18_double_descent import make_resnet18k
+from modules import inference
+
+
+def randomize_batch_norms(net, generator):
+    """ Non-trivial BatchNorm statistics and parameters, so that folding is actually tested. """
+    for module in net.modules():
+        if isinstance(module, torch.nn.BatchNorm2d):
+            n = module.num_features
+            module.running_mean.copy_(0.1 * torch.randn(n, generator=generator))
+            module.running_var.copy_(0.5 + torch.rand(n, generator=generator))
+            module.weight.data.copy_(1.0 + 0.1 * torch.randn(n, generator=generator))
+            module.bias.data.copy_(0.1 * torch.randn(n, generator=generator))
+
+
+def measure_throughput(net, x, n_warmup, n_iters):
+    """ Examples per second. """
+    for _ in range(n_warmup):
+        net(x)
+    t0 = time.perf_counter()
+    for _ in range(n_iters):
+        net(x)
+    return n_iters * x.shape[0] / (time.perf_counter() - t0)
+
+
+@torch.no_grad()
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--ks', type=int, nargs='+', default=[1, 2, 4, 8, 16, 32, 64])
+    parser.add_argument('--batch_size', '-b', type=int, default=128)
+    parser.add_argument('--threads', type=int, default=None, help='number of torch threads')
+    parser.add_argument('--n_warmup', type=int, default=3)
+    parser.add_argument('--n_iters', type=int, default=10)
+    parser.add_argument('--jit', action='store_true', dest='jit', help='also trace and freeze the network')
+    parser.set_defaults(jit=False)
+    parser.add_argument('--tolerance', type=float, default=1e-4, help='maximum relative error of the outputs')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+    print(args)
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    generator = torch.Generator()
+    generator.manual_seed(args.seed)
+    x = torch.randn((args.batch_size, 3, 32, 32), generator=generator)
+
+    print("{:>4} {:>12} {:>12} {:>8} {:>10}".format('k', 'baseline/s', 'optimized/s', 'speedup', 'rel. error'))
+    for k in args.ks:
+        torch.manual_seed(args.seed)
+        net = make_resnet18k(k=k, num_classes=10)
+        randomize_batch_norms(net, generator)
+        net.eval()
+        optimized_net = inference.optimize_network(net, channels_last=True, jit=args.jit, example_input=x)
+
+        expected = net(x)
+        error = float((optimized_net(x) - expected).abs().max() / expected.abs().max().clamp(min=1e-12))
+        assert error < args.tolerance, 'k={}: the optimized network differs, relative error {}'.format(k, error)
+
+        baseline_speed = measure_throughput(net, x, args.n_warmup, args.n_iters)
+        optimized_speed = measure_throughput(optimized_net, x, args.n_warmup, args.n_iters)
+        print("{:>4} {:>12.1f} {:>12.1f} {:>8.2f} {:>10.2e}".format(
+            k, baseline_speed, optimized_speed, optimized_speed / baseline_speed, error))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+""" Benchmarks result aggregation and model selection of modules/result_utils.py on a synthetic
+results table. With --compare_legacy, the previous row-wise implementations are also timed on a
+subsample of the table and their outputs are checked to match the vectorized ones.
+"""
+import time
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from modules import result_utils
+
+
+def make_synthetic_results(n_rows, n_seeds=5, seed=0):
+    """ Creates a results table with the columns used by result_utils, `n_seeds` runs per configuration. """
+    rng = np.random.RandomState(seed)
+    n_configs = n_rows // n_seeds
+
+    model_class = rng.choice(['StandardClassifier', 'PredictGradOutput', 'PenalizeLastLayerFixedForm'], n_configs)
+    loss_function = np.where(model_class == 'StandardClassifier',
+                             rng.choice(['ce', 'mae', 'fw', 'dmi'], n_configs), 'ce')
+    configs = pd.DataFrame({
+        'model_class': model_class,
+        'config': rng.choice(['configs/4layer-cnn-mnist.json', 'configs/double-resnet-cifar10.json'], n_configs),
+        'loss_function': loss_function,
+        'q_dist': rng.choice(['Gaussian', 'Laplace'], n_configs),
+        'sample_from_q': rng.rand(n_configs) < 0.2,
+        'detach': rng.choice([0.0, 1.0], n_configs, p=[0.1, 0.9]),
+        'add_noise': rng.choice([0.0, 1.0], n_configs),
+        'noise_type': rng.choice(['Gaussian', 'Laplace'], n_configs),
+        'warm_up': rng.choice([0, 5], n_configs, p=[0.9, 0.1]),
+        'is_loaded': rng.rand(n_configs) < 0.1,
+        'method_name': 'unknown',
+        # each configuration gets a unique value of lr, so that all configurations are distinct
+        'grad_l1_penalty': 0.0,
+        'grad_weight_decay': rng.choice([0.0, 0.1, 0.3, 1.0, 3.0, 10.0], n_configs),
+        'lamb': 1.0,
+        'loss_function_param': 1.0,
+        'noise_std': rng.choice([0.0, 0.01, 0.1], n_configs),
+        'lr': 1e-3 + np.arange(n_configs) * 1e-9,
+        'weight_decay': 0.0,
+        'dataset': rng.choice(['uniform-noise-cifar10', 'pair-noise-cifar10', 'uniform-noise-cifar100'], n_configs),
+        'label_noise_level': rng.choice([0.0, 0.2, 0.4, 0.6, 0.8], n_configs),
+        'label_noise_type': 'error',
+        'num_train_examples': 'N/A',
+        'remove_prob': 0.5,
+        'transform_function': 'N/A',
+        'data_augmentation': rng.rand(n_configs) < 0.5,
+    })
+
+    df = configs.loc[configs.index.repeat(n_seeds)].reset_index(drop=True)
+    df['seed'] = np.tile(np.arange(42, 42 + n_seeds), n_configs)
+    df['log_dir'] = 'logs/run' + df.index.astype(str)
+    df['val_accuracy'] = rng.rand(len(df))
+    df['test_accuracy'] = rng.rand(len(df))
+    return df
+
+
+def legacy_fill_short_names(df):
+    for idx, row in df.iterrows():
+        df.at[idx, 'method_name'] = result_utils.infer_method_name(row)
+    return df
+
+
+def legacy_get_agg_results(df):
+    grouped = df.groupby(result_utils.method_columns + result_utils.hparam_columns + result_utils.data_columns)
+    for key, item in grouped:
+        group = grouped.get_group(key)
+        assert len(group) <= 5
+        assert len(set(group['seed'])) == len(group)
+    agg_results = grouped.agg({'test_accuracy': ['mean', 'std'], 'val_accuracy': ['mean', 'std']})
+    agg_results = agg_results.reset_index()
+    agg_results.columns = ['_'.join(tup).rstrip('_') for tup in agg_results.columns.values]
+    return agg_results
+
+
+def legacy_do_model_selection_by_val_score(df):
+    def select(group):
+        idx = group['val_accuracy_mean'].idxmax()
+        return group.loc[idx]
+    grouped = df.groupby(result_utils.method_columns + result_utils.data_columns)
+    return grouped.apply(select).reset_index(drop=True)
+
+
+def run(functions, df):
+    timings = {}
+    results = {}
+    for name, fn, input_name in functions:
+        data = df if input_name is None else results[input_name]
+        start = time.time()
+        results[name] = fn(data.copy())
+        timings[name] = time.time() - start
+        print("{:>40}: {:8.3f}s".format(name, timings[name]))
+    return results, timings
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--n_rows', '-n', type=int, default=10**6)
+    parser.add_argument('--compare_legacy', action='store_true', dest='compare_legacy')
+    parser.set_defaults(compare_legacy=False)
+    parser.add_argument('--legacy_n_rows', type=int, default=2 * 10**4,
+                        help='size of the subsample on which the legacy implementation is run')
+    args = parser.parse_args()
+    print(args)
+
+    df = make_synthetic_results(args.n_rows)
+    print("Synthetic results table: {} rows, {} columns".format(*df.shape))
+
+    vectorized = [
+        ('fill_short_names', result_utils.fill_short_names, None),
+        ('get_agg_results', result_utils.get_agg_results, 'fill_short_names'),
+        ('do_model_selection_by_val_score', result_utils.do_model_selection_by_val_score, 'get_agg_results'),
+    ]
+    print("Vectorized implementation:")
+    run(vectorized, df)
+
+    if args.compare_legacy:
+        small = df.iloc[:args.legacy_n_rows]
+        print("On a subsample of {} rows:".format(len(small)))
+        new_results, new_timings = run(vectorized, small)
+        legacy = [
+            ('fill_short_names', legacy_fill_short_names, None),
+            ('get_agg_results', legacy_get_agg_results, 'fill_short_names'),
+            ('do_model_selection_by_val_score', legacy_do_model_selection_by_val_score, 'get_agg_results'),
+        ]
+        print("Legacy implementation:")
+        old_results, old_timings = run(legacy, small)
+        for name, _, _ in legacy:
+            pd.testing.assert_frame_equal(new_results[name].reset_index(drop=True),
+                                          old_results[name].reset_index(drop=True),
+                                          check_dtype=False)
+            print("{:>40}: outputs match, speedup {:.1f}x".format(
+                name, old_timings[name] / max(new_timings[name], 1e-9)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+import os
+import argparse
+import pickle
+
+import numpy as np
+
+from nnlib.nnlib import utils
+from nnlib.nnlib.data_utils.base import load_data_from_arguments
+from modules import ensemble
+import methods
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--device', '-d', default='cuda')
+
+    parser.add_argument('--batch_size', '-b', type=int, default=256)
+    parser.add_argument('--seed', type=int, default=42)
+
+    parser.add_argument('--dataset', '-D', type=str, default='mnist',
+                        choices=['mnist', 'uniform-noise-mnist',
+                                 'cifar10', 'uniform-noise-cifar10', 'pair-noise-cifar10',
+                                 'cifar100', 'uniform-noise-cifar100',
+                                 'clothing1m', 'imagenet'])
+    parser.add_argument('--data_augmentation', '-A', action='store_true', dest='data_augmentation')
+    parser.set_defaults(data_augmentation=False)
+    parser.add_argument('--num_train_examples', type=int, default=None)
+    parser.add_argument('--error_prob', '-n', type=float, default=0.0)
+    parser.add_argument('--clean_validation', dest='clean_validation', action='store_true')
+    parser.set_defaults(clean_validation=False)
+
+    parser.add_argument('--load_from', type=str, nargs='+', required=True,
+                        help='checkpoints of the ensemble members, e.g. one per seed')
+    parser.add_argument('--no-vectorize', dest='vectorize', action='store_false')
+    parser.set_defaults(vectorize=True)
+    parser.add_argument('--output_dir', '-o', type=str, default=None)
+
+    args = parser.parse_args()
+    print(args)
+
+    # Load data
+    _, _, test_loader, _ = load_data_from_arguments(args)
+
+    models = []
+    for path in args.load_from:
+        print(f"Loading the model saved at {path}")
+        models.append(utils.load(path, methods=methods, device=args.device))
+
+    stacked = ensemble.StackedEnsemble(models, output_key='pred', vectorize=args.vectorize)
+    preds, labels = ensemble.predict(stacked, test_loader.dataset, batch_size=args.batch_size,
+                                     device=args.device, description='Testing the ensemble')
+    results = ensemble.evaluate(preds, labels)
+
+    for path, accuracy in zip(args.load_from, results['per_model_accuracy']):
+        print("{}: {:.4f}".format(path, accuracy))
+    print("mean accuracy: {:.4f} +- {:.4f}".format(results['mean_accuracy'], results['std_accuracy']))
+    print("ensemble accuracy: {:.4f}".format(results['ensemble_accuracy']))
+    print("mean pairwise disagreement: {:.4f}".format(results['mean_pairwise_disagreement']))
+    print("fraction of examples with any disagreement: {:.4f}".format(results['any_disagreement']))
+    print("entropy of the averaged prediction: {:.4f}".format(results['ensemble_entropy']))
+    print("pairwise disagreement matrix:\n{}".format(np.round(results['pairwise_disagreement'], 4)))
+
+    if args.output_dir is not None:
+        results['load_from'] = args.load_from
+        with open(os.path.join(args.output_dir, 'ensemble_results.pkl'), 'wb') as f:
+            pickle.dump(results, f)
+        with open(os.path.join(args.output_dir, 'ensemble_test_accuracy.txt'), 'w') as f:
+            f.write("{}\n".format(results['ensemble_accuracy']))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,15 +1,103 @@
+""" Collects arguments and evaluation results of all runs in a log directory into one table.
+
+Run directories are read in parallel with a thread pool. A persistent index stores, for each run,
+the modification times and sizes of the files that were read, along with the extracted record.
+On subsequent calls only new or changed runs are read again. The table is written as a pickle by
+default, or in a columnar format (parquet or feather, chosen by the extension of --output). Columnar
+outputs store list-valued and mixed-type columns as strings.
+With --store, the newly read runs are also appended to a ResultStore (see modules/result_store.py).
+"""
 import os
 import pickle
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 
 import pandas as pd
 from tqdm import tqdm
 
 
+def get_signature(run_dir, file_names):
+    """ (mtime, size) of each file of the run, None for missing files. """
+    signature = []
+    for file_name in file_names:
+        try:
+            st = os.stat(os.path.join(run_dir, file_name))
+            signature.append((st.st_mtime_ns, st.st_size))
+        except FileNotFoundError:
+            signature.append(None)
+    return tuple(signature)
+
+
+def read_run(run_dir, eval_files, eval_names):
+    """ Returns the record of the run or None if some of the files are missing. """
+    instance = os.path.basename(run_dir)
+    args_file = os.path.join(run_dir, 'args.pkl')
+    if not os.path.exists(args_file):
+        print("===> args.pkl is missing: {}".format(instance))
+        return None
+    with open(args_file, 'rb') as f:
+        result = vars(pickle.load(f))
+
+    for file_path, name in zip(eval_files, eval_names):
+        full_file_path = os.path.join(run_dir, file_path)
+        if not os.path.exists(full_file_path):
+            print("===> {} is missing: {}".format(file_path, instance))
+            return None
+        with open(full_file_path, 'r') as f:
+            result[name] = float(f.read())
+    return result
+
+
+def process_run(run_dir, cached_entry, eval_files, eval_names):
+    """ Returns the index entry of the run, reusing the cached one if the files did not change. """
+    signature = get_signature(run_dir, ['args.pkl'] + list(eval_files))
+    if cached_entry is not None and cached_entry['signature'] == signature:
+        return cached_entry
+    try:
+        record = read_run(run_dir, eval_files, eval_names)
+    except Exception as e:
+        print(f"\n===> something unexpected went wrong!\n"
+              f"       instance: {os.path.basename(run_dir)}\n"
+              f"       error: {e}\n")
+        record = None
+    return {'signature': signature, 'record': record}
+
+
+def to_arrow_compatible(df):
+    """ Converts object columns with list values (e.g. all_device_ids, ks) or values of mixed types to
+    strings, since parquet and feather columns have one type. Missing values are kept.
+    """
+    df = df.copy()
+    for c in df.columns:
+        if df[c].dtype != object:
+            continue
+        types = set(type(v) for v in df[c].values if v is not None and not (isinstance(v, float) and v != v))
+        if len(types) > 1 or any(issubclass(t, (list, tuple, dict, set)) for t in types):
+            df[c] = [v if v is None or (isinstance(v, float) and v != v) else str(v) for v in df[c].values]
+    return df
+
+
+def write_table(df, path):
+    if path.endswith('.parquet'):
+        to_arrow_compatible(df).to_parquet(path, index=False)
+    elif path.endswith('.feather'):
+        to_arrow_compatible(df).reset_index(drop=True).to_feather(path)
+    else:
+        with open(path, 'wb') as f:
+            pickle.dump(df, f)
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('--log_dir', '-l', type=str, required=True)
-    parser.add_argument('--output', '-o', type=str, default='results.pkl')
+    parser.add_argument('--output', '-o', type=str, default='results.pkl',
+                        help='output table, .pkl, .parquet or .feather (the last two need pyarrow)')
+    parser.add_argument('--index', type=str, default=None,
+                        help='path of the persistent index of already read runs. '
+                             'By default it is stored next to the output.')
+    parser.add_argument('--store', type=str, default=None,
+                        help='if given, newly read runs are appended to the result store at this path')
+    parser.add_argument('--num_workers', '-j', type=int, default=32)
     parser.add_argument('--eval_files', '-f', nargs='+', type=str,
                         default=['test_accuracy.txt', 'best_val_result.txt'],
                         help='list of evaluation files to read and add to the df')
@@ -20,39 +108,48 @@ def main():
     print(args)
     assert len(args.eval_files) == len(args.eval_names)
 
-    logs = os.listdir(args.log_dir)
-    df = pd.DataFrame()
-    for instance in tqdm(logs):
-        if instance == '.gitkeep':
-            continue
-        try:
-            args_file = os.path.join(args.log_dir, instance, 'args.pkl')
-            if not os.path.exists(args_file):
-                print("===> args.pkl is missing: {}".format(instance))
-                continue
-            with open(args_file, 'rb') as f:
-                result = vars(pickle.load(f))
-
-            file_missing = False
-            for file_path, name in zip(args.eval_files, args.eval_names):
-                full_file_path = os.path.join(args.log_dir, instance, file_path)
-                if not os.path.exists(full_file_path):
-                    print("===> {} is missing: {}".format(file_path, instance))
-                    file_missing = True
-                    break
-                with open(full_file_path, 'r') as f:
-                    result[name] = float(f.read())
-
-            if not file_missing:
-                df = df.append(result, ignore_index=True)
-
-        except Exception as e:
-            print(f"\n===> something unexpected went wrong!\n"
-                  f"       instance: {instance}\n"
-                  f"       error: {e}\n")
-
-    with open(args.output, 'wb') as f:
-        pickle.dump(df, f)
+    index_path = args.index
+    if index_path is None:
+        index_path = os.path.splitext(args.output)[0] + '.index.pkl'
+
+    # the index is only valid for the same set of evaluation files
+    index_key = (os.path.abspath(args.log_dir), tuple(args.eval_files), tuple(args.eval_names))
+    index = {}
+    if os.path.exists(index_path):
+        with open(index_path, 'rb') as f:
+            stored = pickle.load(f)
+        if stored.get('key') == index_key:
+            index = stored['runs']
+
+    instances = sorted(entry.name for entry in os.scandir(args.log_dir)
+                       if entry.is_dir() and entry.name != '.gitkeep')
+
+    with ThreadPoolExecutor(max_workers=args.num_workers) as executor:
+        futures = [executor.submit(process_run, os.path.join(args.log_dir, instance), index.get(instance),
+                                   args.eval_files, args.eval_names)
+                   for instance in instances]
+        new_index = {}
+        for instance, future in tqdm(zip(instances, futures), total=len(instances)):
+            new_index[instance] = future.result()
+
+    n_reused = sum(1 for instance in instances if index.get(instance) is new_index[instance])
+    print("Read {} runs, reused {} runs from the index".format(len(instances) - n_reused, n_reused))
+
+    records = [entry['record'] for entry in new_index.values() if entry['record'] is not None]
+    df = pd.DataFrame.from_records(records)
+    write_table(df, args.output)
+
+    if args.store is not None:
+        from modules.result_store import ResultStore
+        new_records = [new_index[instance]['record'] for instance in instances
+                       if index.get(instance) is not new_index[instance]
+                       and new_index[instance]['record'] is not None]
+        n_appended = ResultStore(args.store).append(pd.DataFrame.from_records(new_records))
+        print("Appended {} runs to the result store {}".format(n_appended, args.store))
+
+    with open(index_path + '.tmp', 'wb') as f:
+        pickle.dump({'key': index_key, 'runs': new_index}, f)
+    os.replace(index_path + '.tmp', index_path)
 
 
 if __name__ == '__main__':
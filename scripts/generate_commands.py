@@ -2,6 +2,8 @@ import os
 import sys
 import random
 
+from modules import registry
+
 
 def merge_commands(commands, gpu_cnt=10, max_job_cnt=10000, shuffle=True, put_device_id=False):
     sys.stderr.write(f"Created {len(commands)} commands")
@@ -30,6 +32,10 @@ def check_exists(logdir):
 def process_command(command):
     arr = command.split(' ')
     logdir = arr[arr.index('-l') + 1]
+    status = registry.should_skip_command(command, registry.default_registry_path)
+    if status is not None:
+        sys.stderr.write(f"Skipping {logdir}, an equivalent experiment is {status}\n")
+        return []
     if check_exists(logdir):
         sys.stderr.write(f"Skipping {logdir}\n")
         return []
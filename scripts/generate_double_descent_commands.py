@@ -2,6 +2,8 @@ import os
 import sys
 import random
 
+from modules import registry
+
 
 def merge_commands(commands, gpu_cnt=10, max_job_cnt=10000, shuffle=True, put_device_id=False):
     sys.stderr.write(f"Created {len(commands)} commands")
@@ -30,6 +32,10 @@ def check_exists(logdir):
 def process_command(command):
     arr = command.split(' ')
     logdir = arr[arr.index('-l') + 1]
+    status = registry.should_skip_command(command, registry.default_registry_path)
+    if status is not None:
+        sys.stderr.write(f"Skipping {logdir}, an equivalent experiment is {status}\n")
+        return []
     if check_exists(logdir):
         sys.stderr.write(f"Skipping {logdir}\n")
         return []
@@ -37,6 +43,40 @@ def process_command(command):
         return [command]
 
 
+def final_model_exists(logdir):
+    root_dir = os.path.dirname(os.path.abspath(__file__))
+    return os.path.exists(os.path.join(root_dir, '../', logdir, 'checkpoints', 'final.mdl'))
+
+
+def chain_warm_start(commands_by_k):
+    """ Chains the commands of one width sweep in increasing order of k. Every command except the first warm-starts
+    from the final model of the previous width. The chain is one job (joined with &&, which merge_commands and
+    schedule_commands keep together). Finished steps are left out of the chain but their checkpoints are still used.
+    A skipped step whose final model does not exist is not used as a warm start: if the registry says it is running,
+    the chain stops there (the remaining widths are generated once it finishes), otherwise it is run again.
+    """
+    chain = []
+    previous_logdir = None
+    widths = sorted(commands_by_k.keys())
+    for i, k in enumerate(widths):
+        command = commands_by_k[k]
+        if previous_logdir is not None:
+            command += f" --warm_start_from {previous_logdir}/checkpoints/final.mdl"
+        arr = command.split(' ')
+        previous_logdir = arr[arr.index('-l') + 1]
+        step = process_command(command)
+        if len(step) == 0 and i + 1 < len(widths) and not final_model_exists(previous_logdir):
+            if registry.should_skip_command(command, registry.default_registry_path) == 'running':
+                sys.stderr.write(f"Stopping the chain at {previous_logdir}, its final model does not exist yet\n")
+                break
+            sys.stderr.write(f"Keeping {previous_logdir} in the chain, its final model does not exist\n")
+            step = [command + " --no-registry"]
+        chain += step
+    if len(chain) == 0:
+        return []
+    return [" && ".join(chain)]
+
+
 ########################################################################################################################
 ######################                       uniform-noise-cifar10                               #######################
 ########################################################################################################################
@@ -67,6 +107,23 @@ for n in ns:
 merge_commands(commands, gpu_cnt=10, max_job_cnt=1)
 
 
+""" Standard Classifier, widths trained in increasing order with Net2Net warm-starting """
+# method = "StandardClassifier"
+#
+# commands = []
+# for n in ns:
+#     for seed in seeds:
+#         commands_by_k = {}
+#         for k in ks:
+#             commands_by_k[k] = f"python -um scripts.train_classifier_double_descent -c {arch_config} -d {device} " \
+#                 f"-e {n_epochs} -s {save_iter} -v {vis_iter} -D {dataset} -n {n} -A -m {method} " \
+#                 f"--seed {seed} -k {k} " \
+#                 f"-l double_descent_logs/{dataset}-noise{n}-augment-{method}-k{k}-seed{seed}-warmstart"
+#         commands += chain_warm_start(commands_by_k)
+#
+# merge_commands(commands, gpu_cnt=10, max_job_cnt=1)
+
+
 """ PredictGradOutput """
 # method = "PredictGradOutput"
 # Ls = [1.0]
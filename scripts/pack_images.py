@@ -0,0 +1,149 @@
+""" Packs a split of an image dataset into memory-mapped uint8 shards (see modules/shards.py).
+
+Images are decoded once, resized so that the shorter side is --resize and center-cropped to --crop.
+Images that cannot be read are marked as failed in index.npz and left out by ShardedImageDataset.
+The list of images is either an annotation file with lines `relative/path.jpg label` (the format of the
+Clothing1M annotations, e.g. resources/clothing1m/dmi_annotations/clean_train.txt), or an ImageNet-style
+directory with one subdirectory per class (--image_folder).
+
+Examples:
+    python -m scripts.pack_images --root data/clothing1M -a resources/clothing1m/dmi_annotations/clean_train.txt \
+        --noisy_labels data/clothing1M/noisy_label_kv.txt -o data/clothing1m-packed/train -D clothing1m
+    python -m scripts.pack_images --image_folder data/imagenet/val -o data/imagenet-packed/val -D imagenet
+"""
+import os
+import json
+import argparse
+import multiprocessing
+
+import numpy as np
+from PIL import Image
+from tqdm import tqdm
+
+from modules.shards import get_shard_path
+
+
+def read_annotations(path):
+    paths = []
+    labels = []
+    with open(path, 'r') as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) < 2:
+                continue
+            paths.append(parts[0])
+            labels.append(int(parts[1]))
+    return paths, labels
+
+
+def read_image_folder(folder):
+    """ Lists images of an ImageNet-style folder. Classes are numbered in sorted order of the subdirectories,
+    as in torchvision.datasets.ImageFolder.
+    """
+    classes = sorted(entry.name for entry in os.scandir(folder) if entry.is_dir())
+    paths = []
+    labels = []
+    for label, class_name in enumerate(classes):
+        for file_name in sorted(os.listdir(os.path.join(folder, class_name))):
+            paths.append(os.path.join(class_name, file_name))
+            labels.append(label)
+    return paths, labels
+
+
+def load_image(path, resize, crop):
+    with Image.open(path) as image:
+        image = image.convert('RGB')
+        w, h = image.size
+        scale = resize / min(w, h)
+        image = image.resize((max(crop, round(w * scale)), max(crop, round(h * scale))), Image.BILINEAR)
+        w, h = image.size
+        left = (w - crop) // 2
+        top = (h - crop) // 2
+        image = image.crop((left, top, left + crop, top + crop))
+        return np.asarray(image, dtype=np.uint8)
+
+
+def _load_image_job(job):
+    """ Returns the image, or None if it cannot be read. """
+    path, resize, crop = job
+    try:
+        return load_image(path, resize, crop)
+    except (OSError, ValueError) as e:
+        print("Could not read {}: {}".format(path, e))
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--root', type=str, default='', help='directory the annotation paths are relative to')
+    parser.add_argument('--annotations', '-a', type=str, default=None, help='file with `path label` lines')
+    parser.add_argument('--image_folder', type=str, default=None, help='ImageNet-style class directories')
+    parser.add_argument('--noisy_labels', type=str, default=None,
+                        help='optional file with `path noisy_label` lines (e.g. noisy_label_kv.txt of Clothing1M)')
+    parser.add_argument('--output_dir', '-o', type=str, required=True)
+    parser.add_argument('--dataset', '-D', type=str, default=None, choices=[None, 'clothing1m', 'imagenet'])
+    parser.add_argument('--resize', type=int, default=256)
+    parser.add_argument('--crop', type=int, default=224)
+    parser.add_argument('--shard_size', type=int, default=4096)
+    parser.add_argument('--num_workers', '-j', type=int, default=16)
+    args = parser.parse_args()
+    print(args)
+    assert (args.annotations is None) != (args.image_folder is None), 'give either --annotations or --image_folder'
+
+    if args.annotations is not None:
+        paths, labels = read_annotations(args.annotations)
+        root = args.root
+    else:
+        paths, labels = read_image_folder(args.image_folder)
+        root = args.image_folder
+
+    noisy_labels = np.full(len(paths), -1, dtype=np.int64)
+    if args.noisy_labels is not None:
+        noisy_paths, noisy_values = read_annotations(args.noisy_labels)
+        noisy = dict(zip(noisy_paths, noisy_values))
+        noisy_labels = np.array([noisy.get(p, -1) for p in paths], dtype=np.int64)
+        print("{} of {} images have noisy labels".format((noisy_labels >= 0).sum(), len(paths)))
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    n = len(paths)
+    n_shards = (n + args.shard_size - 1) // args.shard_size
+    jobs = [(os.path.join(root, p), args.resize, args.crop) for p in paths]
+    failed = np.zeros(n, dtype=bool)
+    with multiprocessing.Pool(args.num_workers) as pool:
+        images = pool.imap(_load_image_job, jobs, chunksize=64)
+        for shard_idx in tqdm(range(n_shards), desc='Packing shards'):
+            start = shard_idx * args.shard_size
+            end = min(n, start + args.shard_size)
+            shard_path = get_shard_path(args.output_dir, shard_idx)
+            tmp_path = shard_path + '.tmp.npy'
+            shard = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.uint8,
+                                              shape=(end - start, args.crop, args.crop, 3))
+            for i in range(end - start):
+                image = next(images)
+                if image is None:
+                    # the slot stays zero and the example is excluded through the index
+                    failed[start + i] = True
+                    continue
+                shard[i] = image
+            shard.flush()
+            del shard
+            os.replace(tmp_path, shard_path)
+
+    if failed.any():
+        print("{} of {} images could not be read and are excluded".format(failed.sum(), n))
+
+    # the index and meta data are written last, a split without them is incomplete
+    np.savez(os.path.join(args.output_dir, 'index.npz'), labels=np.array(labels, dtype=np.int64),
+             noisy_labels=noisy_labels, paths=np.array(paths), failed=failed)
+    with open(os.path.join(args.output_dir, 'meta.json'), 'w') as f:
+        json.dump({
+            'n_examples': n,
+            'shard_size': args.shard_size,
+            'resolution': [args.crop, args.crop],
+            'resize': args.resize,
+            'dataset_name': args.dataset,
+        }, f)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,241 @@
+""" Runs generated training commands on the local machine with a fixed number of concurrent slots.
+
+The input is the output of scripts/generate_commands.py or scripts/generate_double_descent_commands.py
+(a file or stdin). Lines produced by merge_commands are split at '; ' back into single jobs, so that
+jobs are taken from one shared queue whenever a slot becomes free, instead of running in fixed chains.
+
+Each slot owns a disjoint set of CPU cores and, optionally, one GPU. Jobs of a slot are pinned to its
+cores, get OMP/MKL thread budgets equal to the number of cores (which torch uses as its default number
+of threads) and see only the GPU of the slot through CUDA_VISIBLE_DEVICES. Failed jobs are retried.
+Finished jobs are recorded in a journal, so restarting the scheduler with the same journal skips them.
+
+Example:
+    python -m scripts.generate_commands > commands.txt
+    python -m scripts.schedule_commands -i commands.txt --slots 4 --gpus 0 1 --journal logs/schedule.jsonl
+"""
+import os
+import re
+import sys
+import json
+import time
+import hashlib
+import argparse
+import subprocess
+
+
+def read_jobs(input_file):
+    """ Reads commands, splitting chains created by merge_commands. Duplicates are removed, order is kept. """
+    if input_file == '-':
+        lines = sys.stdin.readlines()
+    else:
+        with open(input_file, 'r') as f:
+            lines = f.readlines()
+    jobs = []
+    for line in lines:
+        for command in line.strip().split('; '):
+            command = command.strip()
+            if len(command) > 0 and not command.startswith('#'):
+                jobs.append(command)
+    return list(dict.fromkeys(jobs))
+
+
+def job_id(command):
+    return hashlib.sha1(command.encode('utf-8')).hexdigest()[:16]
+
+
+def read_journal(journal_path):
+    """ Returns job_id -> last recorded event. """
+    events = {}
+    if journal_path is None or not os.path.exists(journal_path):
+        return events
+    with open(journal_path, 'r') as f:
+        for line in f:
+            try:
+                event = json.loads(line)
+            except json.JSONDecodeError:  # a partially written line of an interrupted run
+                continue
+            events[event['job_id']] = event
+    return events
+
+
+def make_slots(n_slots, cores_per_slot=None, gpus=None):
+    """ Splits the available cores into disjoint sets and assigns GPUs to slots round robin. """
+    if hasattr(os, 'sched_getaffinity'):
+        cores = sorted(os.sched_getaffinity(0))
+    else:
+        cores = list(range(os.cpu_count()))
+    if cores_per_slot is None:
+        cores_per_slot = max(1, len(cores) // n_slots)
+    slots = []
+    for i in range(n_slots):
+        slot_cores = cores[i * cores_per_slot:(i + 1) * cores_per_slot]
+        if len(slot_cores) == 0:  # more slots than cores, share them
+            slot_cores = [cores[i % len(cores)]]
+        slots.append({
+            'index': i,
+            'cores': slot_cores,
+            'gpu': None if not gpus else gpus[i % len(gpus)],
+            'process': None,
+            'job': None,
+            'started': None,
+            'busy_time': 0.0,
+            'log_file': None,
+        })
+    return slots
+
+
+def start_job(slot, job, job_log_dir):
+    command = job['command']
+    env = os.environ.copy()
+    n_threads = str(len(slot['cores']))
+    env['OMP_NUM_THREADS'] = n_threads
+    env['MKL_NUM_THREADS'] = n_threads
+    if slot['gpu'] is not None:
+        env['CUDA_VISIBLE_DEVICES'] = str(slot['gpu'])
+        # the only visible device is the slot's GPU
+        command = re.sub(r'cuda:\d+', 'cuda', command)
+
+    cores = set(slot['cores'])
+
+    def pin_to_cores():
+        if hasattr(os, 'sched_setaffinity'):
+            os.sched_setaffinity(0, cores)
+
+    log_path = os.path.join(job_log_dir, '{}.log'.format(job['id']))
+    log_file = open(log_path, 'a')
+    log_file.write("\n===> attempt {}: {}\n".format(job['attempt'], command))
+    log_file.flush()
+    slot['process'] = subprocess.Popen(command, shell=True, env=env, stdout=log_file, stderr=subprocess.STDOUT,
+                                       preexec_fn=pin_to_cores)
+    slot['job'] = job
+    slot['started'] = time.time()
+    slot['log_file'] = log_file
+
+
+def write_event(journal, job, status, returncode=None, duration=None, slot=None):
+    if journal is None:
+        return
+    event = {'job_id': job['id'], 'command': job['command'], 'status': status, 'attempt': job['attempt'],
+             'returncode': returncode, 'duration': duration, 'slot': slot, 'time': time.time()}
+    journal.write(json.dumps(event) + '\n')
+    journal.flush()
+    os.fsync(journal.fileno())
+
+
+def report(slots, n_total, n_done, n_failed, n_pending, start_time):
+    elapsed = max(time.time() - start_time, 1e-9)
+    now = time.time()
+    utilization = []
+    for slot in slots:
+        busy = slot['busy_time'] + (now - slot['started'] if slot['job'] is not None else 0.0)
+        utilization.append(busy / elapsed)
+    n_running = sum(1 for slot in slots if slot['job'] is not None)
+    print("[{:8.0f}s] done {}/{}, failed {}, running {}, pending {} | slot utilization: {} (mean {:.0%})".format(
+        elapsed, n_done, n_total, n_failed, n_running, n_pending,
+        ' '.join('{:.0%}'.format(u) for u in utilization), sum(utilization) / len(utilization)), flush=True)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input', '-i', type=str, default='-', help='file with commands, stdin by default')
+    parser.add_argument('--slots', '-j', type=int, default=1, help='number of concurrent jobs')
+    parser.add_argument('--cores_per_slot', type=int, default=None,
+                        help='by default the available cores are divided equally between slots')
+    parser.add_argument('--gpus', type=int, nargs='+', default=None,
+                        help='GPU ids, assigned to slots round robin')
+    parser.add_argument('--max_retries', type=int, default=2)
+    parser.add_argument('--journal', type=str, default='logs/schedule.jsonl',
+                        help='record of finished jobs, used to resume after a restart')
+    parser.add_argument('--job_log_dir', type=str, default='logs/schedule_outputs')
+    parser.add_argument('--report_every', type=float, default=60.0, help='seconds between progress reports')
+    parser.add_argument('--poll_interval', type=float, default=1.0)
+    parser.add_argument('--dry_run', action='store_true', dest='dry_run')
+    parser.set_defaults(dry_run=False)
+    args = parser.parse_args()
+    print(args)
+
+    commands = read_jobs(args.input)
+    events = read_journal(args.journal)
+    pending = []
+    n_done = 0
+    for command in commands:
+        jid = job_id(command)
+        last = events.get(jid)
+        if last is not None and last['status'] == 'done':
+            n_done += 1
+            continue
+        # attempts of jobs that failed before the restart are counted
+        attempt = 0 if last is None else last['attempt'] + (last['status'] == 'failed')
+        if attempt > args.max_retries:
+            print("Skipping job that failed {} times: {}".format(attempt, command))
+            continue
+        pending.append({'id': jid, 'command': command, 'attempt': attempt})
+    print("{} jobs, {} already done, {} to run".format(len(commands), n_done, len(pending)))
+
+    slots = make_slots(args.slots, cores_per_slot=args.cores_per_slot, gpus=args.gpus)
+    for slot in slots:
+        print("slot {}: cores {}, gpu {}".format(slot['index'], slot['cores'], slot['gpu']))
+    if args.dry_run:
+        for job in pending:
+            print(job['command'])
+        return
+
+    os.makedirs(args.job_log_dir, exist_ok=True)
+    journal_dir = os.path.dirname(args.journal)
+    if journal_dir != '':
+        os.makedirs(journal_dir, exist_ok=True)
+    journal = open(args.journal, 'a')
+
+    n_total = n_done + len(pending)
+    n_failed = 0
+    start_time = time.time()
+    last_report = start_time
+    try:
+        while len(pending) > 0 or any(slot['job'] is not None for slot in slots):
+            for slot in slots:
+                # collect finished jobs
+                if slot['job'] is not None:
+                    returncode = slot['process'].poll()
+                    if returncode is None:
+                        continue
+                    job = slot['job']
+                    duration = time.time() - slot['started']
+                    slot['busy_time'] += duration
+                    slot['log_file'].close()
+                    slot['job'] = slot['process'] = slot['log_file'] = None
+                    if returncode == 0:
+                        n_done += 1
+                        write_event(journal, job, 'done', returncode, duration, slot['index'])
+                    else:
+                        write_event(journal, job, 'failed', returncode, duration, slot['index'])
+                        print("Job failed with code {} (attempt {}): {}".format(
+                            returncode, job['attempt'], job['command']), flush=True)
+                        if job['attempt'] < args.max_retries:
+                            pending.append(dict(job, attempt=job['attempt'] + 1))
+                        else:
+                            n_failed += 1
+
+                # give free slots new jobs
+                if slot['job'] is None and len(pending) > 0:
+                    job = pending.pop(0)
+                    start_job(slot, job, args.job_log_dir)
+                    write_event(journal, job, 'started', slot=slot['index'])
+
+            if time.time() - last_report >= args.report_every:
+                report(slots, n_total, n_done, n_failed, len(pending), start_time)
+                last_report = time.time()
+            time.sleep(args.poll_interval)
+    except KeyboardInterrupt:
+        print("Interrupted, terminating running jobs. They will be restarted on resume.")
+        for slot in slots:
+            if slot['process'] is not None:
+                slot['process'].terminate()
+                slot['process'].wait()
+                slot['log_file'].close()
+    finally:
+        report(slots, n_total, n_done, n_failed, len(pending), start_time)
+        journal.close()
+
+
+if __name__ == '__main__':
+    main()
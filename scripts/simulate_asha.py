@@ -0,0 +1,94 @@
+""" Replays successive halving (see modules/asha.py) on the validation curves of finished runs and checks
+that model selection by validation score picks the same configurations as without early termination.
+
+The validation curves are read from the tensorboard event files of the runs.
+
+Example:
+    python -m scripts.simulate_asha -l logs --tag accuracy/val --min_epochs 10 --eta 3
+"""
+import os
+import pickle
+import argparse
+
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+from modules import asha, result_utils
+
+
+def read_curve(run_dir, tag):
+    from tensorboard.backend.event_processing.event_accumulator import EventAccumulator
+    accumulator = EventAccumulator(run_dir, size_guidance={'scalars': 0})
+    accumulator.Reload()
+    if tag not in accumulator.Tags().get('scalars', []):
+        return None
+    events = sorted(accumulator.Scalars(tag), key=lambda e: e.step)
+    return np.array([e.value for e in events])
+
+
+def select_models(df):
+    """ Model selection as in the analysis notebooks. Returns the selected hyperparameters of each group. """
+    df = df.copy()
+    for column in result_utils.method_columns + result_utils.hparam_columns + result_utils.data_columns:
+        if column not in df.columns:
+            df[column] = 'N/A'
+    df = result_utils.fill_missing_values(df)
+    df = result_utils.fill_short_names(df)
+    agg_results = result_utils.get_agg_results(df)
+    best = result_utils.do_model_selection_by_val_score(agg_results)
+    return best[result_utils.method_columns + result_utils.data_columns + result_utils.hparam_columns]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--log_dir', '-l', type=str, required=True)
+    parser.add_argument('--tag', type=str, required=True, help='tensorboard tag of the validation accuracy')
+    parser.add_argument('--min_epochs', type=int, default=10)
+    parser.add_argument('--eta', type=int, default=3)
+    parser.add_argument('--margin', type=float, default=0.0)
+    args = parser.parse_args()
+    print(args)
+
+    records = []
+    curves = {}
+    for instance in tqdm(sorted(os.listdir(args.log_dir))):
+        run_dir = os.path.join(args.log_dir, instance)
+        args_file = os.path.join(run_dir, 'args.pkl')
+        if not os.path.exists(args_file):
+            continue
+        curve = read_curve(run_dir, args.tag)
+        if curve is None or len(curve) == 0:
+            continue
+        with open(args_file, 'rb') as f:
+            run_args = pickle.load(f)
+        curves[instance] = (asha.get_bracket_key(run_args), asha.get_config_key(run_args), run_args.seed, curve)
+        record = vars(run_args)
+        record['log_dir'] = instance
+        records.append(record)
+    print("Read validation curves of {} runs".format(len(curves)))
+
+    n_epochs = asha.simulate(curves, min_epochs=args.min_epochs, eta=args.eta, margin=args.margin)
+    total = sum(len(c[3]) for c in curves.values())
+    kept = sum(n_epochs.values())
+    n_stopped = sum(1 for run, c in curves.items() if n_epochs[run] < len(c[3]))
+    print("Stopped {} of {} runs, {} of {} epochs ({:.1%}) would be trained".format(
+        n_stopped, len(curves), kept, total, kept / max(total, 1)))
+
+    full = pd.DataFrame.from_records(records)
+    full['val_accuracy'] = [float(np.max(curves[run][3])) for run in full['log_dir']]
+    full['test_accuracy'] = 0.0  # not needed for the selection
+    truncated = full.copy()
+    truncated['val_accuracy'] = [float(np.max(curves[run][3][:n_epochs[run]])) for run in full['log_dir']]
+
+    selected_full = select_models(full).reset_index(drop=True)
+    selected_truncated = select_models(truncated).reset_index(drop=True)
+    same = (selected_full.astype(str) == selected_truncated.astype(str)).all(axis=1)
+    print("Model selection picks the same hyperparameters in {} of {} groups".format(int(same.sum()), len(same)))
+    if not same.all():
+        print("Groups with a different winner:")
+        print(pd.concat([selected_full[~same], selected_truncated[~same]], keys=['full', 'asha']))
+
+
+if __name__ == '__main__':
+    main()
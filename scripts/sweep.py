@@ -0,0 +1,141 @@
+""" Runs many training commands inside long-lived python processes.
+
+Starting a new process for every run re-imports torch, torchvision, matplotlib and nnlib and loads the
+dataset again, which dominates the run time of small models (e.g. 4layer-mlp-mnist). This script reads
+commands produced by the command generators (chains made by merge_commands are split), parses them with
+the parsers of the training scripts and calls their run() functions directly.
+
+Loaded data is reused between runs with the same (dataset, error_prob, seed, num_train_examples) and
+the same loader settings. Each run gets fresh RNG states seeded with its --seed and its own log directory.
+With --num_workers > 1, runs are distributed between worker processes, keeping runs that share data on
+the same worker.
+
+Example:
+    python -m scripts.generate_commands > commands.txt
+    python -m scripts.sweep -i commands.txt --num_workers 4
+"""
+import random
+import argparse
+import importlib
+import traceback
+import multiprocessing
+from collections import OrderedDict
+
+import numpy as np
+import torch
+
+from modules import registry, data_cache, data_utils
+from scripts.schedule_commands import read_jobs
+
+
+# the arguments that load_data_from_arguments depends on
+data_args = ['dataset', 'error_prob', 'seed', 'num_train_examples', 'data_augmentation', 'batch_augmentation',
+             'clean_validation', 'batch_size', 'data_cache', 'tensor_loader', 'packed_data']
+
+_loaded_data = OrderedDict()
+_max_cached_datasets = 4
+
+
+def get_data_key(args):
+    return tuple(getattr(args, name, None) for name in data_args)
+
+
+def get_data(args):
+    """ Returns the output of load_data_from_arguments, reusing it between runs with the same data arguments. """
+    key = get_data_key(args)
+    if key in _loaded_data:
+        _loaded_data.move_to_end(key)
+        return _loaded_data[key]
+    data = data_cache.load_data(args)
+    _loaded_data[key] = data
+    while len(_loaded_data) > _max_cached_datasets:
+        _loaded_data.popitem(last=False)
+    return data
+
+
+def set_seed(seed):
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+    if torch.cuda.is_available():
+        torch.cuda.manual_seed_all(seed)
+
+
+def run_command(command):
+    """ Runs one command in the current process. Returns True if it succeeded. """
+    script, args = registry.parse_command(command)
+    if script is None or not hasattr(importlib.import_module(script), 'run'):
+        print("Cannot run in-process, skipping: {}".format(command))
+        return False
+    module = importlib.import_module(script)
+    print(args)
+    try:
+        data = get_data(args)
+        # the data is loaded with the seed of the run, but runs reusing it should not depend on the
+        # RNG state left by the previous run
+        set_seed(args.seed)
+        # batch augmentation and tensor loaders have their own generators
+        train_loader = data[0]
+        if hasattr(train_loader, 'augmentation'):
+            train_loader.augmentation.generator.manual_seed(args.seed)
+            train_loader = train_loader.loader
+        if isinstance(train_loader, data_utils.TensorLoader):
+            train_loader.generator.manual_seed(args.seed)
+        registry.run_registered(args, script, lambda a: module.run(a, data=data))
+        return True
+    except Exception:
+        print("===> run failed: {}\n{}".format(command, traceback.format_exc()))
+        return False
+    finally:
+        import matplotlib.pyplot as plt
+        plt.close('all')
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+
+def run_group(commands):
+    return [run_command(command) for command in commands]
+
+
+def _init_worker(max_cached_datasets):
+    global _max_cached_datasets
+    _max_cached_datasets = max_cached_datasets
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input', '-i', type=str, default='-', help='file with commands, stdin by default')
+    parser.add_argument('--num_workers', '-j', type=int, default=1)
+    parser.add_argument('--max_cached_datasets', type=int, default=4,
+                        help='number of loaded datasets kept in memory by each process')
+    args = parser.parse_args()
+    print(args)
+
+    commands = read_jobs(args.input)
+    parsed = [registry.parse_command(command) for command in commands]
+
+    log_dirs = [a.log_dir for _, a in parsed if a is not None]
+    assert len(log_dirs) == len(set(log_dirs)), 'runs should have distinct log directories'
+
+    # group runs by their data, so that each group loads the data once
+    groups = OrderedDict()
+    for command, (_, a) in zip(commands, parsed):
+        key = get_data_key(a) if a is not None else None
+        groups.setdefault(key, []).append(command)
+    print("{} runs, {} distinct datasets".format(len(commands), len(groups)))
+
+    if args.num_workers <= 1:
+        _init_worker(args.max_cached_datasets)
+        results = [run_group(group) for group in groups.values()]
+    else:
+        context = multiprocessing.get_context('spawn')
+        with context.Pool(args.num_workers, initializer=_init_worker, initargs=(args.max_cached_datasets,),
+                          maxtasksperchild=None) as pool:
+            results = pool.map(run_group, list(groups.values()), chunksize=1)
+
+    n_succeeded = sum(sum(r) for r in results)
+    print("{} of {} runs finished successfully".format(n_succeeded, len(commands)))
+
+
+if __name__ == '__main__':
+    main()
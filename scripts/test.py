@@ -1,11 +1,10 @@
 import os
 import argparse
-import pickle
-
-import torch
+import tempfile
 
 from nnlib.nnlib import utils
 from nnlib.nnlib.data_utils.base import load_data_from_arguments
+from modules import prediction_io
 import methods
 
 
@@ -39,15 +38,13 @@ def main():
 
     print(f"Testing the model saved at {args.load_from}")
     model = utils.load(args.load_from, methods=methods, device=args.device)
-    ret = utils.apply_on_dataset(model, test_loader.dataset, batch_size=args.batch_size,
-                                 output_keys_regexp='pred|label', description='Testing')
-    pred = ret['pred']
-    labels = ret['label']
-    if args.output_dir is not None:
-        with open(os.path.join(args.output_dir, 'test_predictions.pkl'), 'wb') as f:
-            pickle.dump({'pred': pred, 'labels': labels}, f)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        output_dir = (args.output_dir if args.output_dir is not None else tmp_dir)
+        predictions = prediction_io.write_predictions(model, test_loader.dataset,
+                                                      output_dir=os.path.join(output_dir, 'test_predictions'),
+                                                      batch_size=args.batch_size, description='Testing')
+        accuracy = predictions.accuracy()
 
-    accuracy = torch.mean((pred.argmax(dim=1) == labels).float())
     print(accuracy)
     if args.output_dir is not None:
         with open(os.path.join(args.output_dir, 'test_accuracy.txt'), 'w') as f:
@@ -1,16 +1,13 @@
 import os
 import json
 import argparse
-import pickle
 
-import torch
-
-from nnlib.nnlib import utils, training, metrics, callbacks
-from nnlib.nnlib.data_utils.base import load_data_from_arguments
+from nnlib.nnlib import utils, metrics, callbacks
+from modules import prediction_io, async_vis, registry, data_cache, asha, checkpointing, training, validation
 import methods
 
 
-def main():
+def make_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument('--config', '-c', type=str, required=True)
     parser.add_argument('--device', '-d', default='cuda')
@@ -21,10 +18,35 @@ def main():
     parser.add_argument('--batch_size', '-b', type=int, default=256)
     parser.add_argument('--epochs', '-e', type=int, default=400)
     parser.add_argument('--stopping_param', type=int, default=50)
+    validation.add_validation_arguments(parser)
+    parser.add_argument('--asha', action='store_true', dest='asha',
+                        help='stop runs that are dominated by other configurations of the grid (successive halving)')
+    parser.set_defaults(asha=False)
+    parser.add_argument('--asha_db', type=str, default='logs/asha.sqlite')
+    parser.add_argument('--asha_min_epochs', type=int, default=10, help='number of epochs of the first rung')
+    parser.add_argument('--asha_eta', type=int, default=3, help='reduction factor between rungs')
     parser.add_argument('--save_iter', '-s', type=int, default=10)
+    parser.add_argument('--async_checkpoints', action='store_true', dest='async_checkpoints',
+                        help='write checkpoints in a background thread')
+    parser.set_defaults(async_checkpoints=False)
+    parser.add_argument('--keep_last', type=int, default=None,
+                        help='with --async_checkpoints, number of periodic checkpoints to keep')
     parser.add_argument('--vis_iter', '-v', type=int, default=10)
+    parser.add_argument('--async_vis', action='store_true', dest='async_vis',
+                        help='render visualizations in a background process')
+    parser.set_defaults(async_vis=False)
+    parser.add_argument('--vis_queue_size', type=int, default=2,
+                        help='maximum number of pending visualization snapshots when using --async_vis')
     parser.add_argument('--log_dir', '-l', type=str, default=None)
+    parser.add_argument('--no-resume', dest='resume', action='store_false',
+                        help='do not continue from the resume checkpoints in the log directory')
+    parser.set_defaults(resume=True)
+    parser.add_argument('--resume_iter', type=int, default=1, help='write a resume checkpoint every this many epochs')
     parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--registry', type=str, default=registry.default_registry_path,
+                        help='experiment registry used to skip finished or running duplicates')
+    parser.add_argument('--no-registry', dest='use_registry', action='store_false')
+    parser.set_defaults(use_registry=True)
 
     parser.add_argument('--dataset', '-D', type=str, default='mnist',
                         choices=['mnist', 'uniform-noise-mnist',
@@ -33,7 +55,17 @@ def main():
                                  'clothing1m', 'imagenet'])
     parser.add_argument('--data_augmentation', '-A', action='store_true', dest='data_augmentation')
     parser.set_defaults(data_augmentation=False)
+    parser.add_argument('--batch_augmentation', action='store_true', dest='batch_augmentation',
+                        help='with -A, augment whole batches after collation instead of single examples')
+    parser.set_defaults(batch_augmentation=False)
     parser.add_argument('--num_train_examples', type=int, default=None)
+    parser.add_argument('--data_cache', type=str, default=None,
+                        help='directory of memory-mapped preprocessed datasets')
+    parser.add_argument('--packed_data', type=str, default=None,
+                        help='directory with splits packed by scripts/pack_images.py (clothing1m, imagenet)')
+    parser.add_argument('--tensor_loader', action='store_true', dest='tensor_loader',
+                        help='keep the data in memory as tensors and build batches with a single index_select')
+    parser.set_defaults(tensor_loader=False)
     parser.add_argument('--error_prob', '-n', type=float, default=0.0)
     parser.add_argument('--clean_validation', dest='clean_validation', action='store_true')
     parser.set_defaults(clean_validation=False)
@@ -63,11 +95,15 @@ def main():
     parser.add_argument('--noise_std', type=float, default=0.0)
 
     parser.add_argument('--lr', type=float, default=1e-3, help='Learning rate')
-    args = parser.parse_args()
-    print(args)
+    return parser
 
+
+def run(args, data=None):
+    """ Trains and tests a model. data, if given, is the output of load_data_from_arguments(args). """
     # Load data
-    train_loader, val_loader, test_loader, _ = load_data_from_arguments(args)
+    if data is None:
+        data = data_cache.load_data(args)
+    train_loader, val_loader, test_loader, _ = data
 
     # Options
     optimization_args = {
@@ -116,41 +152,80 @@ def main():
     if args.dataset == 'imagenet':
         metrics_list.append(metrics.TopKAccuracy(k=5, output_key='pred'))
 
-    callbacks_list = [callbacks.SaveBestWithMetric(metric=metrics_list[0], partition='val', direction='max')]
+    save_iter = args.save_iter
+    if args.async_checkpoints:
+        checkpoint_writer = checkpointing.AsyncCheckpointWriter(
+            model, os.path.join(args.log_dir, 'checkpoints'), keep_last=args.keep_last)
+        save_best = checkpointing.AsyncSaveBestWithMetric(writer=checkpoint_writer, metric=metrics_list[0],
+                                                          partition='val', direction='max',
+                                                          file_name='best_val.mdl', log_dir=args.log_dir)
+        callbacks_list = [save_best, checkpointing.AsyncSaveEvery(writer=checkpoint_writer, save_iter=args.save_iter)]
+        save_iter = 2**30  # periodic checkpoints are written by the callback above
+    else:
+        callbacks_list = [callbacks.SaveBestWithMetric(metric=metrics_list[0], partition='val', direction='max')]
+
+    validation_schedule = validation.make_validation_schedule(args, val_loader, metric=metrics_list[0],
+                                                              direction='max')
 
     stopper = callbacks.EarlyStoppingWithMetric(metric=metrics_list[0], stopping_param=args.stopping_param,
                                                 partition='val', direction='max')
-
-    training.train(model=model,
-                   train_loader=train_loader,
-                   val_loader=val_loader,
-                   epochs=args.epochs,
-                   save_iter=args.save_iter,
-                   vis_iter=args.vis_iter,
-                   optimization_args=optimization_args,
-                   log_dir=args.log_dir,
-                   args_to_log=args,
-                   stopper=stopper,
-                   metrics=metrics_list,
-                   callbacks=callbacks_list,
-                   device_ids=args.all_device_ids)
+    if args.asha:
+        coordinator = asha.ASHACoordinator(args.asha_db, min_epochs=args.asha_min_epochs, eta=args.asha_eta)
+        stopper = asha.ASHAStopper(stopper=stopper, metric=metrics_list[0], coordinator=coordinator, args=args,
+                                   max_epochs=args.epochs, partition='val', direction='max')
+
+    if args.async_vis:
+        async_vis.enable(max_queue_size=args.vis_queue_size)
+
+    try:
+        training.train(model=model,
+                       train_loader=train_loader,
+                       val_loader=val_loader,
+                       epochs=args.epochs,
+                       save_iter=save_iter,
+                       vis_iter=args.vis_iter,
+                       optimization_args=optimization_args,
+                       log_dir=args.log_dir,
+                       args_to_log=args,
+                       stopper=stopper,
+                       metrics=metrics_list,
+                       callbacks=callbacks_list,
+                       device_ids=args.all_device_ids,
+                       resume=args.resume,
+                       resume_iter=args.resume_iter,
+                       validation_schedule=validation_schedule)
+    finally:
+        async_vis.disable()
 
     # if training finishes successfully, compute the test score
     print("Testing the best validation model...")
-    model = utils.load(os.path.join(args.log_dir, 'checkpoints', 'best_val.mdl'),
-                       methods=methods, device=args.device)
-    pred = utils.apply_on_dataset(model, test_loader.dataset, batch_size=args.batch_size,
-                                  output_keys_regexp='pred', description='Testing')['pred']
-    labels = [p[1] for p in test_loader.dataset]
-    labels = torch.tensor(labels, dtype=torch.long)
-    labels = utils.to_cpu(labels)
-    with open(os.path.join(args.log_dir, 'test_predictions.pkl'), 'wb') as f:
-        pickle.dump({'pred': pred, 'labels': labels}, f)
-
-    accuracy = torch.mean((pred.argmax(dim=1) == labels).float())
+    if args.async_checkpoints:
+        checkpoint_writer.close()
+        model = save_best.load_best(model)
+    else:
+        model = utils.load(os.path.join(args.log_dir, 'checkpoints', 'best_val.mdl'),
+                           methods=methods, device=args.device)
+    predictions = prediction_io.write_predictions(model, test_loader.dataset,
+                                                  output_dir=os.path.join(args.log_dir, 'test_predictions'),
+                                                  batch_size=args.batch_size, description='Testing')
+
+    accuracy = predictions.accuracy()
     with open(os.path.join(args.log_dir, 'test_accuracy.txt'), 'w') as f:
         f.write("{}\n".format(accuracy))
 
+    return {
+        'test_accuracy': os.path.join(args.log_dir, 'test_accuracy.txt'),
+        'best_val_result': os.path.join(args.log_dir, 'best_val_result.txt'),
+        'test_predictions': os.path.join(args.log_dir, 'test_predictions'),
+        'best_val_checkpoint': os.path.join(args.log_dir, 'checkpoints', 'best_val.mdl')
+    }
+
+
+def main():
+    args = make_parser().parse_args()
+    print(args)
+    registry.run_registered(args, 'scripts.train_classifier', run)
+
 
 if __name__ == '__main__':
     main()
@@ -1,16 +1,14 @@
 import os
 import json
 import argparse
-import pickle
 
-import torch
-
-from nnlib.nnlib import utils, training, metrics, callbacks
-from nnlib.nnlib.data_utils.base import load_data_from_arguments
+from nnlib.nnlib import utils, metrics, callbacks
+from modules import prediction_io, async_vis, registry, data_cache, training, validation, checkpointing
+from modules.resnet18_double_descent import PreActResNet, widen_resnet18k
 import methods
 
 
-def main():
+def make_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument('--config', '-c', type=str, required=True)
     parser.add_argument('--device', '-d', default='cuda')
@@ -21,22 +19,53 @@ def main():
     parser.add_argument('--batch_size', '-b', type=int, default=128)
     parser.add_argument('--epochs', '-e', type=int, default=4000)
     parser.add_argument('--stopping_param', type=int, default=2**30)
+    validation.add_validation_arguments(parser)
     parser.add_argument('--save_iter', '-s', type=int, default=100)
+    parser.add_argument('--async_checkpoints', action='store_true', dest='async_checkpoints',
+                        help='write checkpoints in a background thread')
+    parser.set_defaults(async_checkpoints=False)
+    parser.add_argument('--keep_last', type=int, default=None,
+                        help='with --async_checkpoints, number of periodic checkpoints to keep')
     parser.add_argument('--vis_iter', '-v', type=int, default=10)
+    parser.add_argument('--async_vis', action='store_true', dest='async_vis',
+                        help='render visualizations in a background process')
+    parser.set_defaults(async_vis=False)
+    parser.add_argument('--vis_queue_size', type=int, default=2,
+                        help='maximum number of pending visualization snapshots when using --async_vis')
     parser.add_argument('--log_dir', '-l', type=str, default=None)
+    parser.add_argument('--no-resume', dest='resume', action='store_false',
+                        help='do not continue from the resume checkpoints in the log directory')
+    parser.set_defaults(resume=True)
+    parser.add_argument('--resume_iter', type=int, default=1, help='write a resume checkpoint every this many epochs')
     parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--registry', type=str, default=registry.default_registry_path,
+                        help='experiment registry used to skip finished or running duplicates')
+    parser.add_argument('--no-registry', dest='use_registry', action='store_false')
+    parser.set_defaults(use_registry=True)
 
     parser.add_argument('--dataset', '-D', type=str, default='uniform-noise-cifar10',
                         choices=['uniform-noise-cifar10'])
     parser.add_argument('--data_augmentation', '-A', action='store_true', dest='data_augmentation')
     parser.set_defaults(data_augmentation=False)
+    parser.add_argument('--batch_augmentation', action='store_true', dest='batch_augmentation',
+                        help='with -A, augment whole batches after collation instead of single examples')
+    parser.set_defaults(batch_augmentation=False)
     parser.add_argument('--num_train_examples', type=int, default=None)
+    parser.add_argument('--data_cache', type=str, default=None,
+                        help='directory of memory-mapped preprocessed datasets')
+    parser.add_argument('--tensor_loader', action='store_true', dest='tensor_loader',
+                        help='keep the data in memory as tensors and build batches with a single index_select')
+    parser.set_defaults(tensor_loader=False)
     parser.add_argument('--error_prob', '-n', type=float, default=0.0)
     parser.add_argument('--clean_validation', dest='clean_validation', action='store_true')
     parser.set_defaults(clean_validation=False)
 
     parser.add_argument('--model_class', '-m', type=str, default='StandardClassifier')
     parser.add_argument('--load_from', type=str, default=None)
+    parser.add_argument('--warm_start_from', type=str, default=None,
+                        help='checkpoint of a trained narrower model, widened to width k with Net2Net')
+    parser.add_argument('--warm_start_noise', type=float, default=0.01,
+                        help='relative std of the symmetry-breaking noise of the widened weights')
     parser.add_argument('--grad_weight_decay', '-L', type=float, default=0.0)
     parser.add_argument('--lamb', type=float, default=1.0)
     parser.add_argument('--pretrained_arg', '-r', type=str, default=None)
@@ -50,21 +79,11 @@ def main():
     parser.add_argument('--k', '-k', type=int, required=False, default=10,
                         help='width parameter of ResNet18-k')
     parser.add_argument('--exclude_percent', type=float, default=0.0)  # TODO: make this argument work
-    args = parser.parse_args()
-    print(args)
+    return parser
 
-    # Load data
-    train_loader, val_loader, test_loader, _ = load_data_from_arguments(args)
-
-    # Options
-    optimization_args = {
-        'optimizer': {
-            'name': 'adam',
-            'lr': args.lr,
-            'weight_decay': args.weight_decay
-        }
-    }
 
+def make_model(args, input_shape):
+    """ Builds the model of the given width args.k. """
     with open(args.config, 'r') as f:
         architecture_args = json.load(f)
 
@@ -78,7 +97,7 @@ def main():
 
     model_class = getattr(methods, args.model_class)
 
-    model = model_class(input_shape=train_loader.dataset[0][0].shape,
+    model = model_class(input_shape=input_shape,
                         architecture_args=architecture_args,
                         pretrained_arg=args.pretrained_arg,
                         device=args.device,
@@ -89,30 +108,24 @@ def main():
                         load_from=args.load_from,
                         loss_function='ce')
 
-    metrics_list = [metrics.Accuracy(output_key='pred')]
-    if args.dataset == 'imagenet':
-        metrics_list.append(metrics.TopKAccuracy(k=5, output_key='pred'))
+    if args.warm_start_from is not None:
+        warm_start(model, args.warm_start_from, k=args.k, noise_std=args.warm_start_noise,
+                   seed=args.seed, device=args.device)
+    return model
 
-    callbacks_list = [callbacks.SaveBestWithMetric(metric=metrics_list[0], partition='val', direction='max')]
 
-    stopper = callbacks.EarlyStoppingWithMetric(metric=metrics_list[0], stopping_param=args.stopping_param,
-                                                partition='val', direction='max')
+def warm_start(model, load_from, k, noise_std, seed, device):
+    """ Replaces the ResNet18-k networks of the model with widened copies of the networks stored in load_from. """
+    print("Warm-starting from {}".format(load_from))
+    stored_model = utils.load(load_from, methods=methods, device='cpu')
+    for name in ['classifier', 'q_network']:
+        net = getattr(stored_model, name, None)
+        if isinstance(net, PreActResNet):
+            setattr(model, name, widen_resnet18k(net, new_k=k, noise_std=noise_std, seed=seed).to(device))
 
-    training.train(model=model,
-                   train_loader=train_loader,
-                   val_loader=val_loader,
-                   epochs=args.epochs,
-                   save_iter=args.save_iter,
-                   vis_iter=args.vis_iter,
-                   optimization_args=optimization_args,
-                   log_dir=args.log_dir,
-                   args_to_log=args,
-                   stopper=stopper,
-                   metrics=metrics_list,
-                   callbacks=callbacks_list,
-                   device_ids=args.all_device_ids)
-
-    # test the last model and best model
+
+def test_models(args, test_loader):
+    """ Tests the best validation and the final checkpoints in args.log_dir. Returns the result paths. """
     models_to_test = [
         {
             'name': 'best',
@@ -123,22 +136,99 @@ def main():
             'file': 'final.mdl'
         }
     ]
+    result_paths = {}
     for spec in models_to_test:
         print("Testing the {} model...".format(spec['name']))
         model = utils.load(os.path.join(args.log_dir, 'checkpoints', spec['file']),
                            methods=methods, device=args.device)
-        pred = utils.apply_on_dataset(model, test_loader.dataset, batch_size=args.batch_size,
-                                      output_keys_regexp='pred', description='Testing')['pred']
-        labels = [p[1] for p in test_loader.dataset]
-        labels = torch.tensor(labels, dtype=torch.long)
-        labels = utils.to_cpu(labels)
-        with open(os.path.join(args.log_dir, '{}_test_predictions.pkl'.format(spec['name'])), 'wb') as f:
-            pickle.dump({'pred': pred, 'labels': labels}, f)
-
-        accuracy = torch.mean((pred.argmax(dim=1) == labels).float())
+        predictions = prediction_io.write_predictions(
+            model, test_loader.dataset,
+            output_dir=os.path.join(args.log_dir, '{}_test_predictions'.format(spec['name'])),
+            batch_size=args.batch_size, description='Testing')
+
+        accuracy = predictions.accuracy()
         with open(os.path.join(args.log_dir, '{}_test_accuracy.txt'.format(spec['name'])), 'w') as f:
             f.write("{}\n".format(accuracy))
 
+        result_paths['{}_test_accuracy'.format(spec['name'])] = \
+            os.path.join(args.log_dir, '{}_test_accuracy.txt'.format(spec['name']))
+        result_paths['{}_checkpoint'.format(spec['name'])] = os.path.join(args.log_dir, 'checkpoints', spec['file'])
+    return result_paths
+
+
+def run(args, data=None):
+    """ Trains and tests a model. data, if given, is the output of load_data_from_arguments(args). """
+    # Load data
+    if data is None:
+        data = data_cache.load_data(args)
+    train_loader, val_loader, test_loader, _ = data
+
+    # Options
+    optimization_args = {
+        'optimizer': {
+            'name': 'adam',
+            'lr': args.lr,
+            'weight_decay': args.weight_decay
+        }
+    }
+
+    model = make_model(args, input_shape=train_loader.dataset[0][0].shape)
+
+    metrics_list = [metrics.Accuracy(output_key='pred')]
+    if args.dataset == 'imagenet':
+        metrics_list.append(metrics.TopKAccuracy(k=5, output_key='pred'))
+
+    save_iter = args.save_iter
+    if args.async_checkpoints:
+        checkpoint_writer = checkpointing.AsyncCheckpointWriter(
+            model, os.path.join(args.log_dir, 'checkpoints'), keep_last=args.keep_last)
+        save_best = checkpointing.AsyncSaveBestWithMetric(writer=checkpoint_writer, metric=metrics_list[0],
+                                                          partition='val', direction='max',
+                                                          file_name='best_val_accuracy.mdl', log_dir=args.log_dir)
+        callbacks_list = [save_best, checkpointing.AsyncSaveEvery(writer=checkpoint_writer, save_iter=args.save_iter)]
+        save_iter = 2**30  # periodic checkpoints are written by the callback above
+    else:
+        callbacks_list = [callbacks.SaveBestWithMetric(metric=metrics_list[0], partition='val', direction='max')]
+
+    validation_schedule = validation.make_validation_schedule(args, val_loader, metric=metrics_list[0],
+                                                              direction='max')
+
+    stopper = callbacks.EarlyStoppingWithMetric(metric=metrics_list[0], stopping_param=args.stopping_param,
+                                                partition='val', direction='max')
+
+    if args.async_vis:
+        async_vis.enable(max_queue_size=args.vis_queue_size)
+
+    try:
+        training.train(model=model,
+                       train_loader=train_loader,
+                       val_loader=val_loader,
+                       epochs=args.epochs,
+                       save_iter=save_iter,
+                       vis_iter=args.vis_iter,
+                       optimization_args=optimization_args,
+                       log_dir=args.log_dir,
+                       args_to_log=args,
+                       stopper=stopper,
+                       metrics=metrics_list,
+                       callbacks=callbacks_list,
+                       device_ids=args.all_device_ids,
+                       resume=args.resume,
+                       resume_iter=args.resume_iter,
+                       validation_schedule=validation_schedule)
+    finally:
+        async_vis.disable()
+
+    if args.async_checkpoints:
+        checkpoint_writer.close()  # test_models reads the best checkpoint from the disk
+    return test_models(args, test_loader)
+
+
+def main():
+    args = make_parser().parse_args()
+    print(args)
+    registry.run_registered(args, 'scripts.train_classifier_double_descent', run)
+
 
 if __name__ == '__main__':
     main()
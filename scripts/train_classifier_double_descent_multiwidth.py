@@ -0,0 +1,293 @@
+""" Trains ResNet18-k models of several widths k in one process, on identical batches.
+
+Data loading and augmentation are done once per batch for the whole width grid, and every model takes
+one optimization step on the batch. Each model has its own Adam optimizer, log directory (--log_dir with
+`{k}` replaced by the width), tensorboard logs, checkpoints (best_val_accuracy.mdl and final.mdl) and
+test results, in the same layout as scripts/train_classifier_double_descent.py.
+
+Resume checkpoints are written to the log directory of every width (see modules/training.py). Unless
+--no-resume is given, an interrupted run continues from the latest epoch that all widths have a
+resume checkpoint for, since the widths share the order of the batches.
+
+Every width is recorded as a separate experiment in the experiment registry (modules/registry.py), widths
+with an equivalent finished or running experiment are left out of the grid. The validation schedule
+(--val_schedule every or geometric) is shared by all widths.
+
+Example:
+    python -um scripts.train_classifier_double_descent_multiwidth -c configs/double-descent-cifar10-resnet18.json \
+        -D uniform-noise-cifar10 -n 0.2 -A --ks 2 4 6 8 10 -l double_descent_logs/cifar10-noise0.2-k{k}-seed42
+"""
+import os
+import copy
+import pickle
+import contextlib
+
+import torch
+from torch.utils.tensorboard import SummaryWriter
+from tqdm import tqdm
+
+from nnlib.nnlib import utils
+from modules import data_cache, training, validation, registry, async_vis
+from scripts.train_classifier_double_descent import make_parser, make_model, test_models
+
+
+script_name = 'scripts.train_classifier_double_descent_multiwidth'
+
+
+class WidthRun(object):
+    """ Training state of one width. """
+    def __init__(self, args, model):
+        self.args = args
+        self.model = model
+        self.optimizer = torch.optim.Adam(model.parameters(), lr=args.lr, weight_decay=args.weight_decay)
+        self.checkpoint_dir = os.path.join(args.log_dir, 'checkpoints')
+        os.makedirs(self.checkpoint_dir, exist_ok=True)
+        with open(os.path.join(args.log_dir, 'args.pkl'), 'wb') as f:
+            pickle.dump(args, f)
+        self.tensorboard = SummaryWriter(args.log_dir)
+        self.best_val = -1.0
+        self.best_epoch = -1
+        self.stopped = False
+
+    def train_step(self, x, y):
+        self.model.train()
+        outputs = self.model.forward(inputs=[x], grad_enabled=True)
+        batch_losses, outputs = self.model.compute_loss(inputs=[x], labels=[y], outputs=outputs, grad_enabled=True)
+        loss = sum(batch_losses.values())
+        self.optimizer.zero_grad()
+        loss.backward()
+        if hasattr(self.model, 'before_weight_update'):
+            self.model.before_weight_update()
+        self.optimizer.step()
+        self.model.on_iteration_end(outputs=outputs, batch_losses=batch_losses, batch_labels=[y],
+                                    partition='train', tensorboard=self.tensorboard)
+        correct = (outputs['pred'].argmax(dim=1) == y.to(outputs['pred'].device)).sum()
+        return loss.detach(), correct
+
+    def get_state(self):
+        return {
+            'model': self.model.state_dict(),
+            'current_iteration': dict(getattr(self.model, '_current_iteration', {})),
+            'optimizer': self.optimizer.state_dict(),
+            'run': training.get_object_state(self),
+        }
+
+    def set_state(self, state):
+        self.model.load_state_dict(state['model'])
+        if hasattr(self.model, '_current_iteration'):
+            self.model._current_iteration.update(state['current_iteration'])
+        self.optimizer.load_state_dict(state['optimizer'])
+        training.set_object_state(self, state['run'])
+
+    def end_epoch(self, epoch, train_loss, train_accuracy, val_accuracy, stopping_param):
+        self.model.on_epoch_end(partition='train', epoch=epoch, tensorboard=self.tensorboard)
+        self.tensorboard.add_scalar('losses/train', train_loss, epoch)
+        self.tensorboard.add_scalar('accuracy/train', train_accuracy, epoch)
+        if val_accuracy is not None:
+            self.tensorboard.add_scalar('accuracy/val', val_accuracy, epoch)
+            if val_accuracy > self.best_val:
+                self.best_val = val_accuracy
+                self.best_epoch = epoch
+                utils.save(self.model, os.path.join(self.checkpoint_dir, 'best_val_accuracy.mdl'))
+                with open(os.path.join(self.args.log_dir, 'best_val_result.txt'), 'w') as f:
+                    f.write("{}\n".format(val_accuracy))
+            elif epoch - self.best_epoch > stopping_param:
+                print("Stopping k={} at epoch {}".format(self.args.k, epoch))
+                self.stopped = True
+
+
+def make_width_args(args):
+    assert '{k}' in args.log_dir, 'the log directory should contain {k}'
+    width_args = []
+    for k in args.ks:
+        a = copy.copy(args)
+        a.k = k
+        a.log_dir = args.log_dir.format(k=k)
+        del a.ks
+        width_args.append(a)
+    return width_args
+
+
+def save_resume_checkpoints(runs, epoch, loaders, validation_schedule):
+    """ Writes the state of every width after the given epoch. The random states and the validation schedule
+    are shared by all widths.
+    """
+    rng = training.get_rng_state(loaders)
+    schedule_state = training.get_object_state(validation_schedule)
+    for run in runs:
+        state = run.get_state()
+        state.update({'epoch': epoch, 'rng': rng, 'validation_schedule': schedule_state})
+        training.write_resume_state(run.args.log_dir, epoch, state)
+
+
+def load_resume_checkpoints(runs, loaders, validation_schedule):
+    """ Restores all widths from the latest epoch for which every width has a readable resume checkpoint.
+    Returns the epoch to start from.
+    """
+    epochs = set.intersection(*[set(training.list_resume_checkpoints(run.args.log_dir)) for run in runs])
+    for epoch in sorted(epochs, reverse=True):
+        states = [training.read_resume_checkpoint(run.args.log_dir, epoch) for run in runs]
+        if any(state is None for state in states):
+            continue
+        for run, state in zip(runs, states):
+            run.set_state(state)
+        training.set_object_state(validation_schedule, states[0]['validation_schedule'])
+        training.set_rng_state(states[0]['rng'], loaders)
+        print("Resuming the training from epoch {}".format(epoch + 1))
+        return epoch + 1
+    return 0
+
+
+@torch.no_grad()
+def evaluate(runs, loader, device):
+    """ Accuracies of all active models on the loader, computed with one pass over the data. """
+    correct = [0] * len(runs)
+    total = 0
+    for run in runs:
+        run.model.eval()
+    for x, y in loader:
+        x = x.to(device)
+        y = y.to(device)
+        for i, run in enumerate(runs):
+            if not run.stopped:
+                pred = run.model.forward(inputs=[x], grad_enabled=False)['pred']
+                correct[i] += int((pred.argmax(dim=1) == y).sum())
+        total += len(y)
+    return [c / max(total, 1) for c in correct]
+
+
+def register_widths(experiment_registry, width_args):
+    """ Registers every width as a separate experiment. Widths with an equivalent finished or in-flight
+    experiment are dropped. Returns the remaining width arguments and their registry keys.
+    """
+    started_args = []
+    keys = []
+    for a in width_args:
+        key = registry.get_experiment_key(a, script_name)
+        started, entry = experiment_registry.start(key, script_name, a)
+        if not started:
+            print("Skipping k={}, an equivalent experiment is {} (log_dir: {}, key: {})".format(
+                a.k, entry['status'], entry['log_dir'], key))
+            continue
+        started_args.append(a)
+        keys.append(key)
+    return started_args, keys
+
+
+def train_and_test(args, width_args, on_tested=None):
+    """ Trains the widths of width_args together and tests them. on_tested(i, result_paths) is called after
+    the i-th width is tested. Returns the result paths of all widths.
+    """
+    train_loader, val_loader, test_loader, _ = data_cache.load_data(args)
+    input_shape = train_loader.dataset[0][0].shape
+
+    runs = []
+    for a in width_args:
+        torch.manual_seed(a.seed)
+        runs.append(WidthRun(a, make_model(a, input_shape=input_shape)))
+
+    # the accuracy is computed by evaluate(), the schedule only decides when
+    validation_schedule = validation.make_validation_schedule(args, val_loader, metric=None)
+    loaders = [train_loader, val_loader]
+    start_epoch = load_resume_checkpoints(runs, loaders, validation_schedule) if args.resume else 0
+
+    if args.async_vis:
+        async_vis.enable(max_queue_size=args.vis_queue_size)
+
+    try:
+        for epoch in range(start_epoch, args.epochs):
+            active = [run for run in runs if not run.stopped]
+            if len(active) == 0:
+                break
+            for run in active:
+                run.model.on_epoch_start(partition='train', epoch=epoch, loader=train_loader,
+                                         tensorboard=run.tensorboard)
+
+            losses = [0.0] * len(active)
+            correct = [0] * len(active)
+            n_examples = 0
+            n_batches = 0
+            for x, y in tqdm(train_loader, desc='Epoch {}'.format(epoch)):
+                # the batch is loaded, augmented and moved to the device once for all widths
+                x = x.to(args.device, non_blocking=True)
+                y = y.to(args.device, non_blocking=True)
+                for i, run in enumerate(active):
+                    loss, batch_correct = run.train_step(x, y)
+                    losses[i] += loss
+                    correct[i] += batch_correct
+                n_examples += len(y)
+                n_batches += 1
+
+            # as in modules/training.train, the best checkpoints and early stopping use only full evaluations
+            val_accuracies = [None] * len(runs)
+            if val_loader is not None and validation_schedule.is_full(epoch, args.epochs):
+                val_accuracies = evaluate(runs, val_loader, args.device)
+            for i, run in enumerate(active):
+                run.end_epoch(epoch=epoch,
+                              train_loss=float(losses[i]) / max(n_batches, 1),
+                              train_accuracy=float(correct[i]) / max(n_examples, 1),
+                              val_accuracy=val_accuracies[runs.index(run)],
+                              stopping_param=args.stopping_param)
+                if (epoch + 1) % args.save_iter == 0:
+                    utils.save(run.model, os.path.join(run.checkpoint_dir, 'epoch{}.mdl'.format(epoch)))
+                if (epoch + 1) % args.vis_iter == 0:
+                    figures = run.model.visualize(train_loader, val_loader, tensorboard=run.tensorboard, epoch=epoch)
+                    for name, figure in (figures or {}).items():
+                        run.tensorboard.add_figure(name, figure, epoch)
+            if (epoch + 1) % args.resume_iter == 0 or epoch + 1 == args.epochs or all(run.stopped for run in runs):
+                save_resume_checkpoints(runs, epoch, loaders, validation_schedule)
+    finally:
+        async_vis.disable()
+
+    all_result_paths = []
+    for i, run in enumerate(runs):
+        utils.save(run.model, os.path.join(run.checkpoint_dir, 'final.mdl'))
+        run.tensorboard.close()
+        result_paths = test_models(run.args, test_loader)
+        if on_tested is not None:
+            on_tested(i, result_paths)
+        all_result_paths.append(result_paths)
+    return all_result_paths
+
+
+def main():
+    parser = make_parser()
+    parser.add_argument('--ks', type=int, nargs='+', required=True, help='width parameters of ResNet18-k')
+    args = parser.parse_args()
+    if args.all_device_ids is not None:
+        parser.error('--all_device_ids is not supported, all widths are trained on --device')
+    if args.val_schedule == 'subsample':
+        parser.error('--val_schedule subsample is not supported, use every or geometric')
+    if args.async_checkpoints:
+        parser.error('--async_checkpoints is not supported, checkpoints of all widths are written synchronously')
+    print(args)
+
+    width_args = make_width_args(args)
+    if not args.use_registry:
+        train_and_test(args, width_args)
+        return
+
+    experiment_registry = registry.ExperimentRegistry(args.registry)
+    width_args, keys = register_widths(experiment_registry, width_args)
+    if len(width_args) == 0:
+        return
+    finished = []
+
+    def on_tested(i, result_paths):
+        experiment_registry.finish(keys[i], result_paths)
+        finished.append(keys[i])
+
+    try:
+        with contextlib.ExitStack() as stack:
+            for key in keys:
+                stack.enter_context(registry.Heartbeat(experiment_registry, key))
+            train_and_test(args, width_args, on_tested=on_tested)
+    except BaseException:
+        for key in keys:
+            if key not in finished:
+                experiment_registry.fail(key)
+        raise
+
+
+if __name__ == '__main__':
+    main()
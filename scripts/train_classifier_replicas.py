@@ -0,0 +1,143 @@
+""" Trains a grid of StandardClassifier replicas (seeds x lr x weight_decay x noise_std) in one process.
+
+All replicas are trained in lock-step with vectorized forward and backward passes (see modules/replicas.py).
+Each replica keeps its own optimizer state and early stopping, and gets its own log directory
+`{log_dir}-lr{lr}-wd{weight_decay}-noise_std{noise_std}-seed{seed}` with the same files that
+scripts/train_classifier.py writes (args.pkl, best_val_result.txt, test_accuracy.txt, test predictions
+and the best checkpoint), so that results can be collected with scripts/extract_results_from_logs.py.
+
+Replicas with the same seed share the data (including the label noise). For every distinct seed the data
+is loaded once and the replicas are fed from the loaders of their seed.
+
+Resume checkpoints of the whole grid are written to `{log_dir}/resume/`. Unless --no-resume is given, an
+interrupted run of the same grid continues from the latest one.
+
+Options of scripts/train_classifier.py that the replica trainer does not implement (validation schedules,
+ASHA, periodic and asynchronous checkpoints, visualizations, the experiment registry and multiple devices)
+are rejected. Replicas are validated every epoch and are not recorded in the experiment registry.
+"""
+import os
+import copy
+import json
+import pickle
+import itertools
+
+import torch
+from torch.utils.tensorboard import SummaryWriter
+
+from nnlib.nnlib import utils
+from modules import prediction_io, replicas, data_cache
+from scripts.train_classifier import make_parser
+import methods
+
+
+def make_replica_args(args):
+    seeds = args.seeds or [args.seed]
+    lrs = args.lrs or [args.lr]
+    weight_decays = args.weight_decays or [args.weight_decay]
+    noise_stds = args.noise_stds or [args.noise_std]
+    replica_args = []
+    for lr, weight_decay, noise_std, seed in itertools.product(lrs, weight_decays, noise_stds, seeds):
+        r = copy.copy(args)
+        r.seed = seed
+        r.lr = lr
+        r.weight_decay = weight_decay
+        r.noise_std = noise_std
+        r.add_noise = args.add_noise or noise_std > 0
+        r.log_dir = "{}-lr{}-wd{}-noise_std{}-seed{}".format(args.log_dir, lr, weight_decay, noise_std, seed)
+        for name in ['seeds', 'lrs', 'weight_decays', 'noise_stds']:
+            delattr(r, name)
+        replica_args.append(r)
+    return replica_args
+
+
+def main():
+    parser = make_parser()
+    parser.add_argument('--seeds', nargs='+', type=int, default=None)
+    parser.add_argument('--lrs', nargs='+', type=float, default=None)
+    parser.add_argument('--weight_decays', nargs='+', type=float, default=None)
+    parser.add_argument('--noise_stds', nargs='+', type=float, default=None)
+    parser.set_defaults(use_registry=False)
+    args = parser.parse_args()
+    unsupported = ['all_device_ids', 'asha', 'asha_db', 'asha_min_epochs', 'asha_eta', 'save_iter',
+                   'async_checkpoints', 'keep_last', 'vis_iter', 'async_vis', 'vis_queue_size', 'registry',
+                   'val_schedule', 'val_every', 'val_ratio', 'val_subsample_size', 'val_margin', 'val_max_gap']
+    for name in unsupported:
+        if getattr(args, name) != parser.get_default(name):
+            parser.error('--{} is not supported by the replica trainer'.format(name))
+    print(args)
+    assert args.model_class == 'StandardClassifier' and args.loss_function == 'ce', \
+        'only StandardClassifier with cross-entropy loss is supported'
+    assert args.load_from is None
+
+    replica_args = make_replica_args(args)
+    print("Training {} replicas".format(len(replica_args)))
+
+    # load the data of each seed once
+    seeds = sorted(set(r.seed for r in replica_args))
+    data = {}
+    for seed in seeds:
+        data[seed] = data_cache.load_data(next(r for r in replica_args if r.seed == seed))
+    data_index = [seeds.index(r.seed) for r in replica_args]
+
+    with open(args.config, 'r') as f:
+        architecture_args = json.load(f)
+
+    models = []
+    for r in replica_args:
+        torch.manual_seed(r.seed)
+        models.append(methods.StandardClassifier(input_shape=data[r.seed][0].dataset[0][0].shape,
+                                                 architecture_args=architecture_args,
+                                                 pretrained_arg=r.pretrained_arg,
+                                                 device=r.device,
+                                                 loss_function='ce',
+                                                 add_noise=r.add_noise,
+                                                 noise_type=r.noise_type,
+                                                 noise_std=r.noise_std,
+                                                 loss_function_param=r.loss_function_param))
+
+    trainer = replicas.ReplicaTrainer(models,
+                                      lrs=[r.lr for r in replica_args],
+                                      weight_decays=[r.weight_decay for r in replica_args],
+                                      noise_stds=[r.noise_std if r.add_noise else 0.0 for r in replica_args],
+                                      noise_type=args.noise_type,
+                                      device=args.device)
+
+    writers = []
+    for r in replica_args:
+        os.makedirs(os.path.join(r.log_dir, 'checkpoints'), exist_ok=True)
+        with open(os.path.join(r.log_dir, 'args.pkl'), 'wb') as f:
+            pickle.dump(r, f)
+        writers.append(SummaryWriter(r.log_dir))
+
+    best_val, best_states = replicas.train_replicas(trainer,
+                                                    train_loaders=[data[seed][0] for seed in seeds],
+                                                    val_loaders=[data[seed][1] for seed in seeds],
+                                                    data_index=data_index,
+                                                    epochs=args.epochs,
+                                                    stopping_param=args.stopping_param,
+                                                    writers=writers,
+                                                    log_dir=args.log_dir,
+                                                    run_names=[r.log_dir for r in replica_args],
+                                                    resume=args.resume,
+                                                    resume_iter=args.resume_iter)
+
+    for r, model, val_accuracy, state, writer in zip(replica_args, models, best_val, best_states, writers):
+        writer.close()
+        model.classifier.load_state_dict(state)
+        model.classifier.to(r.device)
+        utils.save(model, os.path.join(r.log_dir, 'checkpoints', 'best_val.mdl'))
+        with open(os.path.join(r.log_dir, 'best_val_result.txt'), 'w') as f:
+            f.write("{}\n".format(val_accuracy))
+
+        print("Testing the best validation model of {}...".format(r.log_dir))
+        test_loader = data[r.seed][2]
+        predictions = prediction_io.write_predictions(model, test_loader.dataset,
+                                                      output_dir=os.path.join(r.log_dir, 'test_predictions'),
+                                                      batch_size=r.batch_size, description='Testing')
+        with open(os.path.join(r.log_dir, 'test_accuracy.txt'), 'w') as f:
+            f.write("{}\n".format(predictions.accuracy()))
+
+
+if __name__ == '__main__':
+    main()
@@ -2,8 +2,9 @@ import argparse
 import json
 
 from methods.vae import VAE
-from nnlib.nnlib import training
 from nnlib.nnlib.data_utils.base import load_data_from_arguments
+from modules import async_vis, training
+from modules import visualization as vis
 
 
 def main():
@@ -15,7 +16,16 @@ def main():
     parser.add_argument('--epochs', '-e', type=int, default=400)
     parser.add_argument('--save_iter', '-s', type=int, default=10)
     parser.add_argument('--vis_iter', '-v', type=int, default=10)
+    parser.add_argument('--async_vis', action='store_true', dest='async_vis',
+                        help='render visualizations in a background process')
+    parser.set_defaults(async_vis=False)
+    parser.add_argument('--vis_queue_size', type=int, default=2,
+                        help='maximum number of pending visualization snapshots when using --async_vis')
     parser.add_argument('--log_dir', '-l', type=str, default=None)
+    parser.add_argument('--no-resume', dest='resume', action='store_false',
+                        help='do not continue from the resume checkpoints in the log directory')
+    parser.set_defaults(resume=True)
+    parser.add_argument('--resume_iter', type=int, default=1, help='write a resume checkpoint every this many epochs')
     parser.add_argument('--seed', type=int, default=42)
 
     parser.add_argument('--dataset', '-D', type=str, default='mnist',
@@ -53,14 +63,23 @@ def main():
                 architecture_args=architecture_args,
                 device=args.device)
 
-    training.train(model=model,
-                   train_loader=train_loader,
-                   val_loader=val_loader,
-                   epochs=args.epochs,
-                   save_iter=args.save_iter,
-                   vis_iter=args.vis_iter,
-                   optimization_args=optimization_args,
-                   log_dir=args.log_dir)
+    if args.async_vis:
+        async_vis.enable(max_queue_size=args.vis_queue_size)
+
+    try:
+        training.train(model=model,
+                       train_loader=train_loader,
+                       val_loader=val_loader,
+                       epochs=args.epochs,
+                       save_iter=args.save_iter,
+                       vis_iter=args.vis_iter,
+                       optimization_args=optimization_args,
+                       log_dir=args.log_dir,
+                       resume=args.resume,
+                       resume_iter=args.resume_iter)
+    finally:
+        async_vis.disable()
+        vis.clear_embedding_state(args.log_dir)
 
 
 if __name__ == '__main__':